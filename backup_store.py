@@ -0,0 +1,277 @@
+"""
+Content-addressed store of the versions of the Terraform States, snapshotted before they are changed
+
+A snapshot is split into chunks at the resource boundaries of the file: what comes before the first resource,
+every resource and what is between and after them. A chunk is stored once, compressed, whatever the number of
+snapshots it is part of, so the snapshots of a state that changes a few resources at a time cost little more than
+the changed resources. The chunks new to a snapshot are written together as one pack, so a snapshot is three objects
+(pack, pack index and manifest) in a local directory or under an S3 prefix:
+
+    packs/<pack>.pack                   the compressed chunks, one after the other
+    packs/<pack>.idx                    {chunk hash: [offset, length]} of the pack
+    snapshots/<bucket>/<key>/<id>.json  the snapshot: its size, sha256, packs and blocks of chunk hashes
+
+The list of the chunk hashes of a snapshot is itself split into blocks stored as chunks, at content-defined
+boundaries, so unchanged runs of resources share their blocks too, even when resources were added or removed before.
+A snapshot is restored from its own packs only, without reading the other snapshots.
+"""
+import datetime
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Any, List, Optional, Tuple
+
+import logging
+
+from state_errors import TFStateChangeError, ObjectNotFoundError
+from state_scanner import scan_resources
+from storage import S3Backend, StorageBackend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.local', 'share', 'tf-state-change', 'backups')
+MB = 1024 * 1024
+# A file that is not laid out the way Terraform writes states is chunked by size
+FALLBACK_CHUNK_SIZE = 1 * MB
+# A block of chunk hashes ends after a hash that is 0 modulo BLOCK_CUT, i.e. every BLOCK_CUT chunks on average
+BLOCK_CUT = 64
+COMPRESSION_LEVEL = 6
+
+
+def chunk_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def split_chunks(data: bytes) -> List[bytes]:
+    """The chunks of a state file, at the boundaries of its resources when it is laid out the way Terraform does"""
+    layout = scan_resources(data) if data else None
+    if layout is None:
+        return [data[start:start + FALLBACK_CHUNK_SIZE] for start in range(0, len(data), FALLBACK_CHUNK_SIZE)]
+    chunks, previous = [], 0
+    for start, end in layout.spans:
+        chunks.append(data[previous:start])
+        chunks.append(data[start:end])
+        previous = end
+    chunks.append(data[previous:])
+    return chunks
+
+
+def split_blocks(hashes: List[str]) -> List[List[str]]:
+    """Content-defined blocks of chunk hashes: the same run of hashes is cut the same way wherever it is"""
+    blocks, current = [], []
+    for value in hashes:
+        current.append(value)
+        if int(value[:8], 16) % BLOCK_CUT == 0:
+            blocks.append(current)
+            current = []
+    if current:
+        blocks.append(current)
+    return blocks
+
+
+class _Directory:
+    """The objects of a store kept in a local directory"""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def put(self, name: str, data: bytes) -> None:
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, name: str) -> bytes:
+        try:
+            with open(os.path.join(self.root, name), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            raise TFStateChangeError(f'{name} is not in the backup store {self.root}')
+
+    def list(self, prefix: str) -> List[str]:
+        directory = os.path.join(self.root, prefix)
+        if not os.path.isdir(directory):
+            return []
+        return [f'{prefix}/{name}' for name in sorted(os.listdir(directory)) if not name.endswith('.tmp')]
+
+    def __str__(self) -> str:
+        return self.root
+
+
+class _Prefix:
+    """The objects of a store kept under a prefix of a bucket, e.g. of S3"""
+
+    def __init__(self, backend: StorageBackend, prefix: str) -> None:
+        self.backend = backend
+        self.prefix = prefix.strip('/')
+
+    def _key(self, name: str) -> str:
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def put(self, name: str, data: bytes) -> None:
+        self.backend.upload_bytes(data, key=self._key(name))
+
+    def get(self, name: str) -> bytes:
+        try:
+            return self.backend.download_bytes(self._key(name))
+        except ObjectNotFoundError:
+            raise TFStateChangeError(f'{name} is not in the backup store {self}')
+
+    def list(self, prefix: str) -> List[str]:
+        start = len(self._key(''))
+        return [key[start:] for key in self.backend.list(self._key(prefix))]
+
+    def __str__(self) -> str:
+        return f'{self.backend}/{self.prefix}'
+
+
+class BackupStore:
+    """
+    Snapshots of state files, deduplicated by chunk. Thread-safe: the targets of a fan-out are backed up
+    concurrently. Worker processes sharing a store may store the same chunk twice, never lose one.
+
+    :param location: A local directory or s3://<bucket>/<prefix>
+    """
+
+    def __init__(self, location: str = DEFAULT_DIR) -> None:
+        self.location = location
+        if location.startswith('s3://'):
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            self.objects = _Prefix(S3Backend(bucket), prefix)
+        else:
+            self.objects = _Directory(location)
+        self._lock = threading.Lock()
+        # Where every chunk of the store is: {chunk hash: (pack, offset, length)}, read on first use
+        self._chunks: Optional[Dict[str, Tuple[str, int, int]]] = None
+
+    def _known(self) -> Dict[str, Tuple[str, int, int]]:
+        if self._chunks is None:
+            self._chunks = {}
+            for name in self.objects.list('packs'):
+                if name.endswith('.idx'):
+                    self._read_index(name[len('packs/'):-len('.idx')], self._chunks)
+        return self._chunks
+
+    def _read_index(self, pack: str, chunks: Dict[str, Tuple[str, int, int]]) -> None:
+        for value, (offset, length) in json.loads(self.objects.get(f'packs/{pack}.idx')).items():
+            chunks.setdefault(value, (pack, offset, length))
+
+    def _store_chunks(self, chunks: List[bytes]) -> Tuple[List[str], List[str]]:
+        """
+        Stores the chunks that are not in the store yet as one pack
+
+        :return: The hashes of the chunks and the packs they are in
+        """
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        with self._lock:
+            known = self._known()
+            pack, index, new = bytearray(), {}, {}
+            for value, chunk in zip(hashes, chunks):
+                if value in known or value in index:
+                    continue
+                compressed = zlib.compress(chunk, COMPRESSION_LEVEL)
+                index[value] = [len(pack), len(compressed)]
+                pack += compressed
+            if index:
+                name = chunk_hash(bytes(pack))
+                # The index is written last: a pack is used only once it is complete
+                self.objects.put(f'packs/{name}.pack', bytes(pack))
+                self.objects.put(f'packs/{name}.idx', json.dumps(index).encode())
+                new = {value: (name, offset, length) for value, (offset, length) in index.items()}
+                known.update(new)
+            packs = sorted({known[value][0] for value in hashes})
+        logger.debug('%s chunks, %s new, %s bytes compressed', len(chunks), len(new), len(pack))
+        return hashes, packs
+
+    def snapshot(self, key: str, data: bytes, reason: str, etag: Optional[str] = None) -> str:
+        """
+        Stores a version of a state. Nothing is stored if it is the same as the latest snapshot of the state
+
+        :param key: The state, as <bucket>/<object key>
+        :param reason: Why the snapshot is taken, e.g. "upload" or "deleteByQuery"
+        :return: The id of the snapshot
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        latest = self.snapshots(key)[-1:]
+        if latest and latest[0].endswith(digest[:12]):
+            logger.info('%s is unchanged since the snapshot %s', key, latest[0])
+            return latest[0]
+
+        chunk_hashes, chunk_packs = self._store_chunks(split_chunks(data))
+        blocks = ["\n".join(block).encode() for block in split_blocks(chunk_hashes)]
+        block_hashes, block_packs = self._store_chunks(blocks)
+        snapshot_id = f'{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S%fZ}-{digest[:12]}'
+        manifest = {"key": key, "id": snapshot_id, "reason": reason, "etag": etag, "size": len(data),
+                    "sha256": digest, "packs": sorted(set(chunk_packs) | set(block_packs)), "blocks": block_hashes}
+        self.objects.put(f'snapshots/{key}/{snapshot_id}.json', json.dumps(manifest).encode())
+        logger.info('%s: Snapshot %s of %s bytes (%s) stored in %s', key, snapshot_id, len(data), reason, self.objects)
+        return snapshot_id
+
+    def snapshots(self, key: str) -> List[str]:
+        """The ids of the snapshots of a state, the oldest first"""
+        return [name.rsplit('/', 1)[1][:-len('.json')] for name in self.objects.list(f'snapshots/{key}')
+                if name.endswith('.json')]
+
+    def manifest(self, key: str, snapshot_id: str = "latest") -> Dict[str, Any]:
+        """
+        :param snapshot_id: The id of a snapshot, "latest" for the latest one
+        """
+        if snapshot_id == "latest":
+            ids = self.snapshots(key)
+            if not ids:
+                raise TFStateChangeError(f'There is no snapshot of {key} in the backup store {self.objects}')
+            snapshot_id = ids[-1]
+        return json.loads(self.objects.get(f'snapshots/{key}/{snapshot_id}.json'))
+
+    def restore(self, key: str, snapshot_id: str = "latest") -> bytes:
+        """
+        Rebuilds a snapshot of a state from its chunks, reading every pack it refers to once
+
+        :raises TFStateChangeError: if the snapshot does not exist or the rebuilt state is not the one stored
+        """
+        manifest = self.manifest(key, snapshot_id)
+        chunks: Dict[str, Tuple[str, int, int]] = {}
+        for pack in manifest["packs"]:
+            self._read_index(pack, chunks)
+        packs: Dict[str, bytes] = {}
+
+        def read(value: str) -> bytes:
+            pack, offset, length = chunks[value]
+            if pack not in packs:
+                packs[pack] = self.objects.get(f'packs/{pack}.pack')
+            return zlib.decompress(packs[pack][offset:offset + length])
+
+        try:
+            chunk_hashes = [value for block in manifest["blocks"] for value in read(block).decode().split("\n")]
+            data = b"".join(read(value) for value in chunk_hashes)
+        except KeyError as e:
+            raise TFStateChangeError(f'The snapshot {manifest["id"]} of {key} refers to a missing chunk {e}')
+        if hashlib.sha256(data).hexdigest() != manifest["sha256"]:
+            raise TFStateChangeError(f'The snapshot {manifest["id"]} of {key} does not match its checksum')
+        logger.info('%s: Restored the snapshot %s, %s bytes from %s packs', key, manifest["id"], len(data), len(packs))
+        return data
+
+
+_store: Optional[BackupStore] = BackupStore()
+
+
+def configure(enabled: bool = True, location: str = DEFAULT_DIR) -> None:
+    """Sets up the store the states of the run are backed up to"""
+    global _store
+    _store = BackupStore(location) if enabled else None
+
+
+def settings() -> Dict[str, Any]:
+    """The arguments of configure() the current store was set up with, e.g. to set worker processes up alike"""
+    if _store is None:
+        return {"enabled": False}
+    return {"enabled": True, "location": _store.location}
+
+
+def get_store() -> Optional[BackupStore]:
+    """The backup store of the run, None if backups are disabled"""
+    return _store
@@ -0,0 +1,256 @@
+"""
+Benchmarks of the state operations on synthetic states
+
+    python benchmark.py --sizes 1000,10000 --output results.json
+    python benchmark.py --sizes 1000,10000 --baseline results.json --threshold 0.25
+
+Every case is timed <repeat> times (the fastest run is kept) and run once more under tracemalloc for
+its peak memory. The results are written as JSON; with a baseline, a case slower than the baseline by
+more than the threshold fails the run. The run also fails if the streaming writer does not produce the
+bytes json.dump(indent=2) + inplace_change produce.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Callable, Tuple
+
+import logging
+
+import download_cache
+import main
+import s3_transfer
+from state_generator import NETWORKING, generate_state, write_state
+from state_writer import iter_state
+from tf_state import TerraformState
+
+logger = logging.getLogger(__name__)
+
+SOURCE, TARGET = 'a.tfstate', 'b.tfstate'
+LISTENERS = {"name": "nlb_broker_listeners"}
+
+
+class Workspace:
+    """A directory with a source and a target state of one size, locally or in an S3 stand-in"""
+
+    def __init__(self, root: str, size: int, save_mode: str = "full", lazy: bool = False, s3: bool = False) -> None:
+        self.root = root
+        self.size = size
+        self.save_mode = save_mode
+        self.lazy = lazy
+        self.s3 = s3
+        self.states = {SOURCE: generate_state(resources=size, variant=1), TARGET: generate_state(resources=size, variant=2)}
+        self.reset()
+
+    def state(self, name: str) -> TerraformState:
+        return TerraformState(filename=name, save_mode=self.save_mode, lazy=self.lazy)
+
+    def reset(self) -> None:
+        """Writes the original states again, locally and to the S3 stand-in"""
+        os.chdir(self.root)
+        shutil.rmtree('modified', ignore_errors=True)
+        for name, data in self.states.items():
+            state = self.state(name)
+            os.makedirs(os.path.dirname(state.file), exist_ok=True)
+            write_state(state.file, data)
+            if self.s3:
+                state.backend.upload_file(state.file, key=f'{state.object}/{name}')
+
+    def loaded(self, name: str) -> TerraformState:
+        state = self.state(name)
+        state.load()
+        return state
+
+
+def _load(ws: Workspace) -> Callable[[], Any]:
+    return lambda: ws.loaded(TARGET)
+
+
+def _get_by_query(ws: Workspace) -> Callable[[], Any]:
+    state = ws.loaded(TARGET)
+    queries = [{"name": "nlb", "module": NETWORKING}, LISTENERS, {"type": "aws_iam_role"}, {"name": f'r{ws.size - 1}'}]
+    return lambda: [state.getByQuery(query) for query in queries for _ in range(25)]
+
+
+def _update_by_query(ws: Workspace) -> Callable[[], Any]:
+    source, target = ws.loaded(SOURCE), ws.loaded(TARGET)
+    query = {"name": "nlb", "module": NETWORKING}
+    resource = source.getByQuery(query)[0]
+    return lambda: target.updateByQuery(query, new_resource=resource)
+
+
+def _save(ws: Workspace) -> Callable[[], Any]:
+    state = ws.loaded(TARGET)
+    state.write_tmp_file()
+    return lambda: state.save(dst='modified', rm_tmp=False)
+
+
+def _inplace_change(ws: Workspace) -> Callable[[], Any]:
+    path = os.path.join(ws.root, 'dumped.json')
+    with open(path, 'w') as dumped:
+        json.dump(ws.states[TARGET], dumped, indent=2)
+    return lambda: TerraformState.inplace_change(path)
+
+
+def _replace_instances_attributes(ws: Workspace) -> Callable[[], Any]:
+    source, target = ws.loaded(SOURCE), ws.loaded(TARGET)
+    return lambda: main.replaceResourceInstancesAttributes(source, target, LISTENERS, "default_action", "port")
+
+
+def _swap_kafka_nlb(ws: Workspace) -> Callable[[], Any]:
+    """The whole flow: (download,) load, swap, save (and upload)"""
+
+    def run():
+        source, target = ws.state(SOURCE), ws.state(TARGET)
+        for state in (source, target):
+            if ws.s3:
+                state.download()
+            state.load()
+        main.swapKafkaNLB(source, target)
+        target.save(dst='modified')
+        if ws.s3:
+            target.upload(source='modified')
+
+    return run
+
+
+CASES: List[Tuple[str, Callable[[Workspace], Callable[[], Any]]]] = [
+    ("load", _load),
+    ("getByQuery", _get_by_query),
+    ("updateByQuery", _update_by_query),
+    ("save", _save),
+    ("inplace_change", _inplace_change),
+    ("replaceResourceInstancesAttributes", _replace_instances_attributes),
+    ("swapKafkaNLB", _swap_kafka_nlb),
+]
+
+
+def measure(ws: Workspace, setup: Callable[[Workspace], Callable[[], Any]], repeat: int) -> Dict[str, float]:
+    """Times a case <repeat> times, then measures its peak memory in one more run. Every run is set up anew"""
+    timings = []
+    for _ in range(repeat):
+        ws.reset()
+        run = setup(ws)
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+
+    ws.reset()
+    run = setup(ws)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(timings), "mean": sum(timings) / len(timings), "peak_mb": peak / 1024 / 1024}
+
+
+def writer_identical(state: Dict[str, Any]) -> bool:
+    """Whether the streaming writer produces the bytes of json.dump(indent=2) + inplace_change"""
+    expected = json.dumps(state, indent=2).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+    return "".join(iter_state(state)) == expected
+
+
+def run_suite(sizes: List[int], repeat: int = 3, save_mode: str = "full", lazy: bool = False,
+              s3: bool = False, cases: List[str] = None) -> Dict[str, Any]:
+    """
+    Runs the cases on states of every size
+
+    :param s3: Download and upload the states of the full flow through the configured S3 endpoint
+    :return: The results, as written to the JSON output
+    """
+    results = {"created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "backend": "s3" if s3 else "local", "save_mode": save_mode, "lazy": lazy, "repeat": repeat,
+               "writer_identical": {}, "cases": []}
+    selected = [(name, setup) for name, setup in CASES if not cases or name in cases]
+    cwd = os.getcwd()
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix=f'tf-state-bench-{size}-')
+        try:
+            ws = Workspace(root, size, save_mode=save_mode, lazy=lazy, s3=s3)
+            results["writer_identical"][str(size)] = writer_identical(ws.states[TARGET])
+            for name, setup in selected:
+                measured = measure(ws, setup, repeat)
+                results["cases"].append({"size": size, "case": name, **measured})
+                print(f'{size:>8} {name:<36} {measured["seconds"]:>9.4f}s {measured["peak_mb"]:>9.1f} MB', flush=True)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    :return: The cases slower than the baseline by more than threshold (0.25 = 25%)
+    """
+    before = {(case["size"], case["case"]): case["seconds"] for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = before.get((case["size"], case["case"]))
+        if old and case["seconds"] > old * (1 + threshold):
+            regressions.append(f'{case["size"]} {case["case"]}: {old:.4f}s -> {case["seconds"]:.4f}s '
+                               f'(+{(case["seconds"] / old - 1) * 100:.0f}%)')
+    return regressions
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks the state operations on synthetic states')
+    parser.add_argument('--sizes', help='Comma separated numbers of resources, e.g. 1000,10000,100000',
+                        default='1000,10000')
+    parser.add_argument('--repeat', help='Timed runs per case, the fastest is kept', type=int, default=3)
+    parser.add_argument('--case', help='Case to run, can be repeated. Default: all of ' +
+                                       ', '.join(name for name, _ in CASES), action='append', dest='cases')
+    parser.add_argument('--save-mode', choices=["full", "splice"], default="full", dest="save_mode")
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--s3-endpoint-url', help='S3 stand-in to run the full flow against, e.g. a local moto '
+                                                  'server. The states are uploaded to it', dest='s3_endpoint_url')
+    parser.add_argument('--output', help='Where to write the JSON results', default='benchmark-results.json')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', help='Slowdown relative to the baseline that fails the run', type=float,
+                        default=0.25)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    args = arg_parser()
+    if args.s3_endpoint_url:
+        s3_transfer.configure(endpoint_url=args.s3_endpoint_url)
+        download_cache.configure(enabled=False)
+        for bucket in {TerraformState(filename=SOURCE).s3_bucket}:
+            try:
+                s3_transfer.get_client().create_bucket(Bucket=bucket)
+            except s3_transfer.get_client().exceptions.BucketAlreadyOwnedByYou:
+                pass
+
+    output = os.path.abspath(args.output)
+    suite = run_suite([int(size) for size in args.sizes.split(',')], repeat=args.repeat, save_mode=args.save_mode,
+                      lazy=args.lazy, s3=bool(args.s3_endpoint_url), cases=args.cases)
+    with open(output, 'w') as results_file:
+        json.dump(suite, results_file, indent=2)
+    print(f'The results are written to {output}')
+
+    failed = False
+    for size, identical in suite["writer_identical"].items():
+        if not identical:
+            print(f'{size}: the streaming writer output differs from json.dump + inplace_change')
+            failed = True
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for setting in ("backend", "save_mode", "lazy"):
+            if baseline.get(setting) != suite[setting]:
+                print(f'The baseline was run with {setting}={baseline.get(setting)}, this run with {suite[setting]}')
+        regressions = compare(suite, baseline, args.threshold)
+        for regression in regressions:
+            print(f'Regression {regression}')
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,137 @@
+"""
+Forward and reverse dependency graph of the resources of a Terraform State, from the "dependencies" of the instances
+"""
+import re
+from collections import deque
+from typing import Dict, Any, List, Iterable, Set
+
+import logging
+
+from state_errors import SchemaError
+
+logger = logging.getLogger(__name__)
+
+DIRECTIONS = ("dependencies", "dependents", "both")
+# A module instance key, [0] or ["k"]: a quoted key may contain dots and brackets
+MODULE_KEY = re.compile(r'\[(?:"(?:[^"\\]|\\.)*"|[^\]"]*)\]')
+
+
+def resource_address(resource: Dict[str, Any]) -> str:
+    """
+    The address of a resource in the state, with the instance keys of its modules,
+    e.g. module.aws_networking[0].aws_lb.nlb or module.x.data.aws_ami.ubuntu
+    """
+    parts = [resource["module"]] if resource.get("module") else []
+    if resource.get("mode") == "data":
+        parts.append("data")
+    parts.extend((resource["type"], resource["name"]))
+    return ".".join(parts)
+
+
+def config_address(address: str) -> str:
+    """
+    The address of a resource in the configuration, without module instance keys,
+    e.g. module.aws_networking.aws_lb.nlb for module.aws_networking[0].aws_lb.nlb.
+    Terraform writes the "dependencies" of the instances as configuration addresses
+    """
+    return MODULE_KEY.sub('', address) if '[' in address else address
+
+
+def resource_dependencies(resource: Dict[str, Any]) -> List[str]:
+    """The configuration addresses the instances of a resource depend on, each once, in the order they appear"""
+    return list(dict.fromkeys(config_address(address) for instance in resource.get("instances", ())
+                              for address in instance.get("dependencies", ())))
+
+
+def _headers(resources) -> Iterable[Dict[str, Any]]:
+    """The fields of the resources an address is made of, without decoding a lazy list"""
+    header = getattr(resources, "header", None)
+    if header is None:
+        return resources
+    return (header(position) for position in range(len(resources)))
+
+
+def addresses(resources) -> Set[str]:
+    """The configuration addresses of all the resources of a state, the ones "dependencies" refer to"""
+    return {config_address(resource_address(resource)) for resource in _headers(resources)}
+
+
+class DependencyGraph:
+    """
+    Built once in time linear in the resources and their dependencies. A lazy resources list is read
+    resource by resource without keeping the decoded resources.
+
+    The edges are between configuration addresses: a dependency on module.x.aws_lb.nlb is a dependency on
+    the nlb of every instance of the module x.
+
+    address: the state address of every resource (by position)
+    config: the configuration address of every resource (by position)
+    positions: the positions of the resources of every configuration address
+    forward: the configuration addresses every resource (by position) depends on
+    reverse: the positions of the resources depending on every configuration address
+    """
+
+    def __init__(self, resources) -> None:
+        self.address: List[str] = [resource_address(header) for header in _headers(resources)]
+        self.config: List[str] = [config_address(address) for address in self.address]
+        self.positions: Dict[str, List[int]] = {}
+        self.forward: List[List[str]] = []
+        self.reverse: Dict[str, List[int]] = {}
+        for position, address in enumerate(self.config):
+            self.positions.setdefault(address, []).append(position)
+        for position, resource in enumerate(resources):
+            dependencies = resource_dependencies(resource)
+            self.forward.append(dependencies)
+            for address in dependencies:
+                self.reverse.setdefault(address, []).append(position)
+        logger.debug('Built the dependency graph of %s resources, %s edges',
+                     len(self.forward), sum(len(d) for d in self.forward))
+
+    def __len__(self) -> int:
+        return len(self.forward)
+
+    def dependencies(self, position: int) -> List[int]:
+        """The positions of the resources the resource at the position depends on"""
+        return [p for address in self.forward[position] for p in self.positions.get(address, ())]
+
+    def dependents(self, position: int) -> List[int]:
+        """The positions of the resources depending on the resource at the position"""
+        return list(self.reverse.get(self.config[position], ()))
+
+    def closure(self, positions: Iterable[int], direction: str = "dependents") -> List[int]:
+        """
+        The transitive closure of resources: all the resources reachable from the given ones, them included.
+        Runs in time linear in the edges it follows.
+
+        :param direction: "dependencies" (what the resources need), "dependents" (what needs them) or "both"
+        :return: The positions, in the state order
+        """
+        if direction not in DIRECTIONS:
+            raise SchemaError(f'closure direction: {direction}', f'expected one of: {",".join(DIRECTIONS)}')
+        seen = set(positions)
+        queue = deque(seen)
+        while queue:
+            position = queue.popleft()
+            neighbours = []
+            if direction in ("dependencies", "both"):
+                neighbours.extend(self.dependencies(position))
+            if direction in ("dependents", "both"):
+                neighbours.extend(self.dependents(position))
+            for neighbour in neighbours:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+        return sorted(seen)
+
+    def dangling(self) -> Dict[str, List[str]]:
+        """
+        The dependencies on resources that are not in the state
+
+        :return: {address of the resource: [configuration addresses it depends on that do not exist]}
+        """
+        found = {}
+        for position, dependencies in enumerate(self.forward):
+            missing = [address for address in dependencies if address not in self.positions]
+            if missing:
+                found.setdefault(self.address[position], []).extend(missing)
+        return found
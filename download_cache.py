@@ -0,0 +1,131 @@
+"""
+Local cache of the downloaded Terraform States, keyed by bucket, key and ETag or version id
+"""
+import hashlib
+import os
+import shutil
+import time
+from typing import Optional, List, Tuple, Dict, Any
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tf-state-change')
+
+
+class DownloadCache:
+    """
+    Content cache of S3 objects. An entry is only ever looked up by the ETag (or version id) the object has
+    right now in S3, so a changed object is never served from the cache; it is downloaded and cached anew.
+
+    Entries not used for max_age seconds are evicted, then the least recently used ones until the cache
+    fits in max_bytes.
+    """
+
+    def __init__(self, root: str = DEFAULT_DIR, max_bytes: int = 1024 * MB, max_age: float = 24 * 3600) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def path(self, bucket: str, key: str, etag: str, version_id: Optional[str] = None) -> str:
+        """The cache file of an object version"""
+        object_dir = hashlib.sha256(f'{bucket}/{key}'.encode()).hexdigest()[:32]
+        entry = hashlib.sha256(f'{etag}:{version_id or ""}'.encode()).hexdigest()[:32]
+        return os.path.join(self.root, object_dir, entry)
+
+    def lookup(self, bucket: str, key: str, etag: str, version_id: Optional[str] = None) -> Optional[str]:
+        """
+        :return: The path of the cached copy of the object version, None if it is not cached or too old
+        """
+        path = self.path(bucket, key, etag, version_id)
+        try:
+            used = os.path.getmtime(path)
+        except OSError:
+            return None
+        if time.time() - used > self.max_age:
+            logger.info('%s: The cached copy is older than %ss, it is not used', key, self.max_age)
+            self._remove(path)
+            return None
+        os.utime(path)  # the mtime is the last use, for the LRU eviction
+        return path
+
+    def store(self, bucket: str, key: str, etag: str, version_id: Optional[str], filename: str) -> str:
+        """Copies a downloaded object version into the cache"""
+        path = self.path(bucket, key, etag, version_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for object_dir in os.scandir(self.root):
+            if not object_dir.is_dir():
+                continue
+            for entry in os.scandir(object_dir.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self) -> int:
+        """
+        Removes the entries older than max_age, then the least recently used ones above max_bytes
+
+        :return: The number of removed entries
+        """
+        now = time.time()
+        entries = sorted(self._entries())
+        removed, kept, size = 0, [], 0
+        for used, entry_size, path in entries:
+            if now - used > self.max_age:
+                self._remove(path)
+                removed += 1
+            else:
+                kept.append((used, entry_size, path))
+                size += entry_size
+        for used, entry_size, path in kept:
+            if size <= self.max_bytes:
+                break
+            self._remove(path)
+            size -= entry_size
+            removed += 1
+        if removed:
+            logger.info('Evicted %s cached states', removed)
+        return removed
+
+
+_cache: Optional[DownloadCache] = DownloadCache()
+
+
+def configure(enabled: bool = True, root: str = DEFAULT_DIR, max_bytes: int = 1024 * MB,
+              max_age: float = 24 * 3600) -> None:
+    """Sets up the cache the states of the run are downloaded through"""
+    global _cache
+    _cache = DownloadCache(root=root, max_bytes=max_bytes, max_age=max_age) if enabled else None
+
+
+def settings() -> Dict[str, Any]:
+    """The arguments of configure() the current cache was set up with, e.g. to set worker processes up alike"""
+    if _cache is None:
+        return {"enabled": False}
+    return {"enabled": True, "root": _cache.root, "max_bytes": _cache.max_bytes, "max_age": _cache.max_age}
+
+
+def get_cache() -> Optional[DownloadCache]:
+    """The download cache of the run, None if it is disabled"""
+    return _cache
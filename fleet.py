@@ -0,0 +1,286 @@
+"""
+Runs the swap of many state pairs, each pair in its own worker process
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple, NamedTuple, Optional
+
+import logging
+
+import backup_store
+import download_cache
+import metrics
+import s3_transfer
+import storage
+from state_errors import SchemaError, TFStateChangeError
+from swap_plan import SwapPlan, Snapshot, apply, run_plans, snapshot
+from tf_state import TerraformState
+
+logger = logging.getLogger(__name__)
+
+JOB_FIELDS = ("states", "env", "plans", "dry_run", "save_mode", "lazy", "in_memory")
+
+
+class PairJob(NamedTuple):
+    """One source/target pair of states and how to swap them"""
+    states: Tuple[str, str]
+    env: str
+    plans: Tuple[str, ...] = ("kafka",)
+    dry_run: bool = False
+    save_mode: str = "full"
+    lazy: bool = False
+    in_memory: bool = False
+
+    @property
+    def name(self) -> str:
+        return f'{self.states[0]} -> {self.states[1]} ({self.env}: {"+".join(self.plans)})'
+
+
+class PairResult(NamedTuple):
+    job: PairJob
+    ok: bool
+    timings: Dict[str, float]
+    error: Optional[str] = None
+    metrics: Optional[Dict[str, Dict[str, float]]] = None
+
+
+def download_states(states, env, **kwargs):
+    """
+    Downloads the states concurrently through the shared S3 client
+
+    :param kwargs: Passed to every TerraformState, e.g. lazy=True
+    :return: The downloaded states, in the given order
+    :rtype: List[TerraformState]
+    """
+    states = [TerraformState(filename=name, env=env, **kwargs) for name in states]
+    with ThreadPoolExecutor(max_workers=min(len(states), s3_transfer.max_workers())) as executor:
+        list(executor.map(lambda state: state.download(), states))
+    return states
+
+
+class _Phases:
+    """Adds the seconds elapsed since the previous phase to the timings of a phase"""
+
+    def __init__(self, timings: Dict[str, float]) -> None:
+        self.timings = timings
+        self.started = time.perf_counter()
+
+    def __call__(self, name: str) -> None:
+        now = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + now - self.started
+        self.started = now
+
+
+def _save_and_upload(job: PairJob, target, phase: _Phases) -> None:
+    """Apply the updated target state"""
+    if job.dry_run or not job.in_memory:
+        target.save(dst="modified")
+        phase("save")
+    if not job.dry_run:
+        target.upload(source="modified")
+        phase("upload")
+
+
+def run_pair(job: PairJob, timings: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """
+    Downloads, swaps and saves/uploads one pair of states
+
+    :param timings: Filled with the seconds spent per phase as they complete
+    :return: The seconds spent per phase: download, load, swap, save, upload
+    """
+    timings = {} if timings is None else timings
+    phase = _Phases(timings)
+    plans = [SwapPlan.load(name) for name in job.plans]
+    # The downloaded objects are kept: their ETags guard the upload against changes made in the meantime
+    state_a, state_b = download_states(states=job.states, env=job.env, save_mode=job.save_mode, lazy=job.lazy,
+                                       in_memory=job.in_memory)
+    phase("download")
+
+    state_a.load()
+    logger.info('The state_a is loaded.')
+    logger.info('The state_a resources len: %s.', len(state_a.dict['resources']))
+    state_b.load()
+    logger.info('The state_b is loaded.')
+    logger.info('The state_b resources len: %s.', len(state_b.dict['resources']))
+    phase("load")
+
+    # Every plan of a direction is applied in one read pass over the source and one update of the target
+    targets = run_plans(plans, state_a, state_b)
+    phase("swap")
+    for target in targets:
+        _save_and_upload(job, target, phase)
+    return timings
+
+
+def _run_isolated(job: PairJob, run, *args) -> PairResult:
+    """Runs a pair; whatever happens to it is reported in its result instead of stopping the others"""
+    timings = {}
+    started = time.perf_counter()
+    try:
+        run(job, *args, timings)
+        ok, error = True, None
+    except (Exception, SystemExit) as e:
+        logger.exception('%s: failed', job.name) if isinstance(e, Exception) else logger.error('%s: exited', job.name)
+        ok, error = False, f'{type(e).__name__}: {e}'
+    timings["total"] = time.perf_counter() - started
+    return PairResult(job=job, ok=ok, timings=timings, error=error)
+
+
+def _run_pair_isolated(job: PairJob) -> PairResult:
+    """Runs a pair in a worker process and returns the spans it recorded along with its result"""
+    metrics.get_recorder().reset()
+    result = _run_isolated(job, run_pair)
+    return result._replace(metrics=metrics.get_recorder().report())
+
+
+def _init_worker(storage_settings: Dict[str, Any], transfer_settings: Dict[str, Any],
+                 cache_settings: Dict[str, Any], backup_settings: Dict[str, Any]) -> None:
+    """
+    Every worker process sets its storage, S3 client, download cache and backup store up once
+    and reuses them for all its pairs
+    """
+    storage.configure(**storage_settings)
+    s3_transfer.configure(**transfer_settings)
+    download_cache.configure(**cache_settings)
+    backup_store.configure(**backup_settings)
+
+
+def run_fleet(jobs: List[PairJob], workers: int = 4) -> List[PairResult]:
+    """
+    Runs the pairs on a bounded process pool. While a worker waits on S3 the others parse and swap,
+    and a failing pair does not affect the others.
+
+    :return: The results in the order of the jobs
+    """
+    settings = (storage.settings(), s3_transfer.settings(), download_cache.settings(), backup_store.settings())
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs))), initializer=_init_worker,
+                             initargs=settings) as executor:
+        results = list(executor.map(_run_pair_isolated, jobs))
+    for result in results:
+        metrics.get_recorder().merge(result.metrics or {})
+    return results
+
+
+def apply_snapshot(job: PairJob, source: Snapshot, timings: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """
+    Downloads the target state of a pair and applies the resources extracted from its source
+
+    :return: The seconds spent per phase: download, load, swap, save, upload
+    """
+    timings = {} if timings is None else timings
+    phase = _Phases(timings)
+    target = TerraformState(filename=job.states[1], env=job.env, save_mode=job.save_mode, lazy=job.lazy,
+                            in_memory=job.in_memory)
+    target.download()
+    phase("download")
+    target.load()
+    logger.info('The target %s is loaded, resources len: %s.', target.name, len(target.dict['resources']))
+    phase("load")
+    # The keep rules of the plan join the snapshot instances with the ones of this target
+    apply(source.plan, source.entries, target)
+    phase("swap")
+    _save_and_upload(job, target, phase)
+    return timings
+
+
+def run_fan_out(jobs: List[PairJob], workers: int = 4) -> List[PairResult]:
+    """
+    Copies the resources of one source state to many target states: the source is downloaded, parsed and
+    queried once, then its snapshot is applied to the targets concurrently. A failing target does not
+    affect the others.
+
+    :param jobs: Pairs sharing their source state and env, one per target
+    :return: The results in the order of the jobs
+    :raises TFStateChangeError: if the pairs do not share their source, or can not run concurrently (see check_pairs)
+    """
+    sources = {(job.states[0], job.env) for job in jobs}
+    if len(sources) != 1:
+        raise TFStateChangeError(f'The pairs of a fan-out must share their source state and env: {sorted(sources)}')
+    (source_name, env), = sources
+    check_pairs(jobs, f'fan-out of {source_name}')
+    started = time.perf_counter()
+    source = TerraformState(filename=source_name, env=env, lazy=jobs[0].lazy, in_memory=jobs[0].in_memory)
+    source.download()
+    source.load()
+    logger.info('The source %s is loaded, resources len: %s.', source.name, len(source.dict['resources']))
+    # One snapshot per distinct set of plans, usually there is only one
+    snapshots = {plans: snapshot([SwapPlan.load(name) for name in plans], source)
+                 for plans in dict.fromkeys(job.plans for job in jobs)}
+    logger.info('The source %s is extracted in %.2fs', source.name, time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+        return list(executor.map(lambda job: _run_isolated(job, apply_snapshot, snapshots[job.plans]), jobs))
+
+
+def load_manifest(path: str, defaults: Optional[Dict[str, Any]] = None) -> List[PairJob]:
+    """
+    Reads the pairs to process from a JSON or YAML manifest, either a list of pairs or
+    {"defaults": {...}, "pairs": [...]}. A pair is e.g.
+    {"states": ["source.tfstate", "target.tfstate"], "env": "nonprod", "plans": ["kafka", "prometheus"]}
+    Fields a pair does not set are taken from the manifest defaults, then from the given defaults.
+
+    :raises SchemaError: if a pair is not valid
+    :raises TFStateChangeError: if the pairs can not run concurrently, see check_pairs
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise TFStateChangeError(f'PyYAML is required to read the manifest {path}: pip install pyyaml')
+            data = yaml.safe_load(file)
+        else:
+            data = json.load(file)
+
+    pairs = data.get("pairs", []) if isinstance(data, dict) else data
+    base = {**(defaults or {}), **(data.get("defaults", {}) if isinstance(data, dict) else {})}
+    jobs = []
+    for number, pair in enumerate(pairs, start=1):
+        fields = {**base, **pair}
+        unknown = set(pair) - set(JOB_FIELDS)
+        if unknown or len(fields.get("states", ())) != 2 or not fields.get("env"):
+            raise SchemaError(f'{path} pair #{number} keys: ' + ",".join(sorted(pair)),
+                              'expected: states (2), env[,' + ",".join(JOB_FIELDS[2:]) + ']')
+        fields["states"] = tuple(fields["states"])
+        fields["plans"] = tuple(fields.get("plans", PairJob._field_defaults["plans"]))
+        jobs.append(PairJob(**{field: fields[field] for field in JOB_FIELDS if field in fields}))
+    check_pairs(jobs, path)
+    return jobs
+
+
+def check_pairs(jobs: List[PairJob], origin: str) -> None:
+    """
+    Refuses pairs that can not run concurrently: two pairs changing the same target state, or a pair changing
+    the source of another (or its own), which would be read while it is changed
+
+    :param origin: Where the pairs come from, for the error message, e.g. the manifest path
+    :raises TFStateChangeError:
+    """
+    targets, sources = {}, {}
+    for number, job in enumerate(jobs, start=1):
+        source, target = (job.env, job.states[0]), (job.env, job.states[1])
+        if target in targets:
+            raise TFStateChangeError(f'{origin}: the pairs #{targets[target]} and #{number} both change '
+                                     f'{job.states[1]}')
+        targets[target] = number
+        sources.setdefault(source, number)
+        if target in sources:
+            raise TFStateChangeError(f'{origin}: the pair #{number} changes {job.states[1]}, '
+                                     f'the source of the pair #{sources[target]}')
+        if source in targets:
+            raise TFStateChangeError(f'{origin}: the pair #{targets[source]} changes {job.states[0]}, '
+                                     f'the source of the pair #{number}')
+
+
+def format_summary(results: List[PairResult]) -> str:
+    """A table of the pairs with their status and the seconds spent per phase"""
+    phases = ["download", "load", "swap", "save", "upload", "total"]
+    rows = [["pair", "status"] + phases + ["error"]]
+    for result in results:
+        rows.append([result.job.name, "ok" if result.ok else "FAILED"] +
+                    [f'{result.timings[p]:.2f}' if p in result.timings else "-" for p in phases] +
+                    [result.error or ""])
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    return os.linesep.join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
@@ -0,0 +1,119 @@
+"""
+Keyed join of the instances of the same resource in two Terraform States
+"""
+import json
+from typing import Dict, Any, List, Tuple, Union, Sequence, Hashable
+
+import logging
+
+from state_errors import TFStateChangeError
+
+logger = logging.getLogger(__name__)
+
+Keys = Union[str, Sequence[str]]
+
+
+def _as_tuple(value: Keys) -> Tuple[str, ...]:
+    return (value,) if isinstance(value, str) else tuple(value)
+
+
+def _hashable(value) -> Hashable:
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return json.dumps(value, sort_keys=True)
+
+
+def instance_key(instance: Dict[str, Any], keys: Tuple[str, ...]) -> Tuple:
+    """
+    The join key of an instance. Every key is looked up in the instance attributes first, then in the
+    instance itself, so both "port" and "index_key" work.
+
+    :raises KeyError: if the instance has no such key
+    """
+    attributes = instance.get("attributes", {})
+    key = []
+    for name in keys:
+        if name in attributes:
+            key.append(_hashable(attributes[name]))
+        elif name in instance:
+            key.append(_hashable(instance[name]))
+        else:
+            raise KeyError(f'The instance {instance.get("index_key")} has no "{name}" to be matched by')
+    return tuple(key)
+
+
+def _by_key(instances: List[Dict[str, Any]], keys: Tuple[str, ...]) -> Tuple[Dict[Tuple, Dict[str, Any]], List[Tuple]]:
+    table, duplicates = {}, []
+    for instance in instances:
+        key = instance_key(instance, keys)
+        if key in table:
+            duplicates.append(key)
+        table[key] = instance
+    return table, duplicates
+
+
+class JoinResult:
+    """
+    instances: All the instances of the left side, the matched ones with the attributes of the right side
+    matched: The keys found on both sides
+    unmatched_left / unmatched_right: The keys found on one side only
+    """
+
+    def __init__(self, instances, matched, unmatched_left, unmatched_right) -> None:
+        self.instances = instances
+        self.matched = matched
+        self.unmatched_left = unmatched_left
+        self.unmatched_right = unmatched_right
+
+
+def join_instances(left: List[Dict[str, Any]],
+                   right: List[Dict[str, Any]],
+                   attributes: Keys,
+                   match_by: Keys = "index_key") -> JoinResult:
+    """
+    Copies attributes from the right instances to the left instances with the same key, in linear time.
+    The left instances are not changed: the updated ones are shallow copies with new "attributes" dicts.
+
+    :param left: The instances to update
+    :param right: The instances to take the attribute values from
+    :param attributes: (str or list) The attribute names to copy, e.g. ["default_action", "certificate_arn"]
+    :param match_by: (str or tuple) The key to match the instances by, e.g. "port" or ("port", "protocol")
+    :raises TFStateChangeError: if a key is not unique on either side, the match would be ambiguous
+    :rtype: JoinResult
+    """
+    keys, attributes = _as_tuple(match_by), _as_tuple(attributes)
+    right_by_key, right_duplicates = _by_key(right, keys)
+    left_keys = [instance_key(instance, keys) for instance in left]
+    seen, left_duplicates = set(), []
+    for key in left_keys:
+        if key in seen:
+            left_duplicates.append(key)
+        seen.add(key)
+    if left_duplicates or right_duplicates:
+        raise TFStateChangeError(f'The instances can not be matched by {keys}, duplicated keys: '
+                                 f'{left_duplicates} in the first state, {right_duplicates} in the second')
+
+    instances, matched, unmatched_left = [], [], []
+    for instance, key in zip(left, left_keys):
+        source = right_by_key.get(key)
+        if source is None:
+            unmatched_left.append(key)
+            instances.append(instance)
+            continue
+        matched.append(key)
+        source_attributes = source["attributes"]
+        updated = dict(instance["attributes"])
+        for name in attributes:
+            updated[name] = source_attributes.get(name)
+        instances.append({**instance, "attributes": updated})
+
+    matched_keys = set(matched)
+    unmatched_right = [key for key in right_by_key if key not in matched_keys]
+    if unmatched_left:
+        logger.warning('No match by %s for the instances %s, their %s are kept', keys, unmatched_left, attributes)
+    if unmatched_right:
+        logger.warning('The instances %s matched by %s exist in the second state only', unmatched_right, keys)
+    return JoinResult(instances=instances, matched=matched, unmatched_left=unmatched_left,
+                      unmatched_right=unmatched_right)
@@ -0,0 +1,126 @@
+"""
+Resources of a memory-mapped Terraform State, decoded on demand
+"""
+import json
+import mmap
+import sys
+from collections.abc import MutableSequence
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+
+from state_scanner import ResourceLayout
+
+HEADER_FIELDS = ("module", "mode", "type", "name", "provider")
+# Terraform writes the other keys of a resource before "instances", one per line, indented by 6 spaces
+INSTANCES_LINE = b'\n      "instances": '
+
+
+def read_header(buf, start: int, end: int) -> Tuple[Optional[str], ...]:
+    """
+    Reads the module, mode, type, name and provider of the resource at buf[start:end] without decoding
+    its instances. The values shared by many resources are interned, so they are kept once
+
+    :return: The values of HEADER_FIELDS, None for the missing ones
+    """
+    instances = buf.find(INSTANCES_LINE, start, end)
+    fields = json.loads(buf[start:instances].rstrip(b',') + b'}' if instances >= 0 else buf[start:end])
+    module, mode, resource_type, name, provider = (fields.get(field) for field in HEADER_FIELDS)
+    return (module if module is None else sys.intern(module), mode if mode is None else sys.intern(mode),
+            resource_type if resource_type is None else sys.intern(resource_type), name,
+            provider if provider is None else sys.intern(provider))
+
+
+def open_mapped(path: str) -> mmap.mmap:
+    """Maps the state file read-only"""
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LazyResourceList(MutableSequence):
+    """
+    The "resources" list of a state backed by the mapped file.
+
+    Only the headers of the resources are read up front (see read_header), which is all the ResourceIndex
+    needs. A resource is decoded the first time it is accessed by position and is kept from then on.
+    Iterating the list, as the writers do, decodes the resources one at a time without keeping them.
+    A resource that has not been decoded is the number of its span in the list.
+    """
+
+    def __init__(self, buf, layout: ResourceLayout) -> None:
+        self.buf = buf
+        self.layout = layout
+        self._headers = [read_header(buf, start, end) for start, end in layout.spans]
+        self._items: List[Any] = list(range(len(layout.spans)))
+        # Decoded resources by id -> their span, kept referenced so the ids stay unique
+        self._decoded: Dict[int, int] = {}
+        self._keep: List[Dict[str, Any]] = []
+
+    def _decode(self, span: int) -> Dict[str, Any]:
+        start, end = self.layout.spans[span]
+        return json.loads(self.buf[start:end])
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self._items)))]
+        item = self._items[position]
+        if isinstance(item, int):
+            resource = self._decode(item)
+            self._items[position] = resource
+            self._decoded[id(resource)] = item
+            self._keep.append(resource)
+            return resource
+        return item
+
+    def __setitem__(self, position, value) -> None:
+        if isinstance(position, slice):
+            if isinstance(value, LazyResourceList) and value.buf is self.buf:
+                self._items[position] = value._items
+            else:
+                self._items[position] = list(value)
+            return
+        self._items[position] = value
+
+    def __delitem__(self, position) -> None:
+        del self._items[position]
+
+    def insert(self, position: int, value: Dict[str, Any]) -> None:
+        self._items.insert(position, value)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for item in self._items:
+            yield self._decode(item) if isinstance(item, int) else item
+
+    def copy(self) -> 'LazyResourceList':
+        """A shallow copy that shares the mapped file and the decoded resources"""
+        other = LazyResourceList.__new__(LazyResourceList)
+        other.buf, other.layout, other._headers = self.buf, self.layout, self._headers
+        other._items, other._decoded, other._keep = list(self._items), self._decoded, self._keep
+        return other
+
+    def header(self, position: int) -> Dict[str, Any]:
+        """The fields the ResourceIndex is keyed by, read without decoding the resource"""
+        item = self._items[position]
+        if not isinstance(item, int):
+            return item
+        return {field: value for field, value in zip(HEADER_FIELDS, self._headers[item]) if value is not None}
+
+    def origin(self, position: int) -> Optional[int]:
+        """The span of the resource in the mapped file if it is unchanged, None if it was replaced or added"""
+        item = self._items[position]
+        if isinstance(item, int):
+            return item
+        return self._decoded.get(id(item))
+
+    def forget(self, resource: Dict[str, Any]) -> None:
+        """
+        The resource no longer has the content of its span, e.g. it was decoded, edited in place and put back.
+        It stays referenced so the ids of the decoded resources stay unique
+        """
+        self._decoded.pop(id(resource), None)
+
+    @property
+    def decoded(self) -> int:
+        """How many resources have been decoded so far"""
+        return len(self._decoded)
@@ -3,27 +3,166 @@ Main TFStateResourceSwapper script.
 """
 import sys
 import argparse
-
+import contextlib
+
+import logging
+
+import backup_store
+import download_cache
+import metrics
+import s3_transfer
+import storage
+from dependency_graph import resource_address
+from fleet import PairJob, check_pairs, download_states, format_summary, load_manifest, run_fan_out, run_fleet, \
+    run_pair
+from instance_join import join_instances
+from selector import compile_selector
+import state_server
+from state_server import MB, StateCache, StateService, serve
+from swap_plan import SwapPlan, builtin_plans, run_plans
 from tf_state import TerraformState
 
+logger = logging.getLogger(__name__)
+
 
 def arg_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--states', nargs=2, help='List of state files to work with', required=True)
-    parser.add_argument('--env', nargs=1, help='nonprod or prod', required=True)
+    parser.add_argument('--states', nargs='+', help='List of state files to work with: the source and the target. '
+                                                   'With --select, any number of states to inspect',
+                        required=False)
+    parser.add_argument('--env', nargs=1, help='nonprod or prod. With --manifest, the default env of the pairs',
+                        required=False)
+    parser.add_argument('--manifest', help='JSON/YAML file listing the state pairs to process in parallel, '
+                                           'instead of --states', required=False, dest="manifest")
+    parser.add_argument('--fan-out', nargs='+', metavar='STATE', help='A source state and the target states to copy its '
+                                                                      'resources to. The source is parsed once',
+                        required=False, dest="fan_out")
+    parser.add_argument('--select', help='Print the resources and instances of the --states matching a selector '
+                                         'expression instead of swapping, e.g. '
+                                         '"**.aws_lb_listener.* where attributes.port in (9092, 9093)"',
+                        required=False, dest="select")
+    parser.add_argument('--rollback', help='Restore the --states to a snapshot of the backup store and upload them: '
+                                           'a snapshot id or "latest", the version the last upload replaced. '
+                                           'With --dry-run the restored states are only saved to "modified"',
+                        required=False, metavar='SNAPSHOT', dest="rollback")
+    parser.add_argument('--list-backups', help='List the snapshots of the --states in the backup store',
+                        required=False, action="store_true", dest="list_backups")
+    parser.add_argument('--serve', help='Keep the parsed states in memory and serve query, swap, diff and save '
+                                         'requests on a Unix socket (--socket) or a localhost port (--port), '
+                                         'see state_server.py',
+                        required=False, action="store_true", dest="serve")
+    parser.add_argument('--socket', help='The Unix socket of --serve, only its owner can connect to it. Default: '
+                                         + state_server.DEFAULT_SOCKET,
+                        required=False, default=state_server.DEFAULT_SOCKET, dest="socket")
+    parser.add_argument('--port', help='Serve on this localhost port instead of the Unix socket. Every request has to '
+                                       'send the token written to --token-file',
+                        required=False, type=int, dest="port")
+    parser.add_argument('--token-file', help='Where --serve --port writes its token, readable by its owner only. '
+                                             'Default: ' + state_server.DEFAULT_TOKEN_FILE,
+                        required=False, default=state_server.DEFAULT_TOKEN_FILE, dest="token_file")
+    parser.add_argument('--output-dir', help='The directory --serve saves the states under, the "dst" of a request '
+                                             'is a directory in it',
+                        required=False, default='modified', dest="output_dir")
+    parser.add_argument('--plans-dir', help='A directory of plan files the --serve requests may name, besides the '
+                                            'built-in plans',
+                        required=False, dest="plans_dir")
+    parser.add_argument('--cache-memory', help='Size in MB of the parsed states --serve keeps in memory, estimated',
+                        required=False, type=int, default=2048, dest="cache_memory")
+    parser.add_argument('--workers', help='Number of state pairs of the manifest or targets of the fan-out processed '
+                                          'at the same time',
+                        required=False, type=int, default=4, dest="workers")
     parser.add_argument('--dry-run', help='Run without uploading state back to S3. The changes will be saved to a new '
                                           '"modified" directory',
                         required=False, action="store_true", dest="dry_run")
     parser.add_argument('--prometheus', help='Set this parameter if prometheus ingress enabled in target clusters',
                         required=False, action="store_true", dest="prom_ingress_enabled")
+    parser.add_argument('--plan', help='Swap plan to apply: a built-in plan name (' + ', '.join(builtin_plans()) +
+                                       ') or a JSON/YAML plan file. Can be repeated. Default: kafka',
+                        required=False, action="append", dest="plans")
+    parser.add_argument('--save-mode', help='"full" re-serializes the whole target state, "splice" rewrites only the '
+                                            'changed resources and keeps the other bytes as downloaded',
+                        required=False, choices=["full", "splice"], default="full", dest="save_mode")
+    parser.add_argument('--lazy', help='Memory-map the states and decode only the resources the swap touches. '
+                                       'The target state is saved by splicing',
+                        required=False, action="store_true", dest="lazy")
+    parser.add_argument('--in-memory', help='Download, edit and upload the target state in memory without writing '
+                                            'files. With --dry-run the result is still saved to "modified"',
+                        required=False, action="store_true", dest="in_memory")
+    parser.add_argument('--storage', help='Where the states are: "s3", or "local" to work offline on files under '
+                                          '--storage-dir/<bucket>/<prefix>',
+                        required=False, choices=["s3", "local"], default="s3", dest="storage")
+    parser.add_argument('--storage-dir', help='The directory of the buckets of the local storage',
+                        required=False, default=storage.DEFAULT_ROOT, dest="storage_dir")
+    parser.add_argument('--bucket', help='The bucket of the states, instead of the one of the --env',
+                        required=False, dest="bucket")
+    parser.add_argument('--prefix', help='The key prefix of the states, instead of the one of the --env',
+                        required=False, dest="prefix")
+    parser.add_argument('--s3-endpoint-url', help='S3 compatible endpoint to use instead of AWS, e.g. a local stand-in',
+                        required=False, dest="s3_endpoint_url")
+    parser.add_argument('--multipart-threshold', help='Size in MB from which the states are transferred in parts',
+                        required=False, type=int, default=8, dest="multipart_threshold")
+    parser.add_argument('--multipart-chunksize', help='Size in MB of the transferred parts',
+                        required=False, type=int, default=8, dest="multipart_chunksize")
+    parser.add_argument('--max-concurrency', help='Number of threads transferring the parts of one state',
+                        required=False, type=int, default=10, dest="max_concurrency")
+    parser.add_argument('--no-cache', help='Always download the states instead of reusing the unchanged cached copies',
+                        required=False, action="store_false", dest="cache_enabled")
+    parser.add_argument('--cache-dir', help='Where the downloaded states are cached',
+                        required=False, default=download_cache.DEFAULT_DIR, dest="cache_dir")
+    parser.add_argument('--cache-max-size', help='Size in MB above which the least recently used states are evicted',
+                        required=False, type=int, default=1024, dest="cache_max_size")
+    parser.add_argument('--cache-max-age', help='Hours after which an unused cached state is evicted',
+                        required=False, type=float, default=24, dest="cache_max_age")
+    parser.add_argument('--backup-dir', help='Where the versions of the states are backed up before they are changed: '
+                                             'a local directory or s3://<bucket>/<prefix>',
+                        required=False, default=backup_store.DEFAULT_DIR, dest="backup_dir")
+    parser.add_argument('--no-backup', help='Do not back the states up before changing them',
+                        required=False, action="store_false", dest="backup_enabled")
+    parser.add_argument('--metrics-file', help='Where to write the JSON summary of the phases of the run',
+                        required=False, dest="metrics_file")
+    parser.add_argument('--metrics-prom', help='Where to write the phases of the run in the Prometheus textfile format, '
+                                               'e.g. for the node_exporter textfile collector',
+                        required=False, dest="metrics_prom")
+    parser.add_argument('--profile', help='Capture a cProfile and a tracemalloc snapshot of the run into a directory. '
+                                          'Default: profile',
+                        required=False, nargs='?', const='profile', dest="profile")
     args = parser.parse_args()
-    return args.states, args.env[0], args.dry_run, args.prom_ingress_enabled
-
-
-def download_states(states, env):
-    for name in states:
-        state = TerraformState(filename=name, env=env)
-        state.download()
+    if sum(bool(option) for option in (args.states, args.manifest, args.fan_out, args.serve)) != 1:
+        parser.error('one of --states, --manifest, --fan-out or --serve is required')
+    if not args.manifest and not args.serve and not args.env and not (args.bucket and args.prefix):
+        parser.error('--env is required unless a --manifest or a --bucket and a --prefix are given')
+    inspect_only = args.select or args.rollback or args.list_backups
+    if sum(bool(option) for option in (args.select, args.rollback, args.list_backups)) > 1:
+        parser.error('--select, --rollback and --list-backups can not be combined')
+    if inspect_only and not args.states:
+        parser.error('--select, --rollback and --list-backups work on the --states')
+    if args.states and not inspect_only and len(args.states) != 2:
+        parser.error('--states takes a source state and a target state')
+    if args.fan_out and len(args.fan_out) < 2:
+        parser.error('--fan-out takes a source state and at least one target state')
+    download_cache.configure(enabled=args.cache_enabled, root=args.cache_dir,
+                             max_bytes=args.cache_max_size * download_cache.MB, max_age=args.cache_max_age * 3600)
+    storage.configure(backend=args.storage, root=args.storage_dir, bucket=args.bucket, prefix=args.prefix)
+    backup_store.configure(enabled=args.backup_enabled, location=args.backup_dir)
+    s3_transfer.configure(endpoint_url=args.s3_endpoint_url,
+                          multipart_threshold=args.multipart_threshold * s3_transfer.MB,
+                          multipart_chunksize=args.multipart_chunksize * s3_transfer.MB,
+                          max_concurrency=args.max_concurrency)
+    plans = args.plans or ["kafka"]
+    if args.prom_ingress_enabled and "prometheus" not in plans:
+        plans.append("prometheus")
+    # The command line options are the defaults of the manifest pairs
+    defaults = {"plans": plans, "dry_run": args.dry_run, "save_mode": args.save_mode, "lazy": args.lazy,
+                "in_memory": args.in_memory, "env": args.env[0] if args.env else None}
+    if args.serve:
+        return [], args
+    if args.manifest:
+        return load_manifest(args.manifest, defaults=defaults), args
+    pairs = [(args.fan_out[0], target) for target in args.fan_out[1:]] if args.fan_out else [tuple(args.states)]
+    jobs = [PairJob(states=pair, **{**defaults, "plans": tuple(plans)}) for pair in pairs]
+    if args.fan_out:
+        check_pairs(jobs, '--fan-out')
+    return jobs, args
 
 
 def replaceResourceInstancesAttributes(state_a,
@@ -35,109 +174,37 @@ def replaceResourceInstancesAttributes(state_a,
     Extracts attribute <attribute_name> from state_b
     Applies this attribute to instances of state_a resource
 
+    The instances are matched with a keyed join in linear time. Unmatched instances keep their attributes
+    and are reported; duplicated keys make the match ambiguous and raise TFStateChangeError.
+    The instances of state_a are not changed, the updated ones are copies.
+
     :param state_a:
     :param state_b:
     :param resource_filter: (dict) The query on which the resource to select, e.g. {"name": "nlb_broker_listeners"}
-    :param attribute_name: (str) The attribute name to replace, e.g. "default_action"
-    :param match_instances_by: (str) The attribute for match instances from state_a and state_b
-    :return: Returns the updated state_a instances
+    :param attribute_name: (str or list) The attribute name(s) to replace, e.g. "default_action" or
+                           ["default_action", "certificate_arn"]
+    :param match_instances_by: (str or tuple) The attribute(s) for match instances from state_a and state_b,
+                               e.g. "port" or ("port", "protocol")
+    :return: Returns all the state_a instances, updated where matched
     :rtype: List[Dict]
     """
-    logger.info(f'Replacing {resource_filter} instances attribute: "{attribute_name}"')
+    logger.info('Replacing %s instances attribute: "%s"', resource_filter, attribute_name)
     instances_a = state_a.getResourceInstances(query=resource_filter)
-    logger.debug(f'Got the instances_a: {instances_a}')
     instances_b = state_b.getResourceInstances(query=resource_filter)
-    logger.debug(f'Got the instances_b: {instances_b}')
-    instances_a_updated = []
-
-    if len(instances_a) == len(instances_b):
-        logger.info('So far so good')
-        for instance_b in instances_b:
-
-            attribute_value_b = state_b.getInstanceAttrValue(instance=instance_b,
-                                                             attribute_key=attribute_name)
-            for instance_a in instances_a:
-                if instance_a["attributes"][match_instances_by] == instance_b["attributes"][match_instances_by]:
-                    instance_a_updated = state_a.updateInstanceAttr(instance=instance_a,
-                                                                    attribute_key=attribute_name,
-                                                                    attribute_value=attribute_value_b)
-                    instances_a_updated.append(instance_a_updated)
-    return instances_a_updated
+    result = join_instances(left=instances_a, right=instances_b, attributes=attribute_name,
+                            match_by=match_instances_by)
+    logger.info('%s of %s instances matched by %s', len(result.matched), len(instances_a), match_instances_by)
+    return result.instances
 
 
 def swapKafkaNLB(state_a, state_b):
-    # Get resources from state_a
-    a_nlb = state_a.getByQuery({"name": "nlb", "module": "module.aws_networking[0]"})
-    a_nlb_domain = state_a.getByQuery({"name": "nlb_domain"})
-    a_nlb_service = state_a.getByQuery({"name": "nlb_service", "module": "module.aws_networking[0]"})
-    a_broker_certificate = state_a.getByQuery({"name": "nlb_certificate"})
-    a_route53_certificate_validation = state_a.getByQuery(
-        query={"name": "nlb_certificate_validation", "type": "aws_route53_record"})
-    a_acm_certificate_validation = state_a.getByQuery(
-        query={"name": "nlb_certificate_validation", "type": "aws_acm_certificate_validation"})
-
-    a_broker_listeners = state_a.getByQuery({"name": "nlb_broker_listeners"})
-    a_service_listeners = state_a.getByQuery({"name": "nlb_service_listeners"})
-
-    # Update listeners with target groups of cluster b
-    a_broker_listeners[0]["instances"] = replaceResourceInstancesAttributes(state_a=state_a,
-                                                                            state_b=state_b,
-                                                                            resource_filter={
-                                                                                "name": "nlb_broker_listeners"},
-                                                                            attribute_name="default_action",
-                                                                            match_instances_by="port")
-    a_service_listeners[0]["instances"] = replaceResourceInstancesAttributes(state_a=state_a,
-                                                                             state_b=state_b,
-                                                                             resource_filter={
-                                                                                 "name": "nlb_service_listeners"},
-                                                                             attribute_name="default_action",
-                                                                             match_instances_by="port")
-    # Update resources in state_b
-    state_b.updateByQuery(query={"name": "nlb", "module": "module.aws_networking[0]"}, new_resource=a_nlb[0])
-    state_b.updateByQuery(query={"name": "nlb_domain"}, new_resource=a_nlb_domain[0])
-    state_b.updateByQuery(query={"name": "nlb_service", "module": "module.aws_networking[0]"}, new_resource=a_nlb_service[0])
-    state_b.updateByQuery(query={"name": "nlb_certificate"}, new_resource=a_broker_certificate[0])
-    state_b.updateByQuery(query={"name": "nlb_certificate_validation", "type": "aws_route53_record"},
-                          new_resource=a_route53_certificate_validation[0])
-    state_b.updateByQuery(query={"name": "nlb_certificate_validation", "type": "aws_acm_certificate_validation"},
-                          new_resource=a_acm_certificate_validation[0])
-
-    state_b.updateByQuery(query={"name": "nlb_broker_listeners"},
-                          new_resource=a_broker_listeners[0])
-    state_b.updateByQuery(query={"name": "nlb_service_listeners"},
-                          new_resource=a_service_listeners[0])
-
-    # Apply the updated state_b
-    state_b.save(dst="modified")
+    """Applies the built-in "kafka" plan (plans/kafka.json)"""
+    return run_plans([SwapPlan.load("kafka")], state_a, state_b)
 
 
 def swapPrometheusNLB(state_a, state_b):
-    # # Get resources from state_a
-    a_nlb = state_a.getByQuery({"name": "nlb", "module": "module.prometheus[0].module.ingress[0]"})
-    a_nlb_domain = state_a.getByQuery({"name": "internal_record_set", "module": "module.prometheus[0].module.ingress[0]"})
-    a_nlb_service = state_a.getByQuery({"name": "nlb_service", "module": "module.prometheus[0].module.ingress[0]"})
-    a_broker_listeners = state_a.getByQuery({"name": "nlb_listeners", "module": "module.prometheus[0].module.ingress[0]"})
-
-    # Update listeners with target groups of cluster b
-    a_broker_listeners[0]["instances"] = replaceResourceInstancesAttributes(state_a=state_a,
-                                                                            state_b=state_b,
-                                                                            resource_filter={
-                                                                                "name": "nlb_listeners",
-                                                                                "module": "module.prometheus[0].module.ingress[0]"},
-                                                                            attribute_name="default_action",
-                                                                            match_instances_by="port")
-    # Update resources in state_b
-    state_b.updateByQuery(query={"name": "nlb", "module": "module.prometheus[0].module.ingress[0]"}, new_resource=a_nlb[0])
-    state_b.updateByQuery(query={"name": "internal_record_set", "module": "module.prometheus[0].module.ingress[0]"},
-                          new_resource=a_nlb_domain[0])
-    state_b.updateByQuery(query={"name": "nlb_service", "module": "module.prometheus[0].module.ingress[0]"},
-                          new_resource=a_nlb_service[0])
-
-    state_b.updateByQuery(query={"name": "nlb_listeners", "module": "module.prometheus[0].module.ingress[0]"},
-                          new_resource=a_broker_listeners[0])
-
-    # Apply the updated state_b
-    state_b.save(dst="modified")
+    """Applies the built-in "prometheus" plan (plans/prometheus.json)"""
+    return run_plans([SwapPlan.load("prometheus")], state_a, state_b)
 
 
 def main() -> None:
@@ -146,25 +213,102 @@ def main() -> None:
     :return: None
     """
 
-    states, env, dry_run, prom_ingress_enabled = arg_parser()
-    download_states(states=states, env=env)
-
-    ###############
-    state_a = TerraformState(filename=states[0], env=env)
-    state_a.load()
-    logger.info(f'The state_a is loaded.')
-    logger.info(f'The state_a resources len: {len(state_a.dict["resources"])}.')
-    state_b = TerraformState(filename=states[1], env=env)
-    state_b.load()
-    logger.info(f'The state_b is loaded.')
-    logger.info(f'The state_b resources len: {len(state_b.dict["resources"])}.')
-
-    swapKafkaNLB(state_a, state_b)
-    if prom_ingress_enabled:
-        swapPrometheusNLB(state_a, state_b)
-
-    if not dry_run:
-        state_b.upload(source="modified")
+    jobs, args = arg_parser()
+    env = args.env[0] if args.env else None
+    with metrics.profile(args.profile) if args.profile else contextlib.nullcontext():
+        if args.serve:
+            cache = StateCache(max_bytes=args.cache_memory * MB, save_mode=args.save_mode, lazy=args.lazy)
+            service = StateService(cache, env=env, output_dir=args.output_dir, plans_dir=args.plans_dir)
+            serve(service, port=args.port, socket_path=args.socket, token_file=args.token_file)
+            failed = False
+        elif args.select:
+            failed = not inspect(args.states, env=env, expression=args.select, lazy=args.lazy)
+        elif args.rollback:
+            rollback(args.states, env=env, snapshot_id=args.rollback, dry_run=args.dry_run)
+            failed = False
+        elif args.list_backups:
+            failed = not list_backups(args.states, env=env)
+        else:
+            failed = run(jobs, workers=args.workers, fan_out=bool(args.fan_out))
+    metrics.write_report(json_path=args.metrics_file, prometheus_path=args.metrics_prom)
+    if failed:
+        sys.exit(1)
+
+
+def inspect(states, env, expression, lazy=False) -> bool:
+    """
+    Prints the address, the number of instances and the matching instance keys of the resources of every
+    state matching a selector expression
+
+    :return: True if any resource matched
+    """
+    selector = compile_selector(expression)
+    found = 0
+    for state in download_states(states, env, lazy=lazy):
+        state.load()
+        with metrics.span("query") as span:
+            selected = selector.select(state.index)
+            span.resources = len(selected)
+        print(f'{state.name}: {len(selected)} resources match {expression}')
+        for position, instances in selected:
+            resource = state.index.resources[position]
+            keys = [instance.get("index_key") for instance in instances]
+            print(f'  {resource_address(resource)}  {len(instances)}/{len(resource.get("instances", []))} instances'
+                  + (f'  {keys}' if any(key is not None for key in keys) else ''))
+        found += len(selected)
+    return bool(found)
+
+
+def list_backups(states, env) -> bool:
+    """
+    Prints the snapshots of every state in the backup store, the oldest first
+
+    :return: True if any state has a snapshot
+    """
+    store = backup_store.get_store()
+    if store is None:
+        logger.error('Backups are disabled')
+        return False
+    found = 0
+    for name in states:
+        state = TerraformState(filename=name, env=env)
+        key = f'{state.s3_bucket}/{state.object}/{state.name}'
+        snapshots = store.snapshots(key)
+        print(f'{key}: {len(snapshots)} snapshots')
+        for snapshot_id in snapshots:
+            manifest = store.manifest(key, snapshot_id)
+            print(f'  {snapshot_id}  {manifest["reason"]}  {manifest["size"]} bytes')
+        found += len(snapshots)
+    return bool(found)
+
+
+def rollback(states, env, snapshot_id, dry_run=False) -> None:
+    """Restores every state to a snapshot of the backup store"""
+    for name in states:
+        path = TerraformState(filename=name, env=env).rollback(snapshot_id, dry_run=dry_run)
+        if dry_run:
+            logger.info('%s: The snapshot %s is saved to %s, not uploaded', name, snapshot_id, path)
+        else:
+            logger.info('%s is rolled back to the snapshot %s', name, snapshot_id)
+
+
+def run(jobs, workers, fan_out) -> bool:
+    """
+    Processes the state pairs: a single pair in this process, raising its errors as they are,
+    many of them in parallel, each failure reported in the summary
+
+    :return: True if a pair failed
+    """
+    if len(jobs) == 1 and not fan_out:
+        run_pair(jobs[0])
+        return False
+
+    results = run_fan_out(jobs, workers=workers) if fan_out else run_fleet(jobs, workers=workers)
+    logger.info('Processed %s state pairs:\n%s', len(results), format_summary(results))
+    failed = [result for result in results if not result.ok]
+    if failed:
+        logger.error('%s of %s state pairs failed', len(failed), len(results))
+    return bool(failed)
 
 
 if __name__ == '__main__':
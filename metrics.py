@@ -0,0 +1,150 @@
+"""
+Phase spans of a run: wall time, bytes and resources per phase, reported as JSON or in the Prometheus textfile format.
+Spans can nest, e.g. saving a state kept in memory serializes it, so the phases do not add up to the run time.
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("download", "parse", "hash", "query", "mutate", "serialize", "escape", "save", "backup", "upload")
+PROMETHEUS_PREFIX = "tf_state_change"
+
+
+class Span:
+    """One timed phase. bytes and resources can be set while the span is open"""
+
+    def __init__(self, name: str, bytes: int = 0, resources: int = 0) -> None:
+        self.name = name
+        self.bytes = bytes
+        self.resources = resources
+        self.seconds = 0.0
+
+
+class Recorder:
+    """Sums the spans of a run per phase. Thread-safe: the states of a run are handled concurrently"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._phases: Dict[str, Dict[str, float]] = {}
+
+    def add(self, name: str, seconds: float, bytes: int = 0, resources: int = 0, count: int = 1) -> None:
+        with self._lock:
+            phase = self._phases.setdefault(name, {"count": 0, "seconds": 0.0, "bytes": 0, "resources": 0})
+            phase["count"] += count
+            phase["seconds"] += seconds
+            phase["bytes"] += bytes
+            phase["resources"] += resources
+
+    def merge(self, report: Dict[str, Dict[str, float]]) -> None:
+        """Adds a report of another recorder, e.g. of a worker process"""
+        for name, phase in report.items():
+            self.add(name, **phase)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """The totals per phase: count, seconds, bytes, resources"""
+        with self._lock:
+            return {name: dict(phase) for name, phase in self._phases.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._phases.clear()
+
+
+_recorder = Recorder()
+
+
+def get_recorder() -> Recorder:
+    """The recorder of the process"""
+    return _recorder
+
+
+@contextmanager
+def span(name: str, bytes: int = 0, resources: int = 0) -> Iterator[Span]:
+    """
+    Times a phase and adds it to the recorder of the process, also when it fails
+
+    Usage:
+        with metrics.span("parse", bytes=size) as current:
+            ...
+            current.resources = len(resources)
+    """
+    current = Span(name, bytes=bytes, resources=resources)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - started
+        _recorder.add(name, current.seconds, bytes=current.bytes, resources=current.resources)
+
+
+def to_json(report: Dict[str, Dict[str, float]]) -> str:
+    """The report as a JSON summary, the phases in the order they happen"""
+    ordered = {name: report[name] for name in sorted(report, key=lambda n: (PHASES + (n,)).index(n))}
+    return json.dumps({"phases": ordered}, indent=2)
+
+
+def to_prometheus(report: Dict[str, Dict[str, float]]) -> str:
+    """The report in the Prometheus text exposition format, for the node_exporter textfile collector"""
+    lines = []
+    for field, help_text in [("seconds", "Wall time spent in the phase"), ("bytes", "Bytes handled in the phase"),
+                             ("resources", "Resources handled in the phase"), ("count", "Times the phase ran")]:
+        metric = f'{PROMETHEUS_PREFIX}_phase_{field}_total'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for name, phase in sorted(report.items()):
+            lines.append(f'{metric}{{phase="{name}"}} {phase[field]}')
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: str, text: str) -> None:
+    """The textfile collector may read the file at any time, so it is replaced in one step"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_report(json_path: Optional[str] = None, prometheus_path: Optional[str] = None) -> Dict[str, Any]:
+    """Logs the JSON summary of the run and writes it to the given files"""
+    report = _recorder.report()
+    summary = to_json(report)
+    logger.info("Phases of the run:\n%s", summary)
+    if json_path:
+        _write_atomic(json_path, summary + "\n")
+    if prometheus_path:
+        _write_atomic(prometheus_path, to_prometheus(report))
+    return report
+
+
+@contextmanager
+def profile(directory: str, top: int = 20) -> Iterator[None]:
+    """
+    Captures a cProfile of the run into <directory>/run.pstats and a tracemalloc snapshot into
+    <directory>/run.tracemalloc, and logs the largest allocation sites.
+    Read them with: python -m pstats profile/run.pstats, tracemalloc.Snapshot.load('profile/run.tracemalloc')
+    """
+    os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(os.path.join(directory, 'run.pstats'))
+        snapshot.dump(os.path.join(directory, 'run.tracemalloc'))
+        logger.info("Peak traced memory: %.1f MB. The profile is saved to %s", peak / 1024 / 1024, directory)
+        for stat in snapshot.statistics('lineno')[:top]:
+            logger.info("%s", stat)
@@ -0,0 +1,230 @@
+"""
+Shared S3 client and transfers of Terraform States.
+boto3 is imported the first time a client is needed: importing it takes longer than a whole local run
+"""
+import base64
+import contextlib
+import hashlib
+import io
+import os
+import threading
+import time
+from typing import Dict, Any, NamedTuple, Optional, Union, BinaryIO
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+DEFAULT_REGION = 'us-east-1'
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_settings = {
+    "endpoint_url": None,
+    "multipart_threshold": 8 * MB,
+    "multipart_chunksize": 8 * MB,
+    "max_concurrency": 10,
+    "max_workers": 8,
+}
+
+
+class TransferStats(NamedTuple):
+    """The outcome of one object transfer"""
+    key: str
+    bytes: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """MB/s"""
+        return self.bytes / MB / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return f'{self.key}: {self.bytes} bytes in {self.seconds:.2f}s ({self.throughput:.2f} MB/s)'
+
+
+def configure(endpoint_url: Optional[str] = None,
+              multipart_threshold: Optional[int] = None,
+              multipart_chunksize: Optional[int] = None,
+              max_concurrency: Optional[int] = None,
+              max_workers: Optional[int] = None) -> None:
+    """
+    Sets up the S3 transfers of the run. Must be called before the first transfer to take effect on the client.
+
+    :param endpoint_url: An S3 compatible endpoint to use instead of AWS, e.g. a local stand-in
+    :param multipart_threshold: (bytes) Objects from this size on are transferred in parts
+    :param multipart_chunksize: (bytes) The size of the parts
+    :param max_concurrency: The number of threads transferring the parts of one object
+    :param max_workers: The number of objects transferred at the same time
+    """
+    updates = {"endpoint_url": endpoint_url,
+               "multipart_threshold": multipart_threshold,
+               "multipart_chunksize": multipart_chunksize,
+               "max_concurrency": max_concurrency,
+               "max_workers": max_workers}
+    with _lock:
+        _settings.update({key: value for key, value in updates.items() if value is not None})
+        _clients.clear()
+
+
+def settings() -> Dict[str, Any]:
+    """The current transfer settings, as arguments of configure(), e.g. to set worker processes up alike"""
+    with _lock:
+        return dict(_settings)
+
+
+def max_workers() -> int:
+    return _settings["max_workers"]
+
+
+def transfer_config() -> 'TransferConfig':
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=_settings["multipart_threshold"],
+                          multipart_chunksize=_settings["multipart_chunksize"],
+                          max_concurrency=_settings["max_concurrency"])
+
+
+def get_session() -> 'boto3.session.Session':
+    """The boto3 session shared by the whole run. Creating one is slow, so it is created once"""
+    import boto3
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session(region_name=DEFAULT_REGION)
+        return _session
+
+
+def get_client(region_name: str = DEFAULT_REGION):
+    """
+    The S3 client shared by the whole run. boto3 clients are thread-safe; the connection pool
+    is sized for every object and part being transferred at the same time.
+    """
+    from botocore.config import Config
+    session = get_session()
+    key = (region_name, _settings["endpoint_url"])
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            pool = max(10, _settings["max_workers"] * _settings["max_concurrency"])
+            client = session.client('s3', region_name=region_name, endpoint_url=_settings["endpoint_url"],
+                                    config=Config(max_pool_connections=pool))
+            _clients[key] = client
+        return client
+
+
+def head_object(bucket: str, key: str) -> Dict[str, Any]:
+    """The metadata of an object: ETag, VersionId (versioned buckets), ContentLength, ..."""
+    return get_client().head_object(Bucket=bucket, Key=key)
+
+
+class _KnownObject:
+    """
+    Gives a transfer the size and the ETag of the object from an earlier HEAD request: the transfer does not
+    request them again and every ranged GET is conditional on the ETag (see s3transfer.subscribers.BaseSubscriber)
+    """
+
+    def __init__(self, size: int, etag: str) -> None:
+        self.size = size
+        self.etag = etag
+
+    def on_queued(self, future, **kwargs) -> None:
+        future.meta.provide_transfer_size(self.size)
+        future.meta.provide_object_etag(self.etag)
+
+    def on_progress(self, future, bytes_transferred, **kwargs) -> None:
+        pass
+
+    def on_done(self, future, **kwargs) -> None:
+        pass
+
+
+def _download(bucket: str, key: str, target: Union[str, BinaryIO], version_id: Optional[str] = None,
+              etag: Optional[str] = None, size: Optional[int] = None) -> None:
+    """
+    Downloads an object into a file or a file object. Given the ETag and the size of a HEAD request, every GET is
+    conditional on the ETag, so an object replaced since then fails with PreconditionFailed rather than being
+    downloaded as the version the ETag stands for
+
+    :param version_id: Download this version of the object, e.g. the one a HEAD request returned
+    """
+    client = get_client()
+    extra_args = {'VersionId': version_id} if version_id else {}
+    if etag is None or size is None:
+        if isinstance(target, str):
+            client.download_file(Bucket=bucket, Key=key, Filename=target, ExtraArgs=extra_args or None,
+                                 Config=transfer_config())
+        else:
+            client.download_fileobj(Bucket=bucket, Key=key, Fileobj=target, ExtraArgs=extra_args or None,
+                                    Config=transfer_config())
+    elif size < _settings["multipart_threshold"]:
+        body = client.get_object(Bucket=bucket, Key=key, IfMatch=etag, **extra_args)['Body']
+        with open(target, 'wb') if isinstance(target, str) else contextlib.nullcontext(target) as file:
+            for chunk in body.iter_chunks(MB):
+                file.write(chunk)
+    else:
+        from botocore.exceptions import ClientError
+        from s3transfer.exceptions import S3DownloadFailedError
+        from s3transfer.manager import TransferManager
+        with TransferManager(client, transfer_config()) as manager:
+            future = manager.download(bucket, key, target, extra_args=extra_args,
+                                      subscribers=[_KnownObject(size, etag)])
+            try:
+                future.result()
+            except S3DownloadFailedError as e:
+                # s3transfer reports a failed precondition this way, the callers handle the error of the GET
+                if isinstance(e.__context__, ClientError):
+                    raise e.__context__
+                raise
+
+
+def download_file(bucket: str, key: str, filename: str, version_id: Optional[str] = None,
+                  etag: Optional[str] = None, size: Optional[int] = None) -> TransferStats:
+    """
+    :param version_id: Download this version of the object, e.g. the one a HEAD request returned
+    :param etag: The ETag of the object the HEAD request returned, see _download
+    :param size: The size of the object the HEAD request returned
+    """
+    started = time.perf_counter()
+    _download(bucket, key, filename, version_id=version_id, etag=etag, size=size)
+    stats = TransferStats(key=key, bytes=os.path.getsize(filename), seconds=time.perf_counter() - started)
+    logger.info('Downloaded %s', stats)
+    return stats
+
+
+def upload_file(filename: str, bucket: str, key: str) -> TransferStats:
+    started = time.perf_counter()
+    get_client().upload_file(Filename=filename, Bucket=bucket, Key=key, Config=transfer_config())
+    stats = TransferStats(key=key, bytes=os.path.getsize(filename), seconds=time.perf_counter() - started)
+    logger.info('Uploaded %s', stats)
+    return stats
+
+
+def download_bytes(bucket: str, key: str, version_id: Optional[str] = None, etag: Optional[str] = None,
+                   size: Optional[int] = None) -> bytes:
+    """Downloads an object into memory, see download_file"""
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    _download(bucket, key, buffer, version_id=version_id, etag=etag, size=size)
+    data = buffer.getvalue()
+    logger.info('Downloaded %s', TransferStats(key=key, bytes=len(data), seconds=time.perf_counter() - started))
+    return data
+
+
+def upload_bytes(data: bytes, bucket: str, key: str) -> TransferStats:
+    """
+    Uploads an object from memory with an integrity check. Below the multipart threshold the object is sent
+    in one request with its Content-MD5; larger objects are sent in parts, each with a CRC32 checksum,
+    as S3 does not accept a Content-MD5 for a whole multipart object.
+    """
+    started = time.perf_counter()
+    if len(data) < _settings["multipart_threshold"]:
+        content_md5 = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        get_client().put_object(Bucket=bucket, Key=key, Body=data, ContentMD5=content_md5)
+    else:
+        get_client().upload_fileobj(Fileobj=io.BytesIO(data), Bucket=bucket, Key=key,
+                                    ExtraArgs={'ChecksumAlgorithm': 'CRC32'}, Config=transfer_config())
+    stats = TransferStats(key=key, bytes=len(data), seconds=time.perf_counter() - started)
+    logger.info('Uploaded %s', stats)
+    return stats
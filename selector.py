@@ -0,0 +1,255 @@
+"""
+Selector expressions over the resources of a Terraform State and their instances, e.g.
+
+    module.prometheus[*].module.ingress[0].aws_lb.nlb
+    **.aws_lb_listener.nlb_*_listeners where attributes.port in (9092, 9093)
+    module.aws_networking[0].aws_route53_record./nlb_(domain|certificate_validation)/
+    **.data.aws_iam_policy_document.*
+
+A path is a Terraform address: module segments, "data" for data sources, then type and name.
+A leading "**" matches any module path, the root one included; without it the path is anchored at the root module.
+Module names, module indexes ([*] is any index), types and names can be globs (* and ?) or /regexes/.
+A missing name matches any name.
+
+Instance predicates follow "where", joined by "and": <field> <op> <value>, the field being a dotted path
+into the instance (attributes.port, index_key, attributes.tags.Name) and op one of
+==, !=, <, <=, >, >=, in, not in, ~ (regex search). Values are Python or JSON literals.
+"""
+import ast
+import fnmatch
+import functools
+import operator
+import re
+from typing import Dict, Any, List, Optional, Tuple, Callable, Set
+
+from state_errors import SchemaError
+
+_WILDCARDS = re.compile(r'[*?\[]')
+# A module segment: its name, a glob or a /regex/ that may have brackets of its own, then its index if any
+_MODULE_SEGMENT = re.compile(r'(.+?)(\[[^\]]*\])?', re.S)
+_PREDICATE = re.compile(r'^\s*([A-Za-z_][\w.]*)\s*(==|!=|<=|>=|<|>|~|not\s+in\b|in\b)\s*(.+?)\s*$', re.S)
+_LITERALS = {"true": True, "false": False, "null": None}
+_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+    "in": lambda value, values: value in values,
+    "not in": lambda value, values: value not in values,
+    "~": lambda value, pattern: isinstance(value, str) and pattern.search(value) is not None,
+}
+
+
+def _split(text: str, separator: str) -> List[str]:
+    """Splits on a separator outside of quotes, brackets, parentheses and /regexes/"""
+    parts, current, depth, quote = [], [], 0, None
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if quote:
+            current.append(char)
+            if char == '\\' and quote != '/':
+                current.append(text[position + 1:position + 2])
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'' or (char == '/' and (not current or current[-1] == '.')):
+            quote = char
+            current.append(char)
+        elif char in '[(':
+            depth += 1
+            current.append(char)
+        elif char in '])':
+            depth -= 1
+            current.append(char)
+        elif depth == 0 and text.startswith(separator, position):
+            parts.append("".join(current))
+            current = []
+            position += len(separator)
+            continue
+        else:
+            current.append(char)
+        position += 1
+    parts.append("".join(current))
+    return parts
+
+
+def _pattern(token: str, what: str) -> Tuple[Optional[str], Optional['re.Pattern']]:
+    """
+    A token of the path: (exact value, None) or (None, compiled pattern)
+    """
+    if not token:
+        raise SchemaError(f'selector: empty {what}')
+    if len(token) > 1 and token.startswith('/') and token.endswith('/'):
+        try:
+            return None, re.compile(token[1:-1])
+        except re.error as e:
+            raise SchemaError(f'selector {what} regex {token}: {e}')
+    if _WILDCARDS.search(token):
+        return None, re.compile(fnmatch.translate(token))
+    return token, None
+
+
+def _regex(token: str, what: str) -> str:
+    """A token of the path as a part of the regex of a whole module path"""
+    exact, pattern = _pattern(token, what)
+    if exact is not None:
+        return re.escape(exact)
+    if token.startswith('/'):
+        return f'(?:{token[1:-1]})'
+    wildcards = {'*': '[^.\\[\\]]*', '?': '[^.\\[\\]]'}
+    return "".join(wildcards.get(char) or re.escape(char) for char in token)
+
+
+def _literal(text: str) -> Any:
+    text = text.strip()
+    if text in _LITERALS:
+        return _LITERALS[text]
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        raise SchemaError(f'selector value: {text}',
+                          'expected a string, number, true/false/null or a tuple of them')
+
+
+class Predicate:
+    """<field> <op> <value> on an instance"""
+
+    def __init__(self, text: str) -> None:
+        match = _PREDICATE.match(text)
+        if not match:
+            raise SchemaError(f'selector predicate: {text}',
+                              'expected: <field> <op> <value>, e.g. attributes.port == 9092')
+        self.text = text.strip()
+        self.path = match.group(1).split('.')
+        self.op = " ".join(match.group(2).split())
+        value = match.group(3)
+        if self.op == "~":
+            self.value = re.compile(_literal(value))
+        elif self.op in ("in", "not in"):
+            values = _literal(value)
+            self.value = frozenset(values) if isinstance(values, (tuple, list, set)) else frozenset([values])
+        else:
+            self.value = _literal(value)
+        self._compare = _OPERATORS[self.op]
+
+    def __call__(self, instance: Dict[str, Any]) -> bool:
+        value = instance
+        for key in self.path:
+            if not isinstance(value, dict) or key not in value:
+                return False
+            value = value[key]
+        try:
+            return self._compare(value, self.value)
+        except TypeError:
+            return False
+
+    def __repr__(self) -> str:
+        return self.text
+
+
+class Selector:
+    """
+    A compiled selector expression. The module, mode, type and name of the path are answered from the
+    lookup tables of the state's ResourceIndex: exact values directly, patterns by matching the distinct
+    values of the field once. Only the instance predicates need the resources themselves.
+    """
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        parts = re.split(r'\s+where(?:\s+|$)', expression.strip(), maxsplit=1, flags=re.I)
+        self.predicates = [Predicate(text) for text in _split(parts[1], ' and ')] if len(parts) > 1 else []
+        self._parse_path(parts[0])
+
+    def _parse_path(self, path: str) -> None:
+        tokens = _split(path, '.')
+        any_module = bool(tokens) and tokens[0] == '**'
+        if any_module:
+            tokens = tokens[1:]
+
+        # Every module segment as an exact address part (None if it has wildcards) and as a regex
+        exact_parts, regex_parts = [], []
+        while len(tokens) > 2 and tokens[0] == 'module':
+            name, index = _MODULE_SEGMENT.fullmatch(tokens[1]).groups()
+            index = index or ''
+            exact = _pattern(name, "module name")[0] is not None and index != '[*]'
+            exact_parts.append(f'module.{name}{index}' if exact else None)
+            regex_parts.append(f'module\\.{_regex(name, "module name")}' +
+                               ('\\[[^\\]]*\\]' if index == '[*]' else re.escape(index)))
+            tokens = tokens[2:]
+        self.mode = "managed"
+        if tokens and tokens[0] == 'data':
+            self.mode = "data"
+            tokens = tokens[1:]
+        if not 1 <= len(tokens) <= 2:
+            raise SchemaError(f'selector path: {path}',
+                              'expected: [**.][module.<name>[<index>]...][data.]<type>[.<name>]')
+        self.type = _pattern(tokens[0], "type")
+        self.name = _pattern(tokens[1], "name") if len(tokens) == 2 else (None, None)
+
+        # The module path: None for any module, "" for the root module, an exact value or a pattern
+        self.module: Tuple[Optional[str], Optional['re.Pattern']]
+        if any_module and not regex_parts:
+            self.module = (None, None)
+        elif not regex_parts:
+            self.module = ("", None)
+        elif not any_module and None not in exact_parts:
+            self.module = (".".join(exact_parts), None)
+        else:
+            self.module = (None, re.compile(('(?:.+\\.)?' if any_module else '') + '\\.'.join(regex_parts)))
+
+    @staticmethod
+    def _field(index, field: str, constraint: Tuple[Optional[str], Optional['re.Pattern']]) -> Optional[Set[int]]:
+        """The positions matching a constraint on a field, None if the field is not constrained"""
+        exact, pattern = constraint
+        if exact is None and pattern is None:
+            return None
+        if exact is not None:
+            return set(index.find({field: exact}))
+        positions = set()
+        for value in index.values(field):
+            if isinstance(value, str) and pattern.fullmatch(value):
+                positions.update(index.find({field: value}))
+        return positions
+
+    def find(self, index) -> List[int]:
+        """The positions of the resources whose address matches the path, in the state order"""
+        candidates = None
+        for field, constraint in (("name", self.name), ("type", self.type), ("mode", (self.mode, None)),
+                                  ("module", (None, None) if self.module[0] == "" else self.module)):
+            positions = self._field(index, field, constraint)
+            if positions is not None:
+                candidates = positions if candidates is None else candidates & positions
+            if not candidates and candidates is not None:
+                return []
+        if self.module[0] == "":
+            candidates = {position for position in candidates if "module" not in index.header(position)}
+        return sorted(candidates)
+
+    def instances(self, resource: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """The instances of the resource matching every predicate"""
+        return [instance for instance in resource.get("instances", ())
+                if all(predicate(instance) for predicate in self.predicates)]
+
+    def select(self, index) -> List[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        :return: (position, matching instances) of the matching resources. Without predicates all the
+                 instances match and a resource matches even if it has no instance
+        """
+        selected = []
+        for position in self.find(index):
+            resource = index.resources[position]
+            if not self.predicates:
+                selected.append((position, resource.get("instances", [])))
+                continue
+            instances = self.instances(resource)
+            if instances:
+                selected.append((position, instances))
+        return selected
+
+    def __repr__(self) -> str:
+        return f'Selector({self.expression!r})'
+
+
+@functools.lru_cache(maxsize=256)
+def compile_selector(expression: str) -> Selector:
+    """Compiles a selector expression, once per distinct expression"""
+    return Selector(expression)
+
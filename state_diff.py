@@ -0,0 +1,199 @@
+"""
+Content hashes of the resources and instances of a Terraform State, and a structural diff of two states by hash
+
+    python state_diff.py downloads/jarvis-nonprod/b.tfstate modified/jarvis-nonprod/b.tfstate
+"""
+import argparse
+import hashlib
+import json
+import sys
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+
+import logging
+
+from dependency_graph import resource_address
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+MISSING = "<not set>"
+
+
+def _canonical(value: Any) -> bytes:
+    """The same bytes for the same content, whatever the key order and the formatting of the file"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+
+
+def content_hash(value: Any) -> bytes:
+    """The hash of a JSON value"""
+    return hashlib.blake2b(_canonical(value), digest_size=DIGEST_SIZE).digest()
+
+
+def _instance_keys(instances: List[Dict[str, Any]]) -> List[Any]:
+    """The instances are told apart by their index_key, by their position if the keys are not unique"""
+    keys = [instance.get("index_key") for instance in instances]
+    if len(keys) < 2 or len(set(keys)) == len(keys):
+        return keys
+    return [f'#{position}' for position in range(len(instances))]
+
+
+def instance_hashes(resource: Dict[str, Any]) -> Dict[Any, bytes]:
+    """The hash of every instance of a resource, by instance key"""
+    instances = resource.get("instances") or []
+    return dict(zip(_instance_keys(instances), map(content_hash, instances)))
+
+
+class ResourceHash(NamedTuple):
+    """
+    digest: The hash of the whole resource
+    position: The position of the resource in the state
+    """
+    digest: bytes
+    position: int
+
+
+def state_hashes(resources) -> Dict[str, ResourceHash]:
+    """
+    The hash of every resource of a state by address. A lazy resources list is decoded one resource at a time
+    without keeping the resources. An address found more than once gets a #<n> suffix from the second time on.
+    The instances are hashed only when the hashes of their resources differ, see instance_hashes()
+    """
+    hashes: Dict[str, ResourceHash] = {}
+    seen: Dict[str, int] = {}
+    for position, resource in enumerate(resources):
+        address = resource_address(resource)
+        seen[address] = seen.get(address, 0) + 1
+        if seen[address] > 1:
+            address = f'{address}#{seen[address]}'
+        hashes[address] = ResourceHash(content_hash(resource), position)
+    return hashes
+
+
+class InstanceChange(NamedTuple):
+    """
+    key: The index_key of the instance
+    fields: {dotted path: (before, after)} of the changed attributes and instance fields, MISSING if not set
+    """
+    key: Any
+    fields: Dict[str, Tuple[Any, Any]]
+
+
+class ResourceChange(NamedTuple):
+    """The changed fields of a resource and its added, removed and changed instances"""
+    address: str
+    fields: Dict[str, Tuple[Any, Any]]
+    added: List[Any]
+    removed: List[Any]
+    changed: List[InstanceChange]
+
+
+class StateDiff(NamedTuple):
+    """The addresses of the added and removed resources, and the changes of the other resources that differ"""
+    added: List[str]
+    removed: List[str]
+    changed: List[ResourceChange]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def _changed_fields(before: Dict[str, Any], after: Dict[str, Any], skip: str,
+                    prefix: str = "") -> Dict[str, Tuple[Any, Any]]:
+    """The fields of two dicts that differ, skipping one of them. "attributes" is compared attribute by attribute"""
+    changed = {}
+    for key in dict.fromkeys([*before, *after]):
+        if key == skip:
+            continue
+        old, new = before.get(key, MISSING), after.get(key, MISSING)
+        if old == new:
+            continue
+        if key == "attributes" and isinstance(old, dict) and isinstance(new, dict):
+            changed.update(_changed_fields(old, new, skip="", prefix="attributes."))
+        else:
+            changed[f'{prefix}{key}'] = (old, new)
+    return changed
+
+
+def _resource_change(address: str, before: Dict[str, Any], after: Dict[str, Any]) -> ResourceChange:
+    """Compares the instances by hash and only the changed ones attribute by attribute"""
+    hashes_a, hashes_b = instance_hashes(before), instance_hashes(after)
+    instances_a = dict(zip(hashes_a, before.get("instances") or []))
+    instances_b = dict(zip(hashes_b, after.get("instances") or []))
+    changed = [InstanceChange(key, _changed_fields(instances_a[key], instances_b[key], skip="index_key"))
+               for key, digest in hashes_a.items() if key in hashes_b and hashes_b[key] != digest]
+    return ResourceChange(address=address,
+                          fields=_changed_fields(before, after, skip="instances"),
+                          added=[key for key in hashes_b if key not in hashes_a],
+                          removed=[key for key in hashes_a if key not in hashes_b],
+                          changed=changed)
+
+
+def diff_states(resources_a, resources_b, hashes_a: Optional[Dict[str, ResourceHash]] = None,
+                hashes_b: Optional[Dict[str, ResourceHash]] = None) -> StateDiff:
+    """
+    Compares two states in time linear in their resources: the resources are matched by address and compared
+    by hash, and only the ones whose hashes differ are decoded (in a lazy state) and compared instance by instance
+
+    :param resources_a: The resources of the state before, e.g. as downloaded
+    :param resources_b: The resources of the state after, e.g. as modified
+    :param hashes_a: The state_hashes() of resources_a if they are already known
+    :param hashes_b: The state_hashes() of resources_b if they are already known
+    """
+    hashes_a = state_hashes(resources_a) if hashes_a is None else hashes_a
+    hashes_b = state_hashes(resources_b) if hashes_b is None else hashes_b
+    changed = [_resource_change(address, resources_a[digest.position], resources_b[hashes_b[address].position])
+               for address, digest in hashes_a.items()
+               if address in hashes_b and hashes_b[address].digest != digest.digest]
+    diff = StateDiff(added=[address for address in hashes_b if address not in hashes_a],
+                     removed=[address for address in hashes_a if address not in hashes_b],
+                     changed=changed)
+    logger.debug('%s resources added, %s removed, %s changed', len(diff.added), len(diff.removed), len(diff.changed))
+    return diff
+
+
+def to_dict(diff: StateDiff) -> Dict[str, Any]:
+    """The diff as JSON-serializable values"""
+    def fields(changed: Dict[str, Tuple[Any, Any]]) -> Dict[str, Any]:
+        return {path: {"before": old, "after": new} for path, (old, new) in changed.items()}
+
+    return {"added": diff.added, "removed": diff.removed,
+            "changed": [{"address": change.address, "fields": fields(change.fields),
+                         "instances": {"added": change.added, "removed": change.removed,
+                                       "changed": [{"index_key": instance.key, "fields": fields(instance.fields)}
+                                                   for instance in change.changed]}}
+                        for change in diff.changed]}
+
+
+def format_diff(diff: StateDiff) -> str:
+    """A plan-like text report of the diff"""
+    if not diff:
+        return "No differences"
+    lines = [f'+ {address}' for address in diff.added] + [f'- {address}' for address in diff.removed]
+    for change in diff.changed:
+        lines.append(f'~ {change.address}')
+        lines.extend(f'    {path}: {json.dumps(old)} -> {json.dumps(new)}'
+                     for path, (old, new) in change.fields.items())
+        lines.extend(f'    + instance {json.dumps(key)}' for key in change.added)
+        lines.extend(f'    - instance {json.dumps(key)}' for key in change.removed)
+        for instance in change.changed:
+            lines.append(f'    ~ instance {json.dumps(instance.key)}')
+            lines.extend(f'        {path}: {json.dumps(old)} -> {json.dumps(new)}'
+                         for path, (old, new) in instance.fields.items())
+    lines.append(f'{len(diff.added)} added, {len(diff.removed)} removed, {len(diff.changed)} changed')
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Structural diff of two Terraform State files, '
+                                                 'e.g. a downloaded state and its dry run result')
+    parser.add_argument('before', help='The state before, e.g. downloads/jarvis-nonprod/b.tfstate')
+    parser.add_argument('after', help='The state after, e.g. modified/jarvis-nonprod/b.tfstate')
+    parser.add_argument('--json', help='Print the diff as JSON', action="store_true", dest="json")
+    args = parser.parse_args()
+    states = []
+    for path in (args.before, args.after):
+        with open(path, encoding='utf-8') as state_file:
+            states.append(json.load(state_file))
+    result = diff_states(states[0]["resources"], states[1]["resources"])
+    print(json.dumps(to_dict(result), indent=2) if args.json else format_diff(result))
+    sys.exit(1 if result else 0)
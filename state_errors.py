@@ -32,3 +32,29 @@ class TFStateChangeError(Exception):
 
     def __str__(self) -> str:
         return str(self.args)
+
+
+class ObjectNotFoundError(Exception):
+    """Exception raised if a state object does not exist in the storage.
+    Attributes:
+        key
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+
+    def __str__(self) -> str:
+        return f"The object {self.key!r} does not exist!"
+
+
+class AccessDeniedError(Exception):
+    """Exception raised if the credentials do not give access to a state object.
+    Attributes:
+        key
+    """
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+
+    def __str__(self) -> str:
+        return f"The access to the object {self.key!r} is denied!"
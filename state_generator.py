@@ -0,0 +1,120 @@
+"""
+Generates synthetic Terraform v4 states of any size, for benchmarks and local runs
+
+    python state_generator.py downloads/jarvis-nonprod/a.tfstate --resources 10000 --variant 1
+"""
+import argparse
+import random
+from typing import Dict, Any, List
+
+from dependency_graph import config_address, resource_address
+from state_writer import dump_state
+
+NETWORKING = 'module.aws_networking[0]'
+PROMETHEUS = 'module.prometheus[0].module.ingress[0]'
+PROVIDER = 'provider["registry.terraform.io/hashicorp/aws"]'
+TYPES = ["aws_instance", "aws_security_group", "aws_security_group_rule", "aws_iam_role", "aws_iam_policy",
+         "aws_s3_bucket", "aws_route53_record", "aws_lb_target_group", "aws_ssm_parameter", "aws_kms_key"]
+LISTENER_PORTS = list(range(9092, 9100))
+
+
+def _instance(attributes: Dict[str, Any], index_key=None, dependencies=None) -> Dict[str, Any]:
+    instance = {"schema_version": 0, "attributes": attributes, "sensitive_attributes": [],
+                "private": "eyJzY2hlbWFfdmVyc2lvbiI6IjEifQ=="}
+    if index_key is not None:
+        instance = {"index_key": index_key, **instance}
+    if dependencies:
+        instance["dependencies"] = dependencies
+    return instance
+
+
+def _resource(module: str, resource_type: str, name: str, instances: List[Dict[str, Any]],
+              mode: str = "managed") -> Dict[str, Any]:
+    resource = {"mode": mode, "type": resource_type, "name": name, "provider": PROVIDER, "instances": instances}
+    return {"module": module, **resource} if module else resource
+
+
+def swap_resources(variant: int = 0, listener_ports: List[int] = LISTENER_PORTS) -> List[Dict[str, Any]]:
+    """
+    The resources of the built-in kafka and prometheus plans. Their values differ between variants.
+    The dependencies are configuration addresses, without module instance keys, as Terraform writes them
+    """
+    nlb = config_address(f'{NETWORKING}.aws_lb.nlb')
+    resources = [_resource(NETWORKING, "aws_lb", "nlb", [_instance(
+        {"arn": f'arn:aws:elasticloadbalancing:us-east-1:000000000000:loadbalancer/net/nlb-{variant}',
+         "tags": {"Description": "Kafka <brokers> & services"}})])]
+    for name, resource_type in [("nlb_domain", "aws_route53_record"), ("nlb_service", "aws_lb"),
+                                ("nlb_certificate", "aws_acm_certificate"),
+                                ("nlb_certificate_validation", "aws_route53_record"),
+                                ("nlb_certificate_validation", "aws_acm_certificate_validation")]:
+        resources.append(_resource(NETWORKING, resource_type, name,
+                                   [_instance({"id": f'{name}-{variant}'}, dependencies=[nlb])]))
+    for name, resource_type in [("nlb", "aws_lb"), ("internal_record_set", "aws_route53_record"),
+                                ("nlb_service", "aws_lb")]:
+        resources.append(_resource(PROMETHEUS, resource_type, name, [_instance({"id": f'prometheus-{name}-{variant}'})]))
+    for module, name in [(NETWORKING, "nlb_broker_listeners"), (NETWORKING, "nlb_service_listeners"),
+                         (PROMETHEUS, "nlb_listeners")]:
+        resources.append(_resource(module, "aws_lb_listener", name, [
+            _instance({"port": port, "protocol": "TCP",
+                       "default_action": [{"type": "forward",
+                                           "target_group_arn": f'arn:aws:targetgroup/tg-{variant}-{port}'}]},
+                      index_key=str(port), dependencies=[config_address(f'{module}.aws_lb.nlb')])
+            for port in listener_ports]))
+    return resources
+
+
+def generate_state(resources: int = 1000, seed: int = 0, variant: int = 0, modules: int = 50,
+                   depth: int = 3) -> Dict[str, Any]:
+    """
+    A Terraform v4 state with the resources of the built-in swap plans and <resources> filler resources
+    in nested modules, some with several instances and attribute values containing <, > and &.
+    The same seed gives the same filler resources, the variant changes the swapped ones only.
+
+    :param modules: The number of distinct module paths
+    :param depth: The maximum nesting of the module paths
+    """
+    rng = random.Random(seed)
+    module_paths = [""]
+    for number in range(modules):
+        path = ".".join(f'module.m{number}_{level}[{level}]' if level % 2 else f'module.m{number}_{level}["k{level}"]'
+                        for level in range(1 + number % depth))
+        module_paths.append(path)
+
+    state_resources = swap_resources(variant)
+    previous = None
+    for number in range(resources):
+        module = module_paths[number % len(module_paths)]
+        resource_type = TYPES[rng.randrange(len(TYPES))]
+        count = 1 if rng.random() < 0.8 else rng.randint(2, 6)
+        instances = [
+            _instance({"id": f'{resource_type}-{number}-{index}',
+                       "arn": f'arn:aws:{resource_type}:us-east-1:000000000000:{number}/{index}',
+                       "description": "allow <ingress> & egress" if number % 5 == 0 else f'resource {number}',
+                       "tags": {"Name": f'r{number}', "Team": "platform"},
+                       "weight": rng.random()},
+                      index_key=index if count > 1 else None,
+                      dependencies=[previous] if previous else None)
+            for index in range(count)]
+        state_resources.append(_resource(module, resource_type, f'r{number}', instances,
+                                         mode="data" if number % 11 == 0 else "managed"))
+        previous = config_address(resource_address(state_resources[-1]))
+    return {"version": 4, "terraform_version": "1.0.11", "serial": 1 + variant,
+            "lineage": f'00000000-0000-0000-0000-{seed:012d}',
+            "outputs": {"endpoint": {"value": "<nlb> & <dns>", "type": "string"}},
+            "resources": state_resources}
+
+
+def write_state(path: str, state: Dict[str, Any]) -> None:
+    """Writes a state the way Terraform does: indented by 2, <, > and & escaped"""
+    with open(path, 'w', encoding='utf-8') as state_file:
+        dump_state(state, state_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic Terraform v4 state')
+    parser.add_argument('path', help='Where to write the state')
+    parser.add_argument('--resources', help='Number of filler resources', type=int, default=1000)
+    parser.add_argument('--seed', help='Seed of the filler resources', type=int, default=0)
+    parser.add_argument('--variant', help='Changes the values of the swapped resources', type=int, default=0)
+    args = parser.parse_args()
+    write_state(args.path, generate_state(resources=args.resources, seed=args.seed, variant=args.variant))
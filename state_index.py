@@ -0,0 +1,192 @@
+"""
+In-memory index over the resources of a Terraform State
+"""
+from typing import Dict, Any, List, Iterable, Optional, Tuple, Callable, Union, Collection
+
+INDEXED_FIELDS = ("module", "mode", "type", "name")
+
+# Root module resources have no "module" key at all. A query for {"module": None}
+# must not match them, so a missing field is indexed under its own sentinel.
+_MISSING = object()
+
+# The positions of the resources with the same value of a field. Most names and keys are unique,
+# so the bucket of a single resource is its position rather than a dict of positions
+Bucket = Union[int, Dict[int, None]]
+
+
+def _hashable(value) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def matches(resource: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    """The exact-match predicate every query of the Terraform State is based on"""
+    return all(x in resource and resource[x] == query[x] for x in query)
+
+
+class ResourceIndex:
+    """
+    Keeps the positions of the state resources keyed by module, type and name, plus a secondary
+    index per field (module, mode, type, name) for partial queries such as {"name": "nlb"}.
+
+    The index does not own a copy of the resources; it indexes the list it is given and must be told
+    about every mutation of it (replace, append, delete) to stay consistent. A list that can tell the
+    indexed fields of a resource without decoding it (see LazyResourceList.header) is indexed from those.
+
+    changed: Called with every resource replaced or appended, even one that is already the resource at its
+             position, i.e. edited in place: it is not the resource of the original file any more
+    """
+
+    def __init__(self, resources: List[Dict[str, Any]],
+                 changed: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        self.resources = resources
+        self.changed = changed
+        self._by_key: Dict[Tuple, Bucket] = {}
+        self._by_field: Dict[str, Dict[Any, Bucket]] = {field: {} for field in INDEXED_FIELDS}
+        self.rebuild()
+
+    def __len__(self) -> int:
+        return len(self.resources)
+
+    def header(self, position: int) -> Dict[str, Any]:
+        """The indexed fields of the resource at the position, without decoding it if the list is lazy"""
+        header = getattr(self.resources, "header", None)
+        return header(position) if header is not None else self.resources[position]
+
+    @staticmethod
+    def _value(resource: Dict[str, Any], field: str):
+        value = resource.get(field, _MISSING)
+        return value if type(value) is str or _hashable(value) else _MISSING
+
+    def _values(self, resource: Dict[str, Any]) -> Tuple:
+        """The values of the INDEXED_FIELDS of a resource"""
+        return tuple(self._value(resource, field) for field in INDEXED_FIELDS)
+
+    def _add(self, position: int, resource: Dict[str, Any]) -> None:
+        module, mode, resource_type, name = values = self._values(resource)
+        self._put(self._by_key, (module, resource_type, name), position)
+        for buckets, value in zip(self._by_field.values(), values):
+            self._put(buckets, value, position)
+
+    def _discard(self, position: int, resource: Dict[str, Any]) -> None:
+        module, mode, resource_type, name = values = self._values(resource)
+        self._drop(self._by_key, (module, resource_type, name), position)
+        for buckets, value in zip(self._by_field.values(), values):
+            self._drop(buckets, value, position)
+
+    @staticmethod
+    def _put(buckets: Dict[Any, Bucket], value, position: int) -> None:
+        bucket = buckets.get(value)
+        if bucket is None:
+            buckets[value] = position
+        elif isinstance(bucket, int):
+            buckets[value] = {bucket: None, position: None}
+        else:
+            bucket[position] = None
+
+    @staticmethod
+    def _drop(buckets: Dict[Any, Bucket], value, position: int) -> None:
+        bucket = buckets.get(value)
+        if bucket is None:
+            return
+        if isinstance(bucket, int):
+            if bucket == position:
+                del buckets[value]
+            return
+        bucket.pop(position, None)
+        if not bucket:
+            del buckets[value]
+
+    @staticmethod
+    def _positions(bucket: Bucket) -> Collection[int]:
+        return (bucket,) if isinstance(bucket, int) else bucket
+
+    def rebuild(self) -> None:
+        """Re-indexes the whole resources list. O(n), used after the positions have shifted"""
+        self._by_key.clear()
+        for values in self._by_field.values():
+            values.clear()
+        for position in range(len(self.resources)):
+            self._add(position, self.header(position))
+
+    def values(self, field: str) -> List[Any]:
+        """Returns the distinct values of an indexed field, e.g. all the module addresses of the state"""
+        return [value for value in self._by_field[field] if value is not _MISSING]
+
+    def _buckets(self, query: Dict[str, Any]) -> Tuple[Optional[List[Collection[int]]], Dict[str, Any]]:
+        """
+        Splits the query into the index buckets it can be answered from and the residual part that
+        has to be checked against the resources themselves.
+        Returns (None, ...) when an indexed field has no resource at all, i.e. nothing can match.
+        """
+        buckets, residual = [], {}
+        if all(field in query and _hashable(query[field]) for field in ("module", "type", "name")):
+            bucket = self._by_key.get(tuple(query[field] for field in ("module", "type", "name")))
+            if bucket is None:
+                return None, residual
+            buckets.append(self._positions(bucket))
+            query = {field: value for field, value in query.items() if field not in ("module", "type", "name")}
+
+        for field, value in query.items():
+            if field not in self._by_field or not _hashable(value):
+                residual[field] = value
+                continue
+            bucket = self._by_field[field].get(value)
+            if bucket is None:
+                return None, residual
+            buckets.append(self._positions(bucket))
+        return buckets, residual
+
+    def find(self, query: Dict[str, Any]) -> List[int]:
+        """
+        Returns the positions of the resources matching the query, in the state order.
+
+        :param query: (dict) The exact-match query, e.g. {"name": "nlb", "module": "module.aws_networking[0]"}
+        :rtype: List[int]
+        """
+        buckets, residual = self._buckets(query)
+        if buckets is None:
+            return []
+        if not buckets:
+            candidates: Iterable[int] = range(len(self.resources))
+        else:
+            buckets.sort(key=len)
+            candidates = (position for position in buckets[0] if all(position in b for b in buckets[1:]))
+        if residual:
+            candidates = (position for position in candidates if matches(self.resources[position], residual))
+        return sorted(candidates)
+
+    def get(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [self.resources[position] for position in self.find(query)]
+
+    def replace(self, position: int, resource: Dict[str, Any]) -> None:
+        self._discard(position, self.header(position))
+        self.resources[position] = resource
+        self._add(position, resource)
+        if self.changed is not None:
+            self.changed(resource)
+
+    def append(self, resource: Dict[str, Any]) -> int:
+        self.resources.append(resource)
+        position = len(self.resources) - 1
+        self._add(position, resource)
+        if self.changed is not None:
+            self.changed(resource)
+        return position
+
+    def delete(self, positions: Iterable[int]) -> List[Dict[str, Any]]:
+        """
+        Deletes the resources at the given positions and re-indexes the remaining ones.
+        The list is changed in place, so the state dict keeps referring to it.
+
+        :return: The deleted resources
+        """
+        positions = sorted(set(positions))
+        deleted = [self.resources[position] for position in positions]
+        for position in reversed(positions):
+            del self.resources[position]
+        self.rebuild()
+        return deleted
@@ -0,0 +1,70 @@
+"""
+Locates the resources of a Terraform State file without decoding it
+"""
+import re
+from typing import List, Tuple, Optional, NamedTuple
+
+# Terraform writes its states indented by 2 spaces. JSON strings can not contain raw new lines, so in
+# such a file every line that starts with exactly 4 spaces followed by { or } opens or closes an
+# element of a top-level array, and the first line "  ]" after "resources" closes that array.
+# The pattern starts with the new line rather than ^, a literal prefix the regex engine searches for fast
+RESOURCES_OPEN = b'\n  "resources": [\n'
+RESOURCES_CLOSE = b'\n  ]'
+RESOURCE_BOUNDARY = re.compile(rb'\n    ([{}])')
+SEPARATOR = b',\n    '
+
+
+class ResourceLayout(NamedTuple):
+    """
+    Byte layout of the resources of a state file
+    spans: The (start, end) offsets of every element of "resources", end excluded
+    """
+    spans: List[Tuple[int, int]]
+
+    @property
+    def head_end(self) -> int:
+        """Everything before the first resource"""
+        return self.spans[0][0]
+
+    @property
+    def tail_start(self) -> int:
+        """Everything after the last resource"""
+        return self.spans[-1][1]
+
+
+def scan_resources(buf) -> Optional[ResourceLayout]:
+    """
+    Finds the byte span of every top-level resource of a state file
+
+    :param buf: The content of the state file (bytes, bytearray, mmap)
+    :return: The layout, or None if the file is not laid out the way Terraform writes it
+             (e.g. minified) or has no resources
+    """
+    opening = buf.find(RESOURCES_OPEN)
+    if opening < 0:
+        return None
+    start = opening + len(RESOURCES_OPEN)
+    end = buf.find(RESOURCES_CLOSE, start)
+    if end < 0:
+        return None
+
+    spans, resource_start = [], None
+    for match in RESOURCE_BOUNDARY.finditer(buf, start - 1, end + 1):
+        if match.group(1) == b'{':
+            if resource_start is not None:
+                return None
+            resource_start = match.start(1)
+        else:
+            if resource_start is None:
+                return None
+            spans.append((resource_start, match.end(1)))
+            resource_start = None
+
+    if resource_start is not None or not spans or spans[0][0] != start + 4:
+        return None
+    for (_, previous_end), (next_start, _) in zip(spans, spans[1:]):
+        if buf[previous_end:next_start] != SEPARATOR:
+            return None
+    if spans[-1][1] != end:
+        return None
+    return ResourceLayout(spans=spans)
@@ -0,0 +1,391 @@
+"""
+Long-lived worker keeping the parsed Terraform States in memory between requests, served over HTTP on a Unix socket
+only its owner can connect to, or on a localhost port with a token:
+
+    python main.py --serve --env nonprod
+    curl -s --unix-socket ~/.local/share/tf-state-change/server.sock localhost/query \\
+        -d '{"state": "a.tfstate", "select": "**.aws_lb.nlb"}'
+    python main.py --serve --port 8765 --env nonprod
+    curl -s -H "Authorization: Bearer $(cat ~/.local/share/tf-state-change/server.token)" localhost:8765/diff \\
+        -d '{"states": ["a.tfstate", "b.tfstate"]}'
+
+Requests are JSON objects; "env" defaults to the env the server was started with. "plans" are names of the
+built-in plans or of the plan files of the plans directory, "dst" a directory under the output directory.
+    GET  /stats                                      the cache and the phases of the requests so far
+    POST /query  {"state", "select" | "query", "addresses"}
+    POST /swap   {"states": [source, target], "plans", "dry_run", "dst"}
+    POST /diff   {"states": [before, after]}
+    POST /save   {"state", "dst"}
+"""
+import hmac
+import json
+import os
+import re
+import secrets
+import signal
+import socketserver
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple, NamedTuple
+
+import logging
+
+import metrics
+import storage
+from dependency_graph import resource_address
+from state_diff import to_dict
+from state_errors import SchemaError, DataNotFoundError, TFStateChangeError, ObjectNotFoundError, AccessDeniedError
+from swap_plan import PLANS_DIR, PLAN_EXTENSIONS, SwapPlan, run_plans
+from tf_state import TerraformState
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.local', 'share', 'tf-state-change')
+DEFAULT_SOCKET = os.path.join(STATE_DIR, 'server.sock')
+DEFAULT_TOKEN_FILE = os.path.join(STATE_DIR, 'server.token')
+PLAN_NAME = re.compile(r'^[\w-]+$')
+# Memory a parsed state takes per byte of its file, kept in memory as downloaded (measured on generated states)
+MEMORY_FACTOR = {"full": 4.0, "lazy": 1.75}
+
+
+class _Entry(NamedTuple):
+    state: TerraformState
+    etag: str
+    size: int
+
+
+class StateCache:
+    """
+    The parsed states, the least recently used evicted first once their estimated memory exceeds max_bytes.
+    A cached state is used only while its ETag is still the one of the stored object, so a state changed by
+    anyone else is downloaded and parsed again.
+
+    Every state has a lock: the requests on a state run one at a time, those on different states concurrently.
+    """
+
+    def __init__(self, max_bytes: int = 2048 * MB, save_mode: str = "full", lazy: bool = False) -> None:
+        self.max_bytes = max_bytes
+        self.save_mode = save_mode
+        self.lazy = lazy
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Tuple[str, str, str], _Entry]' = OrderedDict()
+        self._locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        # misses: states loaded for the first time or after they were evicted, stale: loaded again after they changed
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    @staticmethod
+    def key(name: str, env: Optional[str]) -> Tuple[str, str, str]:
+        return storage.get_backend(env).bucket, storage.get_prefix(env), name
+
+    def lock(self, key: Tuple[str, str, str]) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def get(self, name: str, env: Optional[str]) -> TerraformState:
+        """
+        The parsed state, revalidated against the ETag of the stored object. The caller holds the lock of the state
+
+        :raises ObjectNotFoundError: if the state does not exist
+        """
+        key = self.key(name, env)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            if entry.state.backend.head(f'{key[1]}/{name}').etag == entry.etag:
+                with self._lock:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                return entry.state
+            logger.info('%s changed since it was parsed (ETag %s), it is loaded again', name, entry.etag)
+        with self._lock:
+            self.stats["stale" if entry is not None else "misses"] += 1
+        state = TerraformState(filename=name, env=env, save_mode=self.save_mode, lazy=self.lazy, in_memory=True)
+        if not state.download():
+            raise ObjectNotFoundError(f'{key[1]}/{name}')
+        state.load()
+        size = int(len(state.buffer) * MEMORY_FACTOR["lazy" if self.lazy else "full"])
+        with self._lock:
+            self._entries[key] = _Entry(state, state.etag, size)
+            self._entries.move_to_end(key)
+            self._evict()
+        return state
+
+    def evict(self, name: str, env: Optional[str]) -> None:
+        """Forgets a state, e.g. one changed in memory that is not the stored object any more"""
+        with self._lock:
+            self._entries.pop(self.key(name, env), None)
+
+    def _evict(self) -> None:
+        size = self.size
+        while size > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            size -= entry.size
+            self.stats["evictions"] += 1
+            logger.info('Evicted %s from the state cache', key[2])
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "states": [key[2] for key in self._entries], "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+
+class StateService:
+    """
+    The operations of the API on the cached states
+
+    :param output_dir: The directory the states are saved under, the "dst" of a request is a directory in it
+    :param plans_dir: A directory of plan files the requests may name, besides the built-in plans
+    """
+
+    def __init__(self, cache: StateCache, env: Optional[str] = None, output_dir: str = 'modified',
+                 plans_dir: Optional[str] = None) -> None:
+        self.cache = cache
+        self.env = env
+        self.output_dir = os.path.realpath(output_dir)
+        self.plans_dirs = [directory for directory in (plans_dir, PLANS_DIR) if directory]
+
+    def _plan(self, name: Any) -> SwapPlan:
+        """A plan by name, never by path: the plan files are the ones of the plans directories"""
+        if not isinstance(name, str) or not PLAN_NAME.match(name):
+            raise SchemaError(f'plan: {name}', 'expected the name of a plan of the plans directory')
+        for directory in self.plans_dirs:
+            for extension in PLAN_EXTENSIONS:
+                path = os.path.join(directory, f'{name}{extension}')
+                if os.path.exists(path):
+                    return SwapPlan.load(path)
+        raise SchemaError(f'plan: {name}', f'no such plan in {", ".join(self.plans_dirs)}')
+
+    def _destination(self, request: Dict[str, Any]) -> str:
+        """
+        The directory to save to: the "dst" of the request under the output directory
+
+        :raises PermissionError: if "dst" is outside of the output directory
+        """
+        dst = request.get("dst", "")
+        if not isinstance(dst, str):
+            raise SchemaError(f'dst: {dst}', 'expected a directory under the output directory')
+        path = os.path.realpath(os.path.join(self.output_dir, dst))
+        if os.path.commonpath([path, self.output_dir]) != self.output_dir:
+            raise PermissionError(f'{dst} is not under the output directory {self.output_dir}')
+        return path
+
+    def _names(self, request: Dict[str, Any], field: str, count: int) -> List[str]:
+        names = request.get(field)
+        names = [names] if isinstance(names, str) else names
+        if not isinstance(names, list) or len(names) != count or not all(isinstance(n, str) for n in names):
+            raise SchemaError(f'{field}: {names}', f'expected {count} state name(s)')
+        return names
+
+    def _locked(self, names: List[str], env: Optional[str]) -> List[threading.Lock]:
+        """The locks of the states, always taken in the same order so two requests can not wait on each other"""
+        keys = sorted({self.cache.key(name, env) for name in names})
+        return [self.cache.lock(key) for key in keys]
+
+    def query(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        env = request.get("env", self.env)
+        name, = self._names(request, "state", 1)
+        with _Holding(self._locked([name], env)):
+            state = self.cache.get(name, env)
+            if "select" in request:
+                resources = state.select(request["select"])
+            elif isinstance(request.get("query"), dict):
+                resources = state.getByQuery(request["query"])
+            else:
+                raise SchemaError('query', 'expected "select": <selector expression> or "query": {<field>: <value>}')
+            if request.get("addresses"):
+                return {"addresses": [resource_address(resource) for resource in resources]}
+            return {"resources": resources}
+
+    def swap(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        env = request.get("env", self.env)
+        names = self._names(request, "states", 2)
+        plans = [self._plan(plan) for plan in request.get("plans", ["kafka"])]
+        dry_run = bool(request.get("dry_run", False))
+        dst = self._destination(request)
+        with _Holding(self._locked(names, env)):
+            state_a, state_b = (self.cache.get(name, env) for name in names)
+            # A changed state is not the stored object any more: uploaded, it has a new ETag, in a dry run
+            # it differs from it. The source is only read and stays cached, unless the swap fails half-way
+            changed = [state_a, state_b]
+            try:
+                changed = run_plans(plans, state_a, state_b)
+                for target in changed:
+                    if dry_run:
+                        target.save(dst=dst)
+                    else:
+                        target.upload()
+            finally:
+                for state in changed:
+                    self.cache.evict(state.name, env)
+        return {"targets": [target.name for target in changed], "dry_run": dry_run}
+
+    def diff(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        env = request.get("env", self.env)
+        names = self._names(request, "states", 2)
+        with _Holding(self._locked(names, env)):
+            state_a, state_b = (self.cache.get(name, env) for name in names)
+            return to_dict(state_a.diff(state_b))
+
+    def save(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        env = request.get("env", self.env)
+        name, = self._names(request, "state", 1)
+        dst = self._destination(request)
+        with _Holding(self._locked([name], env)):
+            state = self.cache.get(name, env)
+            state.save(dst=dst)
+        return {"path": os.path.join(dst, state.object, state.name)}
+
+    def stats(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        return {"cache": self.cache.report(), "phases": metrics.get_recorder().report()}
+
+
+class _Holding:
+    """Holds several locks for the time of a block"""
+
+    def __init__(self, locks: List[threading.Lock]) -> None:
+        self.locks = locks
+
+    def __enter__(self) -> None:
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+
+# The HTTP status of the errors of a request
+STATUS = [(SchemaError, 400), (json.JSONDecodeError, 400), (DataNotFoundError, 404), (ObjectNotFoundError, 404),
+          (TFStateChangeError, 409), (AccessDeniedError, 403), (PermissionError, 403)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    routes = {("GET", "/stats"): "stats", ("POST", "/query"): "query", ("POST", "/swap"): "swap",
+              ("POST", "/diff"): "diff", ("POST", "/save"): "save"}
+
+    def _authorized(self) -> bool:
+        """A server with a token requires it as a bearer token of every request"""
+        token = getattr(self.server, "token", None)
+        if token is None:
+            return True
+        return hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}')
+
+    def _handle(self, method: str) -> None:
+        if not self._authorized():
+            self._reply(401, {"error": 'Missing or wrong token, see the token file of the server'})
+            return
+        operation = self.routes.get((method, self.path.split('?')[0]))
+        if operation is None:
+            self._reply(404, {"error": f'{method} {self.path} is not an operation of the API'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise SchemaError('request', 'expected a JSON object')
+            self._reply(200, getattr(self.server.service, operation)(request))
+        except (Exception, SystemExit) as e:
+            status = next((code for error, code in STATUS if isinstance(e, error)), 500)
+            if status == 500:
+                logger.exception('%s %s failed', method, self.path)
+            self._reply(status, {"error": f'{type(e).__name__}: {e}'})
+
+    def _reply(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info('%s - %s', self.address_string(), format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _private(path: str) -> None:
+    """Creates the directory of a file only its owner can access"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+
+def _unix_server(socket_path: str) -> _UnixHTTPServer:
+    """A server on a Unix socket only its owner can connect to, created with those permissions"""
+    _private(socket_path)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    umask = os.umask(0o177)
+    try:
+        server = _UnixHTTPServer(socket_path, _Handler)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+    server.token = None
+    return server
+
+
+def _tcp_server(port: int, token_file: str) -> ThreadingHTTPServer:
+    """A server on a localhost port, with a new token written to a file only its owner can read"""
+    _private(token_file)
+    token = secrets.token_urlsafe(32)
+    descriptor = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as file:
+        file.write(token)
+    os.chmod(token_file, 0o600)
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.token = token
+    logger.info('The requests need the token of %s: "Authorization: Bearer <token>"', token_file)
+    return server
+
+
+def _interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(service: StateService, port: Optional[int] = None, socket_path: str = DEFAULT_SOCKET,
+          token_file: str = DEFAULT_TOKEN_FILE) -> None:
+    """
+    Serves the API until interrupted or terminated, on a Unix socket with 0600 permissions or, given a port,
+    on localhost with a token every request has to send. The socket or the token file is removed on exit
+
+    :param port: Serve on this localhost port instead of the Unix socket
+    :param token_file: Where the token of the localhost port is written, readable by its owner only
+    """
+    if port is not None:
+        server = _tcp_server(port, token_file)
+        address = f'http://127.0.0.1:{port}'
+    else:
+        server = _unix_server(socket_path)
+        address = socket_path
+    server.service = service
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _interrupt)
+    logger.info('Serving the states on %s, saving them under %s', address, service.output_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopped')
+    finally:
+        server.server_close()
+        path = token_file if port is not None else socket_path
+        if os.path.exists(path):
+            os.remove(path)
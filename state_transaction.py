@@ -0,0 +1,189 @@
+"""
+Batched edit session of a Terraform State
+"""
+from typing import Dict, Any, List, Optional, Callable
+
+import logging
+
+import metrics
+from dependency_graph import resource_address
+from state_errors import SchemaError, DataNotFoundError, TFStateChangeError
+
+logger = logging.getLogger(__name__)
+
+
+class StateTransaction:
+    """
+    Stages changes of a TerraformState in memory and applies them all at once.
+
+    Nothing is touched until commit(): the staged operations are applied to the state in the order they
+    were staged and the state is serialized exactly once. If any operation fails, the state is restored
+    and no file is written. rollback() discards everything that is staged.
+
+    Usage:
+        with state.transaction() as tx:
+            tx.replace({"name": "nlb"}, new_resource=resource)
+            tx.delete({"name": "nlb_domain"})
+    """
+
+    def __init__(self, state) -> None:
+        self.state = state
+        self._ops: List[Callable[[], None]] = []
+        self.closed = False
+
+    def __enter__(self) -> 'StateTransaction':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        if self.closed:
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def _stage(self, op: Callable[[], None]) -> 'StateTransaction':
+        if self.closed:
+            raise TFStateChangeError('The transaction is already committed or rolled back')
+        self._ops.append(op)
+        return self
+
+    def _find(self, query: Dict[str, Any]) -> List[int]:
+        positions = self.state.index.find(query)
+        if not positions:
+            logger.error('There is no resource matching the given filter %s in the state %s',
+                         query, self.state.name)
+            raise DataNotFoundError(query)
+        return positions
+
+    def add(self, new_resource: Dict[str, Any]) -> 'StateTransaction':
+        """Appends a new resource to the state"""
+
+        def op():
+            logger.info('Append a new resource %s.%s to %s', new_resource.get('type'), new_resource.get('name'),
+                        self.state.name)
+            logger.debug('The appended resource: %s', new_resource)
+            self.state.index.append(new_resource)
+
+        return self._stage(op)
+
+    def replace(self, query: Dict[str, Any], new_resource: Dict[str, Any]) -> 'StateTransaction':
+        """Replaces every resource matching the query by new_resource"""
+
+        def op():
+            for position in self._find(query):
+                resource = self.state.index.resources[position]
+                if not set(new_resource.keys()).issubset(resource.keys()):
+                    raise SchemaError(
+                        "original resource keys: " + ",".join(sorted(list(resource.keys()))),
+                        "new_resource keys: " + ",".join(sorted(list(new_resource.keys()))),
+                    )
+                self.state.index.replace(position, new_resource)
+                logger.info('The resource %s is replaced in %s', query, self.state.name)
+                logger.debug('The resource %s is replaced in %s by: %s',
+                             query, self.state.name, new_resource)
+
+        return self._stage(op)
+
+    def put(self, new_resource: Dict[str, Any]) -> 'StateTransaction':
+        """Replaces the resource with the same address (module, mode, type and name) or appends it if there is none"""
+
+        def op():
+            address = resource_address(new_resource)
+            index = self.state.index
+            same_name = index.find({"type": new_resource["type"], "name": new_resource["name"]})
+            positions = [position for position in same_name if resource_address(index.header(position)) == address]
+            for position in positions:
+                index.replace(position, new_resource)
+            if not positions:
+                index.append(new_resource)
+            logger.info('The resource %s is %s in %s', address, "replaced" if positions else "added", self.state.name)
+
+        return self._stage(op)
+
+    def set_instances(self, query: Dict[str, Any], new_instances: List[Dict[str, Any]]) -> 'StateTransaction':
+        """Replaces the instances of every resource matching the query"""
+
+        def op():
+            for position in self._find(query):
+                resource = self.state.index.resources[position]
+                self.state.index.replace(position, {**resource, "instances": new_instances})
+                logger.info('The resource %s is updated with %s instances', query, len(new_instances))
+                logger.debug('The instances of %s: %s', query, new_instances)
+
+        return self._stage(op)
+
+    def set_instance_attr(self,
+                          query: Dict[str, Any],
+                          attribute_key: str,
+                          attribute_value,
+                          where: Optional[Dict[str, Any]] = None) -> 'StateTransaction':
+        """
+        Sets an attribute of the instances of every resource matching the query
+
+        :param query: (dict) The query on which the resource to select, e.g. {"name": "nlb_broker_listeners"}
+        :param attribute_key: (str) The attribute name, e.g. "default_action"
+        :param attribute_value: The new value of the attribute
+        :param where: (dict) Only the instances whose attributes match it are changed, e.g. {"port": 9092}.
+                      All the instances by default
+        """
+
+        def op():
+            for position in self._find(query):
+                resource = self.state.index.resources[position]
+                instances = []
+                for instance in resource["instances"]:
+                    attributes = instance["attributes"]
+                    if where is None or all(attributes.get(k) == v for k, v in where.items()):
+                        instance = {**instance, "attributes": {**attributes, attribute_key: attribute_value}}
+                        logger.debug('Instance: %s - Set attribute %s',
+                                     instance.get('index_key'), attribute_key)
+                    instances.append(instance)
+                # The resource is copied rather than changed in place so that a rollback can restore it
+                self.state.index.replace(position, {**resource, "instances": instances})
+
+        return self._stage(op)
+
+    def delete(self, query: Dict[str, Any]) -> 'StateTransaction':
+        """Deletes every resource matching the query"""
+
+        def op():
+            found = self.state.index.delete(self._find(query))
+            logger.info('Deleted %s resources matching %s from %s', len(found), query, self.state.name)
+            logger.debug('The deleted resources: %s', found)
+
+        return self._stage(op)
+
+    def commit(self) -> bool:
+        """
+        Applies the staged operations and serializes the state once (see TerraformState.flush)
+
+        :return: True if the state was changed
+        """
+        ops, self._ops = self._ops, []
+        self.closed = True
+        if not ops:
+            return False
+
+        resources = self.state.index.resources
+        original = resources.copy()
+        try:
+            with metrics.span("mutate", resources=len(ops)):
+                for op in ops:
+                    op()
+        except Exception:
+            resources[:] = original
+            self.state.index.rebuild()
+            raise
+        self.state.flush()
+        return True
+
+    def rollback(self) -> None:
+        """Discards the staged operations"""
+        logger.info('Discard %s staged changes of %s', len(self._ops), self.state.name)
+        self._ops = []
+        self.closed = True
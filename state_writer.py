@@ -0,0 +1,130 @@
+"""
+Writes Terraform States the way Terraform does: JSON indented by 2 spaces with <, > and & escaped
+"""
+import json
+from typing import Dict, Any, Iterator, TextIO, BinaryIO, List, Callable, Optional
+
+from state_scanner import SEPARATOR
+
+# Terraform (Go's encoding/json) escapes these characters in strings. They can not appear outside
+# of strings in JSON, so translating the encoded text is the same as escaping the strings.
+HTML_ESCAPES = str.maketrans({"<": "\\u003c", ">": "\\u003e", "&": "\\u0026"})
+
+INDENT = 2
+CHUNK_SIZE = 64 * 1024
+
+
+def encode(value: Any, level: int = 0) -> str:
+    """
+    Encodes a value the way json.dump(indent=2) encodes it at the given nesting level, escaped
+
+    :param value: The value to encode
+    :param level: The nesting level of the value in the document, e.g. 2 for an element of "resources"
+    :rtype: str
+    """
+    text = json.dumps(value, indent=INDENT)
+    if level and "\n" in text:
+        text = text.replace("\n", "\n" + " " * (INDENT * level))
+    return text.translate(HTML_ESCAPES)
+
+
+def encode_resource(resource: Dict[str, Any]) -> str:
+    """Encodes an element of the "resources" list of the state"""
+    return encode(resource, level=2)
+
+
+def iter_state(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Yields the escaped JSON of the state piece by piece, one resource at a time.
+    The concatenated pieces are byte-identical to json.dump(state, indent=2) followed by inplace_change().
+    """
+    if not state:
+        yield "{}"
+        return
+
+    separator = "{"
+    for key, value in state.items():
+        yield f'{separator}\n{" " * INDENT}{encode(key)}: '
+        separator = ","
+        if key == "resources" and not len(value):
+            yield "[]"
+        elif key == "resources":
+            element_separator = "["
+            for resource in value:
+                yield f'{element_separator}\n{" " * INDENT * 2}{encode_resource(resource)}'
+                element_separator = ","
+            yield f'\n{" " * INDENT}]'
+        else:
+            yield encode(value, level=1)
+    yield "\n}"
+
+
+def dump_state(state: Dict[str, Any], fp: TextIO, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Streams the escaped state to a file object, buffering up to chunk_size characters per write
+
+    :return: The number of characters written
+    """
+    buffer, buffered, written = [], 0, 0
+    for piece in iter_state(state):
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= chunk_size:
+            fp.write("".join(buffer))
+            written += buffered
+            buffer, buffered = [], 0
+    if buffer:
+        fp.write("".join(buffer))
+        written += buffered
+    return written
+
+
+def iter_spliced(source, layout, resources: List[Dict[str, Any]], origin: Callable[[int], Optional[int]]) \
+        -> Iterator[bytes]:
+    """
+    Yields the state as the original file with only the changed resources re-encoded.
+    Runs of resources that are unchanged and still in their original order are copied verbatim,
+    separators included, so untouched bytes stay exactly as they were downloaded.
+
+    :param source: The content of the original state file
+    :param layout: The ResourceLayout of the original state file
+    :param resources: The current resources of the state
+    :param origin: Returns the position in the original file of the resource at the given position
+                   if it is unchanged, None if it is new. Unchanged resources are never accessed
+    """
+    source = memoryview(source)
+    spans = layout.spans
+    yield source[:layout.head_end]
+
+    run_first = run_last = None
+    for position in range(len(resources)):
+        original = origin(position)
+        if original is not None and run_last is not None and original == run_last + 1:
+            run_last = original
+            continue
+        if run_first is not None:
+            yield source[spans[run_first][0]:spans[run_last][1]]
+        if position:
+            yield SEPARATOR
+        if original is not None:
+            run_first = run_last = original
+        else:
+            run_first = run_last = None
+            yield encode_resource(resources[position]).encode('utf-8')
+    if run_first is not None:
+        yield source[spans[run_first][0]:spans[run_last][1]]
+
+    yield source[layout.tail_start:]
+
+
+def dump_spliced(source, layout, resources: List[Dict[str, Any]], origin: Callable[[int], Optional[int]],
+                 fp: BinaryIO) -> int:
+    """
+    Writes the state to a binary file object splicing the changed resources into the original file
+
+    :return: The number of bytes written
+    """
+    written = 0
+    for piece in iter_spliced(source, layout, resources, origin):
+        written += fp.write(piece)
+    return written
@@ -0,0 +1,323 @@
+"""
+Where the Terraform States are downloaded from and uploaded to: an S3 bucket, a local directory or memory.
+boto3 is imported by the S3 backend only, the first time it transfers an object, so local runs never load it.
+"""
+import abc
+import contextlib
+import hashlib
+import os
+import threading
+from typing import Dict, Any, List, NamedTuple, Optional, Iterator
+
+import logging
+
+import s3_transfer
+from state_errors import SchemaError, ObjectNotFoundError, TFStateChangeError, AccessDeniedError
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("s3", "local", "memory")
+DEFAULT_ROOT = 'storage'
+# The bucket and the key prefix of the states of every env
+ENVIRONMENTS = {
+    "nonprod": {"bucket": '20210324-jarvis-platform-dev-states', "prefix": 'jarvis-nonprod'},
+    "prod": {"bucket": '20210517-jarvis-platform-prod-states', "prefix": 'jarvis-prod'},
+}
+
+
+class ObjectInfo(NamedTuple):
+    """The metadata of a stored object. The ETag changes whenever the object does"""
+    etag: str
+    version_id: Optional[str]
+    size: int
+
+
+@contextlib.contextmanager
+def replacing(filename: str) -> Iterator[str]:
+    """
+    Yields a temporary path next to the file to write it to, the file is then replaced by it at once.
+    A file is never rewritten in place: whoever reads or maps the previous one, e.g. another pair of a manifest
+    with the same source state, keeps its content
+    """
+    tmp_path = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class StorageBackend(abc.ABC):
+    """
+    The objects of a bucket, by key. A missing object raises ObjectNotFoundError,
+    an object the credentials do not give access to AccessDeniedError, an object that is not the version
+    a download asks for any more TFStateChangeError.
+
+    remote: The objects are transferred over the network, so it pays to cache them locally
+    """
+    remote = False
+
+    def __init__(self, bucket: str) -> None:
+        self.bucket = bucket
+
+    @abc.abstractmethod
+    def head(self, key: str) -> ObjectInfo:
+        pass
+
+    def download_file(self, key: str, filename: str, info: Optional[ObjectInfo] = None) -> int:
+        """
+        :param info: The object as head() returned it. That version is downloaded, and if the object changed
+                     since, the download fails rather than returning other content than the ETag stands for
+        :return: The number of bytes downloaded. The file is replaced rather than rewritten, see replacing
+        """
+        data = self.download_bytes(key, info=info)
+        with replacing(filename) as tmp_path:
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+        return len(data)
+
+    @abc.abstractmethod
+    def download_bytes(self, key: str, info: Optional[ObjectInfo] = None) -> bytes:
+        """:param info: See download_file"""
+
+    @staticmethod
+    def _changed(key: str, info: ObjectInfo, etag: str) -> TFStateChangeError:
+        return TFStateChangeError(f'{key} changed while it was downloaded (ETag {info.etag} -> {etag}), '
+                                  f'download it again')
+
+    def upload_file(self, filename: str, key: str) -> int:
+        """:return: The number of bytes uploaded"""
+        with open(filename, 'rb') as file:
+            return self.upload_bytes(file.read(), key)
+
+    @abc.abstractmethod
+    def upload_bytes(self, data: bytes, key: str) -> int:
+        pass
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> List[str]:
+        """The keys starting with <prefix>/, sorted"""
+
+    def __str__(self) -> str:
+        return f'{type(self).__name__}({self.bucket})'
+
+
+class S3Backend(StorageBackend):
+    """A bucket of S3 or of an S3 compatible endpoint, through the shared client of s3_transfer"""
+    remote = True
+
+    @staticmethod
+    def _translate(key: str, error) -> Exception:
+        code = error.response['Error']['Code']
+        if code in ("404", "NoSuchKey"):
+            return ObjectNotFoundError(key)
+        if code in ("400", "403", "AccessDenied"):
+            return AccessDeniedError(key)
+        if code in ("412", "PreconditionFailed"):
+            return TFStateChangeError(f'{key} changed while it was downloaded, download it again')
+        return error
+
+    def _call(self, name: str, function, *args, **kwargs):
+        """Calls an s3_transfer function, translating the errors about the object <name>"""
+        from botocore.exceptions import ClientError
+        try:
+            return function(*args, **kwargs)
+        except ClientError as e:
+            raise self._translate(name, e) from e
+
+    def head(self, key: str) -> ObjectInfo:
+        head = self._call(key, s3_transfer.head_object, bucket=self.bucket, key=key)
+        return ObjectInfo(etag=head['ETag'], version_id=head.get('VersionId'), size=head.get('ContentLength', 0))
+
+    @staticmethod
+    def _expected(info: Optional[ObjectInfo]) -> Dict[str, Any]:
+        """The arguments of the s3_transfer downloads that make them conditional on the ETag"""
+        return {} if info is None else {"version_id": info.version_id, "etag": info.etag, "size": info.size}
+
+    def download_file(self, key: str, filename: str, info: Optional[ObjectInfo] = None) -> int:
+        with replacing(filename) as tmp_path:
+            return self._call(key, s3_transfer.download_file, bucket=self.bucket, key=key, filename=tmp_path,
+                              **self._expected(info)).bytes
+
+    def download_bytes(self, key: str, info: Optional[ObjectInfo] = None) -> bytes:
+        return self._call(key, s3_transfer.download_bytes, bucket=self.bucket, key=key, **self._expected(info))
+
+    def upload_file(self, filename: str, key: str) -> int:
+        return self._call(key, s3_transfer.upload_file, filename=filename, bucket=self.bucket, key=key).bytes
+
+    def upload_bytes(self, data: bytes, key: str) -> int:
+        return self._call(key, s3_transfer.upload_bytes, data=data, bucket=self.bucket, key=key).bytes
+
+    def list(self, prefix: str) -> List[str]:
+        paginator = s3_transfer.get_client().get_paginator('list_objects_v2')
+        keys = []
+        for page in self._call(prefix, lambda: list(paginator.paginate(Bucket=self.bucket, Prefix=f'{prefix}/'))):
+            keys.extend(item['Key'] for item in page.get('Contents', ()))
+        return sorted(keys)
+
+    def __str__(self) -> str:
+        return f's3://{self.bucket}'
+
+
+class LocalBackend(StorageBackend):
+    """
+    The objects of a bucket as files under <root>/<bucket>, e.g. for offline runs.
+    The ETag is made of the modification time and the size of the file, so it changes whenever the file is replaced
+    """
+
+    def __init__(self, bucket: str, root: str = DEFAULT_ROOT) -> None:
+        super().__init__(bucket)
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, self.bucket, *key.split('/'))
+
+    @staticmethod
+    def _info(stat: os.stat_result) -> ObjectInfo:
+        return ObjectInfo(etag=f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', version_id=None, size=stat.st_size)
+
+    def head(self, key: str) -> ObjectInfo:
+        try:
+            return self._info(os.stat(self._path(key)))
+        except FileNotFoundError:
+            raise ObjectNotFoundError(key)
+        except PermissionError:
+            raise AccessDeniedError(key)
+
+    def download_bytes(self, key: str, info: Optional[ObjectInfo] = None) -> bytes:
+        try:
+            with open(self._path(key), 'rb') as file:
+                # The files are replaced, never rewritten: the open file is the version its ETag stands for
+                etag = self._info(os.fstat(file.fileno())).etag
+                if info is not None and etag != info.etag:
+                    raise self._changed(key, info, etag)
+                return file.read()
+        except FileNotFoundError:
+            raise ObjectNotFoundError(key)
+        except PermissionError:
+            raise AccessDeniedError(key)
+
+    def upload_bytes(self, data: bytes, key: str) -> int:
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except PermissionError:
+            raise AccessDeniedError(key)
+        return len(data)
+
+    def list(self, prefix: str) -> List[str]:
+        directory = self._path(prefix)
+        keys = []
+        for parent, _, names in os.walk(directory):
+            relative = os.path.relpath(parent, directory)
+            keys.extend("/".join(part for part in (prefix, relative, name) if part and part != '.')
+                        for name in names if not name.endswith('.tmp'))
+        return sorted(keys)
+
+    def __str__(self) -> str:
+        return os.path.join(self.root, self.bucket)
+
+
+class MemoryBackend(StorageBackend):
+    """The objects of a bucket in a dict, e.g. for tests"""
+
+    def __init__(self, bucket: str, objects: Optional[Dict[str, bytes]] = None) -> None:
+        super().__init__(bucket)
+        self.objects: Dict[str, bytes] = {} if objects is None else objects
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _info(data: bytes) -> ObjectInfo:
+        return ObjectInfo(etag=f'"{hashlib.md5(data).hexdigest()}"', version_id=None, size=len(data))
+
+    def head(self, key: str) -> ObjectInfo:
+        return self._info(self.download_bytes(key))
+
+    def download_bytes(self, key: str, info: Optional[ObjectInfo] = None) -> bytes:
+        with self._lock:
+            if key not in self.objects:
+                raise ObjectNotFoundError(key)
+            data = self.objects[key]
+        if info is not None and self._info(data).etag != info.etag:
+            raise self._changed(key, info, self._info(data).etag)
+        return data
+
+    def upload_bytes(self, data: bytes, key: str) -> int:
+        with self._lock:
+            self.objects[key] = bytes(data)
+        return len(data)
+
+    def list(self, prefix: str) -> List[str]:
+        with self._lock:
+            return sorted(key for key in self.objects if key.startswith(f'{prefix}/'))
+
+    def __str__(self) -> str:
+        return f'memory://{self.bucket}'
+
+
+_lock = threading.Lock()
+_backends: Dict[tuple, StorageBackend] = {}
+_settings = {"backend": "s3", "root": DEFAULT_ROOT, "bucket": None, "prefix": None}
+
+
+def configure(backend: Optional[str] = None, root: Optional[str] = None, bucket: Optional[str] = None,
+              prefix: Optional[str] = None) -> None:
+    """
+    Sets up where the states of the run are stored
+
+    :param backend: "s3", "local" or "memory"
+    :param root: The directory of the buckets of the local backend
+    :param bucket: The bucket of the states, instead of the one of their env
+    :param prefix: The key prefix of the states, instead of the one of their env
+    """
+    if backend is not None and backend not in BACKENDS:
+        raise SchemaError(f'storage backend: {backend}', f'expected one of: {",".join(BACKENDS)}')
+    updates = {"backend": backend, "root": root, "bucket": bucket, "prefix": prefix}
+    with _lock:
+        _settings.update({key: value for key, value in updates.items() if value is not None})
+        _backends.clear()
+
+
+def settings() -> Dict[str, Any]:
+    """The arguments of configure() the storage was set up with, e.g. to set worker processes up alike"""
+    with _lock:
+        return dict(_settings)
+
+
+def _environment(env: Optional[str], field: str) -> str:
+    if _settings[field] is not None:
+        return _settings[field]
+    if env not in ENVIRONMENTS:
+        raise SchemaError(f'env: {env}', f'expected one of: {",".join(ENVIRONMENTS)}, or a configured {field}')
+    return ENVIRONMENTS[env][field]
+
+
+def get_prefix(env: Optional[str]) -> str:
+    """The key prefix of the states of an env"""
+    return _environment(env, "prefix")
+
+
+def get_backend(env: Optional[str]) -> StorageBackend:
+    """
+    The backend of the bucket of an env, one per bucket until the storage is configured again.
+    The objects of a memory bucket live as long as its backend
+    """
+    bucket = _environment(env, "bucket")
+    with _lock:
+        key = (_settings["backend"], _settings["root"], bucket)
+        backend = _backends.get(key)
+        if backend is None:
+            if _settings["backend"] == "s3":
+                backend = S3Backend(bucket)
+            elif _settings["backend"] == "local":
+                backend = LocalBackend(bucket, root=_settings["root"])
+            else:
+                backend = MemoryBackend(bucket)
+            _backends[key] = backend
+            logger.debug('Storing the states of %s in %s', env, backend)
+        return backend
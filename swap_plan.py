@@ -0,0 +1,272 @@
+"""
+Declarative swap plans: which resources to copy between two Terraform States and what to keep from the target
+"""
+import json
+import os
+from typing import Dict, Any, List, Tuple, Sequence, Union, NamedTuple, Optional
+
+import logging
+
+import dependency_graph
+from dependency_graph import config_address, resource_address, resource_dependencies
+from instance_join import join_instances
+from state_errors import SchemaError, TFStateChangeError
+
+logger = logging.getLogger(__name__)
+
+PLANS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plans')
+PLAN_EXTENSIONS = ('.json', '.yaml', '.yml')
+DIRECTIONS = ("a_to_b", "b_to_a")
+VALIDATIONS = ("off", "warn", "error")
+
+
+class SwapRule:
+    """
+    One resource of a plan
+
+    select: (dict) The query of the resource, e.g. {"name": "nlb", "module": "module.aws_networking[0]"}
+    keep_instance_attributes: (list) Instance attributes whose values are kept from the target, e.g. ["default_action"]
+    match_instances_by: (str or list) How the source and target instances are matched to keep them, e.g. "port"
+    closure: (str) Also copy the resources the selected one transitively depends on ("dependencies"),
+             the ones depending on it ("dependents") or both ("both"). They are replaced in the target
+             or added to it if it does not have them
+    """
+
+    def __init__(self, select: Dict[str, Any], keep_instance_attributes: Sequence[str] = (),
+                 match_instances_by: Union[str, Sequence[str]] = "index_key", closure: Optional[str] = None,
+                 put: bool = False) -> None:
+        if closure is not None and closure not in dependency_graph.DIRECTIONS:
+            raise SchemaError(f'plan resource closure: {closure}',
+                              f'expected one of: {",".join(dependency_graph.DIRECTIONS)}')
+        self.select = select
+        self.keep_instance_attributes = list(keep_instance_attributes)
+        self.match_instances_by = match_instances_by
+        self.closure = closure
+        # Resources of a closure are matched by address and added when the target does not have them
+        self.put = put
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'SwapRule':
+        unknown = set(data) - {"select", "keep_instance_attributes", "match_instances_by", "closure"}
+        if "select" not in data or unknown:
+            raise SchemaError("plan resource keys: " + ",".join(sorted(data)),
+                              "expected: select[,keep_instance_attributes,match_instances_by,closure]")
+        match_by = data.get("match_instances_by", "index_key")
+        return cls(select=data["select"], keep_instance_attributes=data.get("keep_instance_attributes", ()),
+                   match_instances_by=match_by if isinstance(match_by, str) else tuple(match_by),
+                   closure=data.get("closure"))
+
+    def __repr__(self) -> str:
+        return f'SwapRule({self.select})'
+
+
+class SwapPlan:
+    """
+    A named list of resources to copy from the source state to the target state.
+    direction: "a_to_b" copies from the first state to the second one, "b_to_a" the other way round
+    validate_dependencies: What to do when a copied resource depends on a resource the target state does
+                           not have: "warn" (default), "error" to refuse the plan, or "off"
+    """
+
+    def __init__(self, name: str, rules: List[SwapRule], direction: str = "a_to_b", description: str = "",
+                 validate_dependencies: str = "warn") -> None:
+        if direction not in DIRECTIONS:
+            raise SchemaError(f'plan {name} direction: {direction}', f'expected one of: {",".join(DIRECTIONS)}')
+        if validate_dependencies not in VALIDATIONS:
+            raise SchemaError(f'plan {name} validate_dependencies: {validate_dependencies}',
+                              f'expected one of: {",".join(VALIDATIONS)}')
+        self.name = name
+        self.rules = rules
+        self.direction = direction
+        self.description = description
+        self.validate_dependencies = validate_dependencies
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], name: str = None) -> 'SwapPlan':
+        if not isinstance(data.get("resources"), list):
+            raise SchemaError(f'plan {data.get("name", name)} has no "resources" list')
+        return cls(name=data.get("name", name),
+                   rules=[SwapRule.from_dict(rule) for rule in data["resources"]],
+                   direction=data.get("direction", "a_to_b"),
+                   description=data.get("description", ""),
+                   validate_dependencies=data.get("validate_dependencies", "warn"))
+
+    @classmethod
+    def load(cls, name_or_path: str) -> 'SwapPlan':
+        """
+        Loads a built-in plan by name (see builtin_plans) or a plan file, JSON or YAML.
+        An argument is a file only if it has a plan extension or a directory, e.g. "kafka" is always the built-in
+        plan whatever is in the working directory, "./kafka" or "kafka.json" a file.
+        YAML plans need PyYAML to be installed.
+        """
+        if is_plan_file(name_or_path):
+            path = name_or_path
+            if not os.path.isfile(path):
+                raise TFStateChangeError(f'No such plan file: {name_or_path}')
+        else:
+            path = os.path.join(PLANS_DIR, f'{name_or_path}.json')
+            if not os.path.isfile(path):
+                raise TFStateChangeError(f'No such plan: {name_or_path}. Built-in plans: {", ".join(builtin_plans())}')
+
+        with open(path, 'r', encoding='utf-8') as file:
+            if path.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise TFStateChangeError(f'PyYAML is required to read the plan {path}: pip install pyyaml')
+                data = yaml.safe_load(file)
+            else:
+                data = json.load(file)
+        name = os.path.splitext(os.path.basename(path))[0]
+        logger.debug('Loaded the plan %s from %s', name, path)
+        return cls.from_dict(data, name=name)
+
+
+def is_plan_file(name_or_path: str) -> bool:
+    """Whether a plan argument is the path of a plan file rather than the name of a built-in plan"""
+    separators = (os.sep, os.altsep) if os.altsep else (os.sep,)
+    return name_or_path.endswith(PLAN_EXTENSIONS) or any(separator in name_or_path for separator in separators)
+
+
+def builtin_plans() -> List[str]:
+    """The names of the plans shipped in the plans directory"""
+    return sorted(os.path.splitext(name)[0] for name in os.listdir(PLANS_DIR) if name.endswith('.json'))
+
+
+def merge_plans(plans: List[SwapPlan]) -> SwapPlan:
+    """Compiles plans of the same direction into one, so they are applied in a single pass"""
+    directions = {plan.direction for plan in plans}
+    if len(directions) > 1:
+        raise TFStateChangeError(f'Plans of different directions can not be merged: {[p.name for p in plans]}')
+    return SwapPlan(name="+".join(plan.name for plan in plans),
+                    rules=[rule for plan in plans for rule in plan.rules],
+                    direction=directions.pop() if directions else "a_to_b",
+                    description="; ".join(plan.description for plan in plans if plan.description),
+                    validate_dependencies=max((plan.validate_dependencies for plan in plans),
+                                              key=VALIDATIONS.index, default="warn"))
+
+
+def extract(plan: SwapPlan, source) -> List[Tuple[SwapRule, Dict[str, Any]]]:
+    """
+    The read pass over the source state: looks every resource of the plan up in the source index,
+    then adds the resources of the closures the plan asks for, each resource once
+
+    :raises DataNotFoundError: if a resource of the plan is not in the source state
+    :return: (rule, source resource) for every rule of the plan, then for every resource of the closures
+    """
+    extracted = []
+    for rule in plan.rules:
+        found = source.getByQuery(rule.select)
+        if len(found) > 1:
+            logger.warning('%s resources match %s in %s, the first one is copied',
+                           len(found), rule.select, source.name)
+        extracted.append((rule, found[0]))
+
+    copied = {resource_address(resource) for _, resource in extracted}
+    for rule in plan.rules:
+        if not rule.closure:
+            continue
+        graph = source.dependencyGraph()
+        for position in graph.closure(source.index.find(rule.select)[:1], direction=rule.closure):
+            address = graph.address[position]
+            if address not in copied:
+                copied.add(address)
+                extracted.append((SwapRule(select={"address": address}, put=True), source.dict['resources'][position]))
+                logger.info('%s is copied with the %s of %s', address, rule.closure, rule.select)
+    return extracted
+
+
+def check_dependencies(plan: SwapPlan, extracted: List[Tuple[SwapRule, Dict[str, Any]]],
+                       target) -> Dict[str, List[str]]:
+    """
+    Flags the copied resources that depend on resources the target state will not have
+
+    :raises TFStateChangeError: if there are any and the plan validates its dependencies with "error"
+    :return: {address of the copied resource: [addresses it depends on that are missing in the target]}
+    """
+    available = dependency_graph.addresses(target.dict['resources'])
+    available.update(config_address(resource_address(resource)) for _, resource in extracted)
+    dangling = {}
+    for _, resource in extracted:
+        missing = [address for address in resource_dependencies(resource) if address not in available]
+        if missing:
+            dangling[resource_address(resource)] = missing
+    if dangling:
+        message = f'The plan {plan.name} copies resources depending on resources missing in {target.name}: {dangling}'
+        if plan.validate_dependencies == "error":
+            raise TFStateChangeError(message)
+        logger.warning('%s', message)
+    return dangling
+
+
+class Snapshot(NamedTuple):
+    """
+    The resources of a plan extracted once from a source state, to be applied to any number of target states.
+    The resources are shared by every target, not copied: apply() never edits them, it replaces the target
+    resources by them or by shallow copies with the kept instance attributes.
+    """
+    plan: SwapPlan
+    source: str
+    entries: Tuple[Tuple[SwapRule, Dict[str, Any]], ...]
+
+
+def snapshot(plans: List[SwapPlan], source) -> Snapshot:
+    """
+    Extracts the resources of the plans from the source state in one read pass
+
+    :raises TFStateChangeError: if a plan copies to the source ("b_to_a"), it has no single source then
+    """
+    backwards = [plan.name for plan in plans if plan.direction != "a_to_b"]
+    if backwards:
+        raise TFStateChangeError(f'Only "a_to_b" plans can be applied from one source to many targets: {backwards}')
+    plan = merge_plans(plans)
+    entries = tuple(extract(plan, source))
+    logger.info('Extracted %s resources of the plan %s from %s', len(entries), plan.name, source.name)
+    return Snapshot(plan=plan, source=source.name, entries=entries)
+
+
+def apply(plan: SwapPlan, extracted: List[Tuple[SwapRule, Dict[str, Any]]], target) -> int:
+    """
+    The update pass over the target state: every extracted resource replaces its counterpart in the target,
+    keeping the instance attributes the plan says to keep. All the replacements are one transaction.
+
+    :return: The number of replaced resources
+    """
+    if plan.validate_dependencies != "off":
+        check_dependencies(plan, extracted, target)
+    with target.transaction() as tx:
+        for rule, resource in extracted:
+            if rule.put:
+                tx.put(resource)
+                continue
+            if rule.keep_instance_attributes:
+                result = join_instances(left=resource["instances"],
+                                        right=target.getResourceInstances(query=rule.select),
+                                        attributes=rule.keep_instance_attributes,
+                                        match_by=rule.match_instances_by)
+                logger.info('%s: %s of %s instances keep their %s from %s', rule.select, len(result.matched),
+                            len(resource["instances"]), rule.keep_instance_attributes, target.name)
+                resource = {**resource, "instances": result.instances}
+            tx.replace(query=rule.select, new_resource=resource)
+    logger.info('The plan %s replaced %s resources in %s', plan.name, len(extracted), target.name)
+    return len(extracted)
+
+
+def run_plans(plans: List[SwapPlan], state_a, state_b) -> List[Any]:
+    """
+    Applies the plans to a pair of states. The plans of each direction are merged, so every
+    state is read once and updated in one transaction whatever the number of plans.
+
+    :return: The states that were changed, the ones to save
+    """
+    targets = []
+    for direction in DIRECTIONS:
+        selected = [plan for plan in plans if plan.direction == direction]
+        if not selected:
+            continue
+        source, target = (state_a, state_b) if direction == "a_to_b" else (state_b, state_a)
+        plan = merge_plans(selected)
+        logger.info('Applying the plan %s from %s to %s', plan.name, source.name, target.name)
+        apply(plan, extract(plan, source), target)
+        targets.append(target)
+    return targets
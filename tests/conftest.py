@@ -0,0 +1,48 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup_store  # noqa: E402
+import storage  # noqa: E402
+from state_writer import dump_state  # noqa: E402
+from tf_state import TerraformState  # noqa: E402
+
+PREFIX = 'jarvis-nonprod'
+
+
+def state_bytes(state):
+    """A state written the way Terraform does"""
+    buffer = io.StringIO()
+    dump_state(state, buffer)
+    return buffer.getvalue().encode('utf-8')
+
+
+@pytest.fixture(autouse=True)
+def no_backups():
+    backup_store.configure(enabled=False)
+    yield
+    backup_store.configure()
+
+
+@pytest.fixture
+def backend():
+    return storage.MemoryBackend('states')
+
+
+@pytest.fixture
+def load_state(backend, tmp_path, monkeypatch):
+    """Stores a state in the memory backend, then downloads and loads it like a run would"""
+    monkeypatch.chdir(tmp_path)
+
+    def load(name, state, **kwargs):
+        backend.upload_bytes(state_bytes(state), f'{PREFIX}/{name}')
+        tf_state = TerraformState(name, backend=backend, prefix=PREFIX, **kwargs)
+        tf_state.download()
+        tf_state.load()
+        return tf_state
+
+    return load
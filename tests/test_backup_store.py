@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+import backup_store
+import storage
+from backup_store import BackupStore, _Prefix, split_chunks
+from conftest import PREFIX, state_bytes
+from state_errors import TFStateChangeError
+from state_generator import generate_state
+
+KEY = 'states/jarvis-nonprod/a.tfstate'
+
+
+@pytest.fixture(params=["directory", "memory"])
+def store(request, tmp_path):
+    store = BackupStore(str(tmp_path / 'backups'))
+    if request.param == "memory":
+        store.objects = _Prefix(storage.MemoryBackend('backups'), 'store')
+    return store
+
+
+def stored_chunks(store):
+    indexes = [name for name in store.objects.list('packs') if name.endswith('.idx')]
+    return sum(len(json.loads(store.objects.get(name))) for name in indexes)
+
+
+def edited(state, position, **fields):
+    resources = list(state["resources"])
+    resources[position] = {**resources[position], **fields}
+    return {**state, "resources": resources}
+
+
+@pytest.mark.parametrize("data", [state_bytes(generate_state(resources=80)), b'', b'not a state' * 1000])
+def test_chunks_are_the_file(data):
+    assert b"".join(split_chunks(data)) == data
+
+
+def test_round_trip(store):
+    first = state_bytes(generate_state(resources=80))
+    second = state_bytes(edited(generate_state(resources=80), 5, name="renamed"))
+    ids = [store.snapshot(KEY, data, reason="upload") for data in (first, second)]
+
+    assert store.snapshots(KEY) == ids
+    assert store.restore(KEY, ids[0]) == first
+    assert store.restore(KEY) == second
+    assert store.manifest(KEY)["reason"] == "upload"
+
+
+def test_unchanged_state_is_not_stored_again(store):
+    data = state_bytes(generate_state(resources=80))
+    first = store.snapshot(KEY, data, reason="upload")
+    chunks = stored_chunks(store)
+
+    assert store.snapshot(KEY, data, reason="upload") == first
+    assert store.snapshots(KEY) == [first]
+    assert stored_chunks(store) == chunks
+
+
+@pytest.mark.parametrize("change", [
+    lambda state: edited(state, 40, name="renamed"),
+    lambda state: {**state, "resources": [{**state["resources"][3], "name": "added"}] + state["resources"]},
+    lambda state: {**state, "resources": state["resources"][1:]},
+])
+def test_snapshots_share_their_unchanged_chunks(store, change):
+    state = generate_state(resources=300)
+    store.snapshot(KEY, state_bytes(state), reason="upload")
+    chunks = stored_chunks(store)
+    changed = state_bytes(change(state))
+    snapshot_id = store.snapshot(KEY, changed, reason="upload")
+
+    # The changed resource and the separators and blocks of hashes around it, not the whole state again
+    assert stored_chunks(store) - chunks <= 5
+    assert store.restore(KEY, snapshot_id) == changed
+
+
+def test_missing_snapshot(store):
+    with pytest.raises(TFStateChangeError):
+        store.restore(KEY)
+    store.snapshot(KEY, b'{}', reason="upload")
+    with pytest.raises(TFStateChangeError):
+        store.restore(KEY, "20200101T000000000000Z-000000000000")
+
+
+def test_restore_checks_the_checksum(store):
+    snapshot_id = store.snapshot(KEY, state_bytes(generate_state(resources=20)), reason="upload")
+    name = f'snapshots/{KEY}/{snapshot_id}.json'
+    manifest = json.loads(store.objects.get(name))
+    store.objects.put(name, json.dumps({**manifest, "sha256": "0" * 64}).encode())
+
+    with pytest.raises(TFStateChangeError):
+        store.restore(KEY, snapshot_id)
+
+
+@pytest.fixture
+def backups(tmp_path):
+    backup_store.configure(location=str(tmp_path / 'backups'))
+    return backup_store.get_store()
+
+
+def test_upload_backs_up_and_rollback_restores(load_state, backend, backups):
+    original = state_bytes(generate_state(resources=30))
+    state = load_state('a.tfstate', json.loads(original), in_memory=True)
+    state.deleteByQuery({"name": "nlb_domain"})
+    assert state.upload()
+    changed = backend.download_bytes(f'{PREFIX}/a.tfstate')
+    assert changed != original
+
+    rolled_back = load_state('a.tfstate', json.loads(changed), in_memory=True)
+    rolled_back.rollback(dry_run=True)
+    assert backend.download_bytes(f'{PREFIX}/a.tfstate') == changed
+
+    rolled_back.rollback()
+    assert backend.download_bytes(f'{PREFIX}/a.tfstate') == original
+    # The rollback backed up the version it replaced, so it can be rolled back too
+    assert backups.restore(f'states/{PREFIX}/a.tfstate') == changed
+
+
+def test_delete_backs_up_the_downloaded_version(load_state, backend, backups, monkeypatch):
+    state = load_state('a.tfstate', generate_state(resources=30), in_memory=True)
+    downloaded = backend.download_bytes(f'{PREFIX}/a.tfstate')
+    state.updateInstanceAttr(state.getByQuery({"name": "nlb"})[0]["instances"][0], "arn", "arn:not-uploaded")
+    monkeypatch.setattr(state, "to_bytes", lambda: pytest.fail("the state is serialized"))
+    state.deleteByQuery({"name": "nlb_domain"})
+
+    assert backups.restore(f'states/{PREFIX}/a.tfstate') == downloaded
+
+
+def test_delete_without_backups_does_not_serialize(load_state, monkeypatch):
+    state = load_state('a.tfstate', generate_state(resources=30), in_memory=True)
+    monkeypatch.setattr(state, "to_bytes", lambda: pytest.fail("the state is serialized"))
+
+    assert state.deleteByQuery({"name": "nlb_domain"})
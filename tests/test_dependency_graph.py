@@ -0,0 +1,72 @@
+import pytest
+
+from dependency_graph import DependencyGraph, config_address, resource_address
+from state_errors import TFStateChangeError
+from state_generator import generate_state
+from swap_plan import SwapPlan, check_dependencies, extract, run_plans
+
+NLB = 'module.aws_networking.aws_lb.nlb'
+
+
+@pytest.mark.parametrize("address, expected", [
+    ('module.aws_networking[0].aws_lb.nlb', NLB),
+    ('module.m["k.[0]"].module.n[2].data.aws_ami.ubuntu', 'module.m.module.n.data.aws_ami.ubuntu'),
+    ('aws_lb.nlb', 'aws_lb.nlb'),
+])
+def test_config_address(address, expected):
+    assert config_address(address) == expected
+
+
+def test_generated_dependencies_are_configuration_addresses():
+    dependencies = [address for resource in generate_state(resources=200)["resources"]
+                    for instance in resource["instances"] for address in instance.get("dependencies", ())]
+    assert dependencies
+    assert all('[' not in address for address in dependencies)
+
+
+def test_edges_resolve_inside_counted_modules():
+    state = generate_state(resources=200)
+    graph = DependencyGraph(state["resources"])
+    nlb = graph.positions[NLB][0]
+
+    dependents = {graph.address[position] for position in graph.closure([nlb])}
+    assert 'module.aws_networking[0].aws_route53_record.nlb_domain' in dependents
+    assert 'module.aws_networking[0].aws_lb_listener.nlb_broker_listeners' in dependents
+    assert graph.dangling() == {}
+
+
+def test_dependencies_span_all_the_instances_of_a_module():
+    resources = [
+        {"module": f'module.az[{index}]', "mode": "managed", "type": "aws_subnet", "name": "private",
+         "instances": [{"attributes": {}}]} for index in range(2)]
+    resources.append({"mode": "managed", "type": "aws_lb", "name": "nlb",
+                      "instances": [{"attributes": {}, "dependencies": ['module.az.aws_subnet.private']}]})
+    graph = DependencyGraph(resources)
+
+    assert graph.dependencies(2) == [0, 1]
+    assert graph.dependents(1) == [2]
+
+
+def test_builtin_plan_is_not_refused(load_state):
+    state_a = load_state('a.tfstate', generate_state(resources=100, variant=1))
+    state_b = load_state('b.tfstate', generate_state(resources=100, variant=2))
+    plan = SwapPlan.load("kafka")
+    plan.validate_dependencies = "error"
+
+    assert check_dependencies(plan, extract(plan, state_a), state_b) == {}
+    assert run_plans([plan], state_a, state_b) == [state_b]
+
+
+def test_missing_dependency_is_refused(load_state):
+    state = generate_state(resources=10, variant=1)
+    state_a = load_state('a.tfstate', state)
+    target = generate_state(resources=10, variant=2)
+    target["resources"] = [resource for resource in target["resources"] if resource["name"] != "nlb"
+                           or resource_address(resource) != 'module.aws_networking[0].aws_lb.nlb']
+    state_b = load_state('b.tfstate', target)
+    plan = SwapPlan.load("kafka")
+    plan.rules = plan.rules[1:]
+    plan.validate_dependencies = "error"
+
+    with pytest.raises(TFStateChangeError, match=NLB):
+        check_dependencies(plan, extract(plan, state_a), state_b)
@@ -0,0 +1,72 @@
+import json
+import os
+
+import pytest
+
+import storage
+from conftest import state_bytes
+from fleet import PairJob, load_manifest, run_fan_out, run_fleet
+from state_errors import TFStateChangeError
+from state_generator import generate_state
+
+
+def manifest(tmp_path, pairs):
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps({"defaults": {"env": "nonprod"}, "pairs": [{"states": states} for states in pairs]}))
+    return str(path)
+
+
+def test_independent_pairs(tmp_path):
+    jobs = load_manifest(manifest(tmp_path, [["a", "b"], ["a", "c"], ["d", "e"]]))
+
+    assert [job.states for job in jobs] == [("a", "b"), ("a", "c"), ("d", "e")]
+
+
+@pytest.mark.parametrize("pairs", [
+    [["a", "b"], ["c", "b"]],
+    [["a", "b"], ["b", "c"]],
+    [["b", "c"], ["a", "b"]],
+    [["a", "b"], ["b", "a"]],
+    [["a", "a"]],
+])
+def test_pairs_changing_a_state_another_pair_reads(tmp_path, pairs):
+    with pytest.raises(TFStateChangeError):
+        load_manifest(manifest(tmp_path, pairs))
+
+
+def test_same_states_of_different_envs(tmp_path):
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps([{"states": ["a", "b"], "env": "nonprod"}, {"states": ["b", "c"], "env": "prod"}]))
+
+    assert len(load_manifest(str(path))) == 2
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    settings = storage.settings()
+    storage.configure(backend="local", root=str(tmp_path / 'storage'))
+    yield storage.get_backend("nonprod"), storage.get_prefix("nonprod")
+    storage.configure(**settings)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_pairs_sharing_a_source(local_storage, lazy):
+    backend, prefix = local_storage
+    for name, variant in (("a.tfstate", 1), ("b.tfstate", 2), ("c.tfstate", 3), ("d.tfstate", 4)):
+        backend.upload_bytes(state_bytes(generate_state(resources=200, variant=variant)), f'{prefix}/{name}')
+    jobs = [PairJob(states=("a.tfstate", target), env="nonprod", dry_run=True, lazy=lazy)
+            for target in ("b.tfstate", "c.tfstate", "d.tfstate")]
+
+    results = run_fleet(jobs, workers=3)
+
+    assert [result.error for result in results] == [None, None, None]
+    assert all(os.path.exists(os.path.join('modified', prefix, target)) for target in ("b.tfstate", "c.tfstate"))
+
+
+@pytest.mark.parametrize("targets", [["c", "c"], ["a"], ["b", "a"]])
+def test_fan_out_targets_changing_a_state_another_pair_reads(targets):
+    jobs = [PairJob(states=("a", target), env="nonprod") for target in targets]
+
+    with pytest.raises(TFStateChangeError):
+        run_fan_out(jobs)
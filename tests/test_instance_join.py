@@ -0,0 +1,62 @@
+import pytest
+
+from instance_join import join_instances
+from state_errors import TFStateChangeError
+
+
+def listener(index_key, port, protocol="TCP", action="forward", **attributes):
+    return {"index_key": index_key,
+            "attributes": {"port": port, "protocol": protocol, "default_action": [{"type": action}], **attributes}}
+
+
+def test_join_by_index_key():
+    left = [listener("a", 9092), listener("b", 9093)]
+    right = [listener("b", 1, action="redirect"), listener("a", 2, action="fixed")]
+    result = join_instances(left, right, "default_action")
+
+    assert [i["attributes"]["default_action"][0]["type"] for i in result.instances] == ["fixed", "redirect"]
+    assert [i["attributes"]["port"] for i in result.instances] == [9092, 9093]
+    assert result.matched == [("a",), ("b",)]
+    assert left[0]["attributes"]["default_action"] == [{"type": "forward"}]
+
+
+def test_join_by_composite_key():
+    left = [listener(0, 9092, "TCP"), listener(1, 9092, "TLS"), listener(2, 9093, "TCP")]
+    right = [listener(5, 9092, "TLS", action="tls"), listener(6, 9092, "TCP", action="tcp")]
+    result = join_instances(left, right, ["default_action"], match_by=("port", "protocol"))
+
+    assert [i["attributes"]["default_action"][0]["type"] for i in result.instances] == ["tcp", "tls", "forward"]
+    assert result.matched == [(9092, "TCP"), (9092, "TLS")]
+    assert result.unmatched_left == [(9093, "TCP")]
+
+
+def test_unmatched_on_both_sides():
+    left = [listener("a", 9092), listener("b", 9093)]
+    right = [listener("b", 1, action="b"), listener("c", 2, action="c")]
+    result = join_instances(left, right, "default_action")
+
+    assert result.instances[0] is left[0]
+    assert result.unmatched_left == [("a",)]
+    assert result.unmatched_right == [("c",)]
+
+
+def test_unhashable_key():
+    left = [listener("a", 9092, tags={"x": "1"}), listener("b", 9092, tags={"x": "2"})]
+    right = [listener("z", 1, action="two", tags={"x": "2"})]
+    result = join_instances(left, right, "default_action", match_by="tags")
+
+    assert [i["attributes"]["default_action"][0]["type"] for i in result.instances] == ["forward", "two"]
+
+
+@pytest.mark.parametrize("left, right", [
+    ([listener("a", 9092), listener("b", 9092)], [listener("c", 9092)]),
+    ([listener("a", 9092)], [listener("b", 9092), listener("c", 9092)]),
+])
+def test_duplicated_keys(left, right):
+    with pytest.raises(TFStateChangeError):
+        join_instances(left, right, "default_action", match_by="port")
+
+
+def test_missing_key():
+    with pytest.raises(KeyError):
+        join_instances([listener("a", 9092)], [listener("b", 9092)], "default_action", match_by="weight")
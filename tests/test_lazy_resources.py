@@ -0,0 +1,27 @@
+from dependency_graph import resource_address
+from state_generator import generate_state
+
+FIELDS = ("module", "mode", "type", "name", "provider")
+
+
+def test_headers_are_the_fields_of_the_resources(load_state):
+    state = load_state('a.tfstate', generate_state(resources=200), lazy=True)
+    resources = state.dict['resources']
+    headers = [resources.header(position) for position in range(len(resources))]
+
+    assert resources.decoded == 0
+    assert headers == [{field: r[field] for field in FIELDS if field in r} for r in generate_state(200)["resources"]]
+    assert any('["k0"]' in header.get("module", "") for header in headers)
+    assert any("module" not in header for header in headers)
+
+
+def test_lazy_index_finds_what_a_full_load_finds(load_state):
+    lazy = load_state('a.tfstate', generate_state(resources=200), lazy=True)
+    full = load_state('b.tfstate', generate_state(resources=200))
+    queries = [{"name": "nlb"}, {"type": "aws_lb_listener"}, {"mode": "data"}, {"module": 'module.m1_0["k0"]'},
+               {"module": "module.aws_networking[0]", "type": "aws_lb", "name": "nlb_service"}]
+
+    for query in queries:
+        assert lazy.index.find(query) == full.index.find(query)
+    assert [resource_address(r) for r in lazy.getByQuery({"name": "r7"})] == \
+           [resource_address(r) for r in full.getByQuery({"name": "r7"})]
@@ -0,0 +1,152 @@
+import re
+
+import pytest
+
+from selector import Predicate, Selector, compile_selector
+from state_errors import SchemaError
+from state_generator import generate_state
+from state_index import ResourceIndex
+
+
+def resource(module, resource_type, name, mode="managed", instances=()):
+    resource = {"mode": mode, "type": resource_type, "name": name, "provider": "aws", "instances": list(instances)}
+    return {"module": module, **resource} if module else resource
+
+
+def listener(port, protocol="TCP", **attributes):
+    return {"index_key": str(port), "attributes": {"port": port, "protocol": protocol, **attributes}}
+
+
+EXTRA = [
+    resource("module.prometheus[1].module.ingress[0]", "aws_lb", "nlb"),
+    resource("module.prometheus[0].module.ingress[1]", "aws_lb", "nlb"),
+    resource('module.prometheus["blue"].module.ingress[0]', "aws_lb", "nlb"),
+    resource("module.other[0].module.prometheus[0].module.ingress[0]", "aws_lb", "nlb"),
+    resource(None, "aws_lb", "nlb"),
+    resource(None, "aws_lb", "nlb", mode="data"),
+    resource("module.edge", "aws_lb_listener", "tls_listeners",
+             instances=[listener(443, "TLS", tags={"Name": "edge-443"}), listener(8443, "TLS"),
+                        listener(80, certificate_arn=None)]),
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return ResourceIndex(generate_state(resources=300)["resources"] + EXTRA)
+
+
+def modules(resource):
+    return resource.get("module", "")
+
+
+CASES = [
+    ("module.prometheus[*].module.ingress[0].aws_lb.nlb",
+     lambda r: re.fullmatch(r'module\.prometheus\[[^\]]*\]\.module\.ingress\[0\]', modules(r))
+     and r["type"] == "aws_lb" and r["name"] == "nlb" and r["mode"] == "managed"),
+    ("module.prometheus[0].module.ingress[0].aws_lb.nlb",
+     lambda r: modules(r) == "module.prometheus[0].module.ingress[0]" and r["type"] == "aws_lb"
+     and r["name"] == "nlb" and r["mode"] == "managed"),
+    ("**.module.prometheus[*].module.ingress[0].aws_lb.nlb",
+     lambda r: re.fullmatch(r'(.+\.)?module\.prometheus\[[^\]]*\]\.module\.ingress\[0\]', modules(r))
+     and r["type"] == "aws_lb" and r["name"] == "nlb" and r["mode"] == "managed"),
+    ("**.aws_lb.nlb", lambda r: r["type"] == "aws_lb" and r["name"] == "nlb" and r["mode"] == "managed"),
+    ("aws_lb.nlb", lambda r: not modules(r) and r["type"] == "aws_lb" and r["name"] == "nlb"
+     and r["mode"] == "managed"),
+    ("aws_lb", lambda r: not modules(r) and r["type"] == "aws_lb" and r["mode"] == "managed"),
+    ("aws_lb_target_group.*", lambda r: not modules(r) and r["type"] == "aws_lb_target_group"
+     and r["mode"] == "managed"),
+    ("data.aws_lb.nlb", lambda r: not modules(r) and r["type"] == "aws_lb" and r["name"] == "nlb"
+     and r["mode"] == "data"),
+    ("**.data.aws_iam_role.*", lambda r: r["type"] == "aws_iam_role" and r["mode"] == "data"),
+    ("**.aws_lb_listener.nlb_*_listeners",
+     lambda r: r["type"] == "aws_lb_listener" and re.fullmatch(r'nlb_.*_listeners', r["name"])
+     and r["mode"] == "managed"),
+    ("module.aws_networking[0].aws_route53_record./nlb_(domain|certificate_validation)/",
+     lambda r: modules(r) == "module.aws_networking[0]" and r["type"] == "aws_route53_record"
+     and r["name"] in ("nlb_domain", "nlb_certificate_validation") and r["mode"] == "managed"),
+    ("**.aws_?3_*.r1?",
+     lambda r: re.fullmatch(r'aws_.3_.*', r["type"]) and re.fullmatch(r'r1.', r["name"]) and r["mode"] == "managed"),
+    ("module.m1_0[*].module./m1_[0-9]/[1].*",
+     lambda r: re.fullmatch(r'module\.m1_0\[[^\]]*\]\.module\.m1_[0-9]\[1\]', modules(r)) and r["mode"] == "managed"),
+    ("**.module.m?_1[1].aws_iam_role",
+     lambda r: re.fullmatch(r'(.+\.)?module\.m._1\[1\]', modules(r)) and r["type"] == "aws_iam_role"
+     and r["mode"] == "managed"),
+    ("**./aws_lb(_listener)?/.missing", lambda r: False),
+]
+
+
+@pytest.mark.parametrize("expression, expected", CASES, ids=[case[0] for case in CASES])
+def test_find_is_a_scan(index, expression, expected):
+    scan = [position for position, resource in enumerate(index.resources) if expected(resource)]
+
+    assert Selector(expression).find(index) == scan
+    assert scan or expression.endswith("missing")
+
+
+PREDICATES = [
+    ("attributes.port in (9092, 9093)", lambda i: i["attributes"].get("port") in (9092, 9093)),
+    ("attributes.port not in (9092, 9093)", lambda i: "port" in i["attributes"]
+     and i["attributes"]["port"] not in (9092, 9093)),
+    ("attributes.port in 443", lambda i: i["attributes"].get("port") == 443),
+    ("attributes.protocol == 'TLS' and attributes.port > 500",
+     lambda i: i["attributes"].get("protocol") == "TLS" and i["attributes"].get("port", 0) > 500),
+    ("attributes.port >= 443 and attributes.port <= 9092", lambda i: 443 <= i["attributes"].get("port", 0) <= 9092),
+    ("attributes.protocol != \"TLS\"", lambda i: "protocol" in i["attributes"]
+     and i["attributes"]["protocol"] != "TLS"),
+    ("index_key ~ '^9'", lambda i: str(i.get("index_key", "")).startswith("9")),
+    ("attributes.tags.Name ~ 'edge-[0-9]+'",
+     lambda i: bool(re.search(r'edge-[0-9]+', i["attributes"].get("tags", {}).get("Name", "")))),
+    ("attributes.certificate_arn == null", lambda i: "certificate_arn" in i["attributes"]
+     and i["attributes"]["certificate_arn"] is None),
+    ("attributes.port < 'text'", lambda i: False),
+]
+
+
+@pytest.mark.parametrize("predicates, expected", PREDICATES, ids=[case[0] for case in PREDICATES])
+def test_select_with_predicates(index, predicates, expected):
+    selector = compile_selector(f'**.aws_lb_listener.* where {predicates}')
+    scan = []
+    for position, resource in enumerate(index.resources):
+        if resource["type"] == "aws_lb_listener" and resource["mode"] == "managed":
+            instances = [instance for instance in resource["instances"] if expected(instance)]
+            if instances:
+                scan.append((position, instances))
+
+    assert selector.select(index) == scan
+
+
+def test_select_without_predicates_keeps_resources_without_instances(index):
+    selected = Selector("**.aws_lb.nlb").select(index)
+
+    assert [position for position, _ in selected] == Selector("**.aws_lb.nlb").find(index)
+    assert any(instances == [] for _, instances in selected)
+
+
+def test_where_is_case_insensitive_and_split_outside_of_quotes():
+    selector = Selector("**.aws_lb_listener.* WHERE attributes.tags.Name == 'a and b' and index_key != 'x'")
+
+    assert [predicate.text for predicate in selector.predicates] == ["attributes.tags.Name == 'a and b'",
+                                                                      "index_key != 'x'"]
+    assert selector.predicates[0]({"attributes": {"tags": {"Name": "a and b"}}})
+
+
+def test_missing_field_does_not_match():
+    assert not Predicate("attributes.port == 80")({"attributes": {}})
+    assert not Predicate("attributes.port.value == 80")({"attributes": {"port": 80}})
+
+
+@pytest.mark.parametrize("expression", [
+    "",
+    "**",
+    "a.b.c",
+    "data",
+    "**.aws_lb./(unclosed/",
+    "**.aws_lb.nlb where",
+    "**.aws_lb.nlb where attributes.port",
+    "**.aws_lb.nlb where attributes.port === 1",
+    "**.aws_lb.nlb where attributes.port == undefined_name",
+    "**.aws_lb.nlb where 1port == 1",
+])
+def test_malformed_expressions(expression):
+    with pytest.raises(SchemaError):
+        Selector(expression)
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from state_generator import generate_state
+from swap_plan import SwapPlan, run_plans
+
+NLB = {"name": "nlb", "module": "module.aws_networking[0]"}
+MODES = [{"save_mode": "splice"}, {"save_mode": "splice", "in_memory": True}, {"lazy": True},
+         {"lazy": True, "in_memory": True}]
+
+
+def saved(state):
+    return json.loads(state.to_bytes())
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_output_is_the_one_of_a_full_save(load_state, mode):
+    results = []
+    for options in ({"in_memory": True}, mode):
+        state_a = load_state('a.tfstate', generate_state(resources=300, variant=1), **options)
+        state_b = load_state('b.tfstate', generate_state(resources=300, variant=2), **options)
+        run_plans([SwapPlan.load("kafka"), SwapPlan.load("prometheus")], state_a, state_b)
+        results.append(state_b.to_bytes())
+    assert results[1] == results[0]
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_resource_edited_in_place_is_saved(load_state, mode):
+    state = load_state('a.tfstate', generate_state(resources=50), **mode)
+    resource = state.getByQuery(NLB)[0]
+    resource["instances"][0]["attributes"]["arn"] = "arn:edited"
+    state.updateByQuery(NLB, new_resource=resource)
+
+    nlb = [r for r in saved(state)["resources"] if r["name"] == "nlb" and r.get("module") == NLB["module"]][0]
+    assert nlb["instances"][0]["attributes"]["arn"] == "arn:edited"
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_instance_helpers_edit_in_place(load_state, mode):
+    state = load_state('a.tfstate', generate_state(resources=50), **mode)
+    resource = state.getByQuery(NLB)[0]
+    state.updateInstanceAttr(resource["instances"][0], "arn", "arn:updated")
+    state.updateByQuery(NLB, new_resource=resource)
+
+    nlb = [r for r in saved(state)["resources"] if r["name"] == "nlb" and r.get("module") == NLB["module"]][0]
+    assert nlb == resource
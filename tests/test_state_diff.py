@@ -0,0 +1,137 @@
+import copy
+import json
+
+import pytest
+
+from state_diff import MISSING, diff_states, format_diff, state_hashes, to_dict
+from state_generator import generate_state
+
+NLB = 'module.aws_networking[0].aws_lb.nlb'
+LISTENERS = 'module.aws_networking[0].aws_lb_listener.nlb_broker_listeners'
+
+
+def listener(index_key, port, **attributes):
+    return {"index_key": index_key, "schema_version": 0, "attributes": {"port": port, **attributes}}
+
+
+def resource(name, instances, **fields):
+    return {"module": "module.aws_networking[0]", "mode": "managed", "type": "aws_lb_listener", "name": name,
+            "provider": "aws", "instances": instances, **fields}
+
+
+def by_address(resources, address):
+    return [r for r in resources if f'{r.get("module")}.{r["type"]}.{r["name"]}' == address][0]
+
+
+def test_hashes_ignore_key_order_and_formatting():
+    before = resource("a", [listener("80", 80, protocol="TCP")])
+    after = json.loads(json.dumps({key: before[key] for key in reversed(list(before))}, indent=4))
+    after["instances"][0]["attributes"] = {"protocol": "TCP", "port": 80}
+
+    assert state_hashes([before]) == state_hashes([after])
+    assert not diff_states([before], [after])
+
+
+def test_duplicated_addresses_are_suffixed():
+    resources = [resource("a", []), resource("b", []), resource("a", [listener("80", 80)]), resource("a", [])]
+    hashes = state_hashes(resources)
+    prefix = 'module.aws_networking[0].aws_lb_listener.'
+
+    assert list(hashes) == [prefix + 'a', prefix + 'b', prefix + 'a#2', prefix + 'a#3']
+    assert [digest.position for digest in hashes.values()] == [0, 1, 2, 3]
+    assert hashes[prefix + 'a'].digest == hashes[prefix + 'a#3'].digest
+
+    diff = diff_states(resources, resources[:3])
+    assert diff.removed == [prefix + 'a#3'] and not diff.added and not diff.changed
+
+
+def test_added_removed_and_changed_resources():
+    state = generate_state(resources=60)
+    resources_a = state["resources"]
+    resources_b = copy.deepcopy(resources_a)
+    nlb = by_address(resources_b, NLB)
+    nlb["provider"] = "provider[\"registry.terraform.io/hashicorp/aws\"].other"
+    nlb["instances"][0]["attributes"]["arn"] = "arn:changed"
+    del nlb["instances"][0]["attributes"]["tags"]
+    resources_b.remove(by_address(resources_b, 'module.aws_networking[0].aws_route53_record.nlb_domain'))
+    resources_b.append(resource("added", []))
+
+    diff = diff_states(resources_a, resources_b)
+
+    assert diff.added == ['module.aws_networking[0].aws_lb_listener.added']
+    assert diff.removed == ['module.aws_networking[0].aws_route53_record.nlb_domain']
+    assert [change.address for change in diff.changed] == [NLB]
+    change = diff.changed[0]
+    assert change.fields == {"provider": (by_address(resources_a, NLB)["provider"], nlb["provider"])}
+    assert not change.added and not change.removed
+    key = nlb["instances"][0].get("index_key")
+    before = by_address(resources_a, NLB)["instances"][0]["attributes"]
+    assert change.changed[0].key == key
+    assert change.changed[0].fields == {"attributes.arn": (before["arn"], "arn:changed"),
+                                        "attributes.tags": (before["tags"], MISSING)}
+
+
+def test_instances_are_matched_by_index_key():
+    before = resource("listeners", [listener("9092", 9092, protocol="TCP"), listener("9093", 9093),
+                                    listener("9094", 9094)])
+    after = resource("listeners", [listener("9095", 9095), listener("9093", 9093),
+                                   listener("9092", 9092, protocol="TLS")])
+    change, = diff_states([before], [after]).changed
+
+    assert change.fields == {}
+    assert change.added == ["9095"]
+    assert change.removed == ["9094"]
+    assert [(instance.key, instance.fields) for instance in change.changed] == \
+        [("9092", {"attributes.protocol": ("TCP", "TLS")})]
+
+
+def test_instances_with_non_unique_keys_are_matched_by_position():
+    before = resource("listeners", [listener(None, 80), listener(None, 443)])
+    after = resource("listeners", [listener(None, 80), listener(None, 8443), listener(None, 9000)])
+    change, = diff_states([before], [after]).changed
+
+    assert change.added == ["#2"]
+    assert [(instance.key, instance.fields) for instance in change.changed] == \
+        [("#1", {"attributes.port": (443, 8443)})]
+
+
+def test_reports():
+    before = resource("listeners", [listener("80", 80)])
+    after = resource("listeners", [listener("80", 81)])
+    diff = diff_states([before], [after])
+
+    assert json.loads(json.dumps(to_dict(diff)))["changed"][0]["instances"]["changed"][0]["fields"] == \
+        {"attributes.port": {"before": 80, "after": 81}}
+    assert format_diff(diff).splitlines()[-1] == "0 added, 0 removed, 1 changed"
+    assert format_diff(diff_states([before], [before])) == "No differences"
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_diff_of_loaded_states(load_state, lazy):
+    state_a = load_state('a.tfstate', generate_state(resources=200, variant=1), lazy=lazy, in_memory=True)
+    state_b = load_state('b.tfstate', generate_state(resources=200, variant=2), lazy=lazy, in_memory=True)
+    expected = diff_states(generate_state(resources=200, variant=1)["resources"],
+                           generate_state(resources=200, variant=2)["resources"])
+
+    diff = state_a.diff(state_b)
+
+    assert diff == expected
+    assert diff.changed and not diff.added and not diff.removed
+    if lazy:
+        # Only the resources whose hashes differ are decoded and kept
+        assert state_a.dict['resources'].decoded == len(diff.changed)
+        assert state_b.dict['resources'].decoded == len(diff.changed)
+
+
+def test_hashes_follow_the_changes_of_a_lazy_state(load_state):
+    state = load_state('a.tfstate', generate_state(resources=100), lazy=True, in_memory=True)
+    other = load_state('b.tfstate', generate_state(resources=100), lazy=True, in_memory=True)
+    assert not state.diff(other)
+
+    with state.transaction() as tx:
+        tx.set_instance_attr({"name": "nlb_broker_listeners"}, "protocol", "TLS", where={"port": 9092})
+    diff = state.diff(other)
+
+    assert [change.address for change in diff.changed] == [LISTENERS]
+    assert [(instance.key, instance.fields) for instance in diff.changed[0].changed] == \
+        [("9092", {"attributes.protocol": ("TLS", "TCP")})]
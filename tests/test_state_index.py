@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from state_generator import generate_state
+from state_index import ResourceIndex, matches
+
+QUERIES = [{"name": "nlb"}, {"type": "aws_lb_listener"}, {"mode": "data"}, {"module": "module.aws_networking[0]"},
+           {"module": "module.aws_networking[0]", "type": "aws_lb", "name": "nlb"}, {"module": None},
+           {"name": "nlb", "provider": "provider[\"registry.terraform.io/hashicorp/aws\"]"}, {"name": "missing"}]
+
+
+def scan(resources, query):
+    return [position for position, resource in enumerate(resources) if matches(resource, query)]
+
+
+def assert_consistent(index):
+    for query in QUERIES:
+        assert index.find(query) == scan(index.resources, query), query
+    fresh = ResourceIndex(index.resources)
+    for field in ("module", "mode", "type", "name"):
+        assert sorted(index.values(field), key=str) == sorted(fresh.values(field), key=str)
+
+
+@pytest.fixture
+def index():
+    return ResourceIndex(generate_state(resources=60)["resources"])
+
+
+def test_find_is_a_scan(index):
+    assert_consistent(index)
+    assert index.find({"name": "missing"}) == []
+
+
+def test_replace(index):
+    position = index.find({"name": "nlb"})[0]
+    index.replace(position, {**index.resources[position], "name": "renamed"})
+
+    assert position in index.find({"name": "renamed"})
+    assert position not in index.find({"name": "nlb"})
+    assert_consistent(index)
+
+
+def test_replace_a_unique_name_twice(index):
+    position = index.find({"name": "nlb"})[0]
+    index.replace(position, {**index.resources[position], "name": "unique"})
+    index.replace(position, {**index.resources[position], "name": "unique"})
+    index.replace(position, {**index.resources[position], "name": "nlb"})
+
+    assert index.find({"name": "unique"}) == []
+    assert_consistent(index)
+
+
+def test_append_shares_a_bucket(index):
+    position = index.find({"name": "nlb"})[0]
+    appended = index.append({**index.resources[position], "module": "module.other"})
+
+    assert index.find({"name": "nlb", "module": "module.other"}) == [appended]
+    assert appended in index.find({"name": "nlb"})
+    assert_consistent(index)
+
+
+def test_delete_shifts_the_positions(index):
+    deleted = index.delete(index.find({"name": "nlb"}) + [0])
+
+    assert deleted
+    assert index.find({"name": "nlb"}) == []
+    assert_consistent(index)
+
+
+def test_random_mutations():
+    generator = random.Random(7)
+    resources = generate_state(resources=40)["resources"]
+    index = ResourceIndex(list(resources))
+    for _ in range(300):
+        action = generator.choice(["replace", "replace", "append", "append", "delete"])
+        if action == "replace" and len(index):
+            position = generator.randrange(len(index))
+            name = generator.choice(["nlb", "x", "y", index.resources[position]["name"]])
+            index.replace(position, {**index.resources[position], "name": name})
+        elif action == "append":
+            index.append({**generator.choice(resources), "name": generator.choice(["nlb", "z"])})
+        elif len(index):
+            index.delete(generator.sample(range(len(index)), min(2, len(index))))
+        assert_consistent(index)
+
+
+def test_changed_is_called_for_the_same_resource():
+    changed = []
+    resources = generate_state(resources=10)["resources"]
+    index = ResourceIndex(resources, changed=changed.append)
+    index.replace(0, resources[0])
+    index.append(resources[1])
+
+    assert changed == [resources[0], resources[1]]
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from state_errors import SchemaError
+from state_server import StateCache, StateService
+
+
+@pytest.fixture
+def service(tmp_path):
+    plans = tmp_path / 'plans'
+    plans.mkdir()
+    (plans / 'mine.json').write_text('{"name": "mine", "resources": []}')
+    return StateService(StateCache(), output_dir=str(tmp_path / 'modified'), plans_dir=str(plans))
+
+
+def test_destination_under_output_dir(service):
+    assert service._destination({}) == service.output_dir
+    assert service._destination({"dst": "sub/dir"}) == os.path.join(service.output_dir, 'sub', 'dir')
+
+
+@pytest.mark.parametrize("dst", ["..", "../elsewhere", "sub/../../elsewhere", "/etc"])
+def test_destination_outside_output_dir(service, dst):
+    with pytest.raises(PermissionError):
+        service._destination({"dst": dst})
+
+
+def test_destination_symlink_out_of_output_dir(service, tmp_path):
+    os.makedirs(service.output_dir)
+    os.symlink(str(tmp_path), os.path.join(service.output_dir, 'link'))
+    with pytest.raises(PermissionError):
+        service._destination({"dst": "link"})
+
+
+def test_plan_by_name(service):
+    assert service._plan("mine").name == "mine"
+    assert service._plan("kafka").name == "kafka"
+
+
+@pytest.mark.parametrize("name", ["../plans/kafka", "/etc/passwd", "plans/kafka.json", "missing", 1])
+def test_plan_not_a_name(service, name):
+    with pytest.raises(SchemaError):
+        service._plan(name)
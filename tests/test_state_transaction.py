@@ -0,0 +1,64 @@
+import pytest
+
+from state_errors import DataNotFoundError, TFStateChangeError
+from state_generator import generate_state
+
+NLB = {"name": "nlb", "module": "module.aws_networking[0]"}
+MODES = [{}, {"in_memory": True}, {"save_mode": "splice", "in_memory": True}, {"lazy": True, "in_memory": True}]
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_failed_commit_restores_the_state(load_state, mode):
+    state = load_state('a.tfstate', generate_state(resources=50), **mode)
+    before = state.to_bytes()
+    count = len(state.index)
+
+    with pytest.raises(DataNotFoundError):
+        with state.transaction() as tx:
+            tx.set_instance_attr(NLB, "arn", "arn:changed")
+            tx.delete({"name": "nlb_domain"})
+            tx.add({"mode": "managed", "type": "aws_s3_bucket", "name": "new", "instances": []})
+            tx.delete({"name": "missing"})
+
+    assert state.to_bytes() == before
+    assert len(state.index) == count
+    assert state.index.find({"name": "new"}) == []
+    assert state.index.find({"name": "nlb_domain"})
+    assert state.getByQuery(NLB)[0]["instances"][0]["attributes"]["arn"] != "arn:changed"
+
+
+def test_commit_applies_in_order(load_state):
+    state = load_state('a.tfstate', generate_state(resources=50), in_memory=True)
+    with state.transaction() as tx:
+        tx.add({"mode": "managed", "type": "aws_s3_bucket", "name": "new", "instances": []})
+        tx.delete({"name": "new"})
+        tx.set_instance_attr(NLB, "arn", "arn:changed")
+
+    assert state.index.find({"name": "new"}) == []
+    assert state.getByQuery(NLB)[0]["instances"][0]["attributes"]["arn"] == "arn:changed"
+
+
+def test_rollback_discards_the_staged_changes(load_state):
+    state = load_state('a.tfstate', generate_state(resources=50), in_memory=True)
+    before = state.to_bytes()
+    tx = state.transaction()
+    tx.delete({"name": "nlb_domain"})
+    tx.rollback()
+
+    assert len(tx) == 0
+    assert state.to_bytes() == before
+    assert tx.commit() is False
+    with pytest.raises(TFStateChangeError):
+        tx.delete({"name": "nlb"})
+
+
+def test_exception_in_the_block_discards_the_staged_changes(load_state):
+    state = load_state('a.tfstate', generate_state(resources=50), in_memory=True)
+    before = state.to_bytes()
+
+    with pytest.raises(RuntimeError):
+        with state.transaction() as tx:
+            tx.delete({"name": "nlb_domain"})
+            raise RuntimeError("stop")
+
+    assert state.to_bytes() == before
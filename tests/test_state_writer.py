@@ -0,0 +1,78 @@
+import io
+import json
+
+import pytest
+
+from state_generator import generate_state
+from state_writer import dump_state, encode_resource, iter_state
+from tf_state import TerraformState
+
+RESOURCE = {
+    "module": "module.aws_networking[0]",
+    "mode": "managed",
+    "type": "aws_lb_listener",
+    "name": "nlb_<broker>_listeners",
+    "provider": "provider[\"registry.terraform.io/hashicorp/aws\"]",
+    "instances": [
+        {
+            "index_key": "a&b",
+            "schema_version": 0,
+            "attributes": {
+                "default_action": [{"forward": [], "target_group_arn": "arn:aws:<tg>&x", "order": 1}],
+                "tags": {},
+                "tags_all": {"<key>": "a > b && c < d"},
+                "ports": [9092, 9093],
+                "ratio": 0.5,
+                "enabled": True,
+                "certificate_arn": None,
+                "description": "café ✓",
+            },
+            "sensitive_attributes": [],
+            "dependencies": ["module.aws_networking.aws_lb.nlb"],
+        }
+    ],
+}
+
+STATES = {
+    "empty": {},
+    "no resources": {"version": 4, "terraform_version": "1.5.7", "serial": 1, "lineage": "x", "outputs": {},
+                     "resources": []},
+    "escaped": {"version": 4, "terraform_version": "1.5.7", "serial": 3, "lineage": "<&>",
+                "outputs": {"url": {"value": "https://a/?b=1&c=<2>", "type": "string"}},
+                "resources": [RESOURCE, {**RESOURCE, "name": "other", "instances": []}],
+                "check_results": None},
+    "generated": generate_state(resources=40),
+}
+
+
+def reference(state, path):
+    """What Terraform writes: json.dump(indent=2), then <, > and & escaped"""
+    with open(path, 'w') as file:
+        json.dump(state, file, indent=2)
+    TerraformState.inplace_change(str(path))
+    with open(path) as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("name", STATES)
+@pytest.mark.parametrize("chunk_size", [1, 64, 64 * 1024])
+def test_dump_is_json_dump_escaped(name, chunk_size, tmp_path):
+    buffer = io.StringIO()
+    written = dump_state(STATES[name], buffer, chunk_size=chunk_size)
+
+    assert buffer.getvalue() == reference(STATES[name], tmp_path / 'reference.json')
+    assert written == len(buffer.getvalue())
+
+
+def test_pieces_are_the_document(tmp_path):
+    state = STATES["escaped"]
+
+    assert "".join(iter_state(state)) == reference(state, tmp_path / 'reference.json')
+    assert "<" not in "".join(iter_state(state))
+    assert json.loads("".join(iter_state(state))) == state
+
+
+def test_resource_is_encoded_at_its_level(tmp_path):
+    text = reference({"resources": [RESOURCE]}, tmp_path / 'reference.json')
+
+    assert "    " + encode_resource(RESOURCE) in text
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import storage
+from lazy_resources import open_mapped
+from state_errors import TFStateChangeError, AccessDeniedError
+
+
+@pytest.fixture(params=["local", "memory"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        return storage.LocalBackend('states', root=str(tmp_path))
+    return storage.MemoryBackend('states')
+
+
+def test_download_of_the_version_of_the_head(backend):
+    backend.upload_bytes(b'{"serial": 1}', 'p/a.tfstate')
+    info = backend.head('p/a.tfstate')
+
+    assert backend.download_bytes('p/a.tfstate', info=info) == b'{"serial": 1}'
+
+
+def test_download_fails_if_the_object_changed_since_the_head(backend, tmp_path):
+    backend.upload_bytes(b'{"serial": 1}', 'p/a.tfstate')
+    info = backend.head('p/a.tfstate')
+    backend.upload_bytes(b'{"serial": 2}', 'p/a.tfstate')
+
+    with pytest.raises(TFStateChangeError):
+        backend.download_bytes('p/a.tfstate', info=info)
+    with pytest.raises(TFStateChangeError):
+        backend.download_file('p/a.tfstate', os.path.join(str(tmp_path), 'a.tfstate'), info=info)
+
+
+def test_s3_access_denied():
+    from botocore.exceptions import ClientError
+
+    def get_object():
+        raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, 'GetObject')
+
+    with pytest.raises(AccessDeniedError):
+        storage.S3Backend('states')._call('p/a.tfstate', get_object)
+
+
+def test_backends_implement_the_storage():
+    with pytest.raises(TypeError):
+        storage.StorageBackend('states')
+
+    class Partial(storage.StorageBackend):
+        def head(self, key):
+            return storage.ObjectInfo('"0"', None, 0)
+
+    with pytest.raises(TypeError):
+        Partial('states')
+
+
+def test_download_replaces_the_file(backend, tmp_path):
+    filename = os.path.join(str(tmp_path), 'a.tfstate')
+    backend.upload_bytes(b'{"serial": 1}', 'p/a.tfstate')
+    backend.download_file('p/a.tfstate', filename)
+    mapped = open_mapped(filename)
+    backend.upload_bytes(b'{"serial": 2, "lineage": "x"}', 'p/a.tfstate')
+    backend.download_file('p/a.tfstate', filename, info=backend.head('p/a.tfstate'))
+
+    assert mapped[:] == b'{"serial": 1}'
+    with open(filename, 'rb') as file:
+        assert file.read() == b'{"serial": 2, "lineage": "x"}'
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
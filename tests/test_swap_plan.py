@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from state_errors import TFStateChangeError
+from swap_plan import SwapPlan
+
+PLAN = {"name": "mine", "resources": [{"select": {"name": "nlb"}}]}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_builtin_plan_whatever_the_working_directory(workdir):
+    (workdir / 'kafka').mkdir()
+    (workdir / 'prometheus').write_text(json.dumps(PLAN))
+
+    assert SwapPlan.load("kafka").name == "kafka"
+    assert SwapPlan.load("prometheus").name == "prometheus"
+    assert len(SwapPlan.load("prometheus").rules) > 1
+
+
+@pytest.mark.parametrize("argument", ["mine.json", "./mine.json", "./prometheus", "plans/mine.json"])
+def test_plan_file(workdir, argument):
+    (workdir / 'plans').mkdir()
+    for path in ("mine.json", "prometheus", "plans/mine.json"):
+        (workdir / path).write_text(json.dumps(PLAN))
+
+    assert len(SwapPlan.load(argument).rules) == 1
+
+
+@pytest.mark.parametrize("argument", ["missing", "missing.json", "./kafka"])
+def test_no_such_plan(workdir, argument):
+    with pytest.raises(TFStateChangeError):
+        SwapPlan.load(argument)
@@ -1,43 +1,73 @@
 """
 Represents and stores information about Terraform State
 """
+import io
 import json
 import os
 import shutil
 from collections.abc import Mapping
-from typing import Dict, Any, List, Callable
-
-import boto3
-import botocore
+from typing import Dict, Any, List, Callable, BinaryIO
 
 import logging
 
-from state_errors import SchemaError, DataNotFoundError
+import backup_store
+import download_cache
+from dependency_graph import DependencyGraph
+from selector import compile_selector
+import metrics
+import storage
+from lazy_resources import LazyResourceList, open_mapped
+from state_errors import DataNotFoundError, TFStateChangeError, ObjectNotFoundError, AccessDeniedError
+from state_index import ResourceIndex
+from state_diff import StateDiff, diff_states, state_hashes
+from state_scanner import scan_resources
+from state_transaction import StateTransaction
+from state_writer import dump_state, dump_spliced
 
 logger = logging.getLogger(__name__)
 
 
 class TerraformState:
 
-    def __init__(self, filename, env="nonprod"):
+    def __init__(self, filename, env="nonprod", save_mode="full", lazy=False, in_memory=False, backend=None,
+                 prefix=None):
         """
         Init the Terraform State object
 
         :param name: The secret name
+        :param env: The env whose bucket and key prefix the state is in, unless the storage is configured with others
+        :param save_mode: "full" re-serializes the whole state on save,
+                          "splice" copies the unchanged resources verbatim from the downloaded file
+                          and serializes only the replaced and added ones
+        :param lazy: Memory-map the state file and decode a resource only when a query touches it.
+                     A lazy state is always saved by splicing
+        :param in_memory: Download the state into memory, edit it there and upload it from memory
+                          without writing any file. save() still writes the state to a directory
+        :param backend: The StorageBackend of the state, by default the one of the env (see storage.py)
+        :param prefix: The key prefix of the state, by default the one of the env
         """
 
         self.name = filename
-        self.s3_resource = boto3.resource('s3', region_name='us-east-1')
         self.dl_prefix = 'downloads'
         self.dict = None
+        self.index = None
         self.tmp_file = None
-
-        if env == "nonprod":
-            self.s3_bucket = self.s3_resource.Bucket('20210324-jarvis-platform-dev-states')
-            self.object = 'jarvis-nonprod'
-        elif env == "prod":
-            self.s3_bucket = self.s3_resource.Bucket('20210517-jarvis-platform-prod-states')
-            self.object = 'jarvis-prod'
+        self.save_mode = save_mode
+        self.lazy = lazy
+        self.in_memory = in_memory
+        self.buffer = None
+        self.source = None
+        self.layout = None
+        self._originals = None
+        self._origin = {}
+        self._graph = None
+        self._hashes = None
+        self.etag = None
+        self.version_id = None
+
+        self.backend = backend or storage.get_backend(env)
+        self.s3_bucket = self.backend.bucket
+        self.object = prefix if prefix is not None else storage.get_prefix(env)
 
         self.file = os.path.join(self.dl_prefix, self.object, self.name)
 
@@ -51,78 +81,257 @@ class TerraformState:
 
         full_path = os.path.join(name, self.object)
         if not os.path.exists(full_path):
-            try:
-                if not os.path.exists(name):
-                    os.mkdir(name)
-                os.mkdir(full_path)
-                logger.info(f'The directory {full_path} is created')
-            except OSError:
-                raise
+            # The states are downloaded concurrently, another thread may be creating the same folder
+            os.makedirs(full_path, exist_ok=True)
+            logger.info('The directory %s is created', full_path)
         else:
-            logger.info(f'The directory {full_path} exists')
+            logger.info('The directory %s exists', full_path)
         return name
 
     def load(self):
-        self.dict = self.from_file()
+        with metrics.span("parse") as span:
+            self._load()
+            span.bytes = len(self.buffer) if self.in_memory else os.path.getsize(self.file)
+            span.resources = len(self.index)
+
+    def _load(self):
+        if self.lazy and self._load_lazy():
+            return
+        if self.in_memory:
+            self.source = self.buffer
+            self.dict = json.loads(self.buffer)
+        elif self.save_mode == "splice":
+            with open(self.file, 'rb') as file:
+                self.source = file.read()
+            self.dict = json.loads(self.source)
+        else:
+            self.dict = self.from_file()
+        self.index = ResourceIndex(self.dict['resources'], changed=self._changed)
+        logger.debug('Indexed %s resources of %s', len(self.index), self.name)
+        if self.save_mode == "splice":
+            self._map_origin()
+
+    def _load_lazy(self) -> bool:
+        """
+        Maps the state file and indexes its resources from their headers. Only the top-level
+        fields other than "resources" are decoded.
+
+        :return: False if the file is not laid out the way Terraform writes states and has to be loaded in full
+        """
+        source = self.buffer if self.in_memory else open_mapped(self.file)
+        layout = scan_resources(source)
+        if layout is None:
+            logger.warning('%s is not laid out the way Terraform writes states, it is loaded in full', self.name)
+            if not self.in_memory:
+                source.close()
+            return False
+        self.source, self.layout = source, layout
+        # The file without its resources is the same document with an empty "resources" list
+        self.dict = json.loads(source[:layout.head_end].rstrip() + source[layout.tail_start:])
+        self.dict['resources'] = LazyResourceList(source, layout)
+        self.index = ResourceIndex(self.dict['resources'], changed=self._changed)
+        logger.debug('Indexed %s resources of %s without decoding them', len(self.index), self.name)
+        return True
+
+    def _origin_of(self, position: int):
+        resources = self.dict['resources']
+        if isinstance(resources, LazyResourceList):
+            return resources.origin(position)
+        return self._origin.get(id(resources[position]))
+
+    def _changed(self, resource: Dict[str, Any]) -> None:
+        """
+        A replaced or added resource is serialized on save, even if it is the loaded object edited in place,
+        e.g. one from getByQuery() passed back to updateByQuery()
+        """
+        resources = self.dict['resources']
+        if isinstance(resources, LazyResourceList):
+            resources.forget(resource)
+        else:
+            self._origin.pop(id(resource), None)
+
+    def _map_origin(self):
+        """
+        Remembers where every loaded resource is in the downloaded file, so the ones that are still the
+        same objects on save can be copied verbatim. The originals are kept referenced so their ids stay unique.
+        """
+        self.layout = scan_resources(self.source)
+        resources = self.dict['resources']
+        if self.layout is None or len(self.layout.spans) != len(resources):
+            logger.warning('%s is not laid out the way Terraform writes states, it is saved in full', self.name)
+            self.layout = self.source = None
+            return
+        self._originals = list(resources)
+        self._origin = {id(resource): position for position, resource in enumerate(resources)}
+
+    def _ensure_loaded(self):
+        """The state file is parsed once, the first time it is needed"""
+        if self.index is None:
+            self.load()
 
     def from_file(self):
         with(open(self.file, 'r', encoding='ASCII')) as file:
-            logger.debug(f'Working with the file {self.file}')
+            logger.debug('Working with the file %s', self.file)
             self.dict = json.load(file)
         return self.dict
 
-    def create_tmp_file(self):
-        tmp_file = f'{self.file}.tmp.json'
-        if not os.path.exists(tmp_file):
-            shutil.copyfile(self.file, tmp_file)
-            logger.info(f'The file is copied to {tmp_file}')
+    def write_to(self, fp: BinaryIO) -> None:
+        """
+        Serializes the state into a seekable binary file object, by splicing when the state was loaded for it.
+        The strings are escaped while they are encoded, so the "serialize" span includes the escaping
+        """
+        with metrics.span("serialize", resources=len(self.dict['resources'])) as span:
+            start = fp.tell()
+            if self.layout is not None and self.dict['resources']:
+                dump_spliced(self.source, self.layout, self.dict['resources'], self._origin_of, fp)
+            else:
+                text = io.TextIOWrapper(fp, encoding='utf-8')
+                dump_state(self.dict, text)
+                text.flush()
+                text.detach()
+            span.bytes = fp.tell() - start
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        self.write_to(buffer)
+        return buffer.getvalue()
+
+    def write_tmp_file(self):
+        """
+        Serializes the state into <state_file>.tmp.json, the file save() copies to the destination directory
 
-        with(open(tmp_file, 'r')) as file:
-            logger.debug(f'Working with the file {tmp_file}')
-            self.dict = json.load(file)
+        :return: Path to the tmp file
+        """
+        self.tmp_file = f'{self.file}.tmp.json'
+        with open(self.tmp_file, "wb") as state_file:
+            self.write_to(state_file)
+        logger.info('The state %s is written to %s', self.name, self.tmp_file)
+        return self.tmp_file
+
+    def flush(self):
+        """
+        Called once the changes of a transaction are applied. A state kept in memory is serialized
+        only when it is saved or uploaded, any other one is written to its tmp file
+        """
+        self._graph = None
+        self._hashes = None
+        if not self.in_memory:
+            self.write_tmp_file()
+
+    def transaction(self) -> StateTransaction:
+        """
+        Opens an edit session of the state. The staged changes are applied and written once on commit
 
-        return tmp_file
+        :rtype: StateTransaction
+        """
+        self._ensure_loaded()
+        return StateTransaction(self)
 
     def download(self):
         """
-        Downloads the files from an S3. Saves the downloaded file into the specified folder ("downloads") or raises error
+        Downloads the files from the storage of the state (S3 by default). Saves the downloaded file into the specified folder ("downloads") or raises error
+        The object is looked up by its current ETag in the download cache first and is fetched only if it changed.
+        A state kept in memory is downloaded into memory, bypassing the folder and the cache
 
         :return: Path to the downloaded file
 
         """
-        prefix = self.create_folder(name=self.dl_prefix)  # create a folder where to store the Terraform State
+        with metrics.span("download") as span:
+            path = self._download()
+            if path:
+                span.bytes = len(self.buffer) if self.in_memory else os.path.getsize(self.file)
+        return path
+
+    def _download(self):
+        if not self.in_memory:
+            prefix = self.create_folder(name=self.dl_prefix)  # create a folder where to store the Terraform State
+        else:
+            prefix = self.dl_prefix
         try:
             path = f'{self.object}/{self.name}'
-            self.s3_bucket.download_file(Key=path, Filename=f'{prefix}/{path}')
+            filename = f'{prefix}/{path}'
+            head = self.backend.head(path)
+            self.etag, self.version_id = head.etag, head.version_id
+            # The download is of the version of the HEAD request or fails, so the ETag always stands for the content
+            if self.in_memory:
+                self.buffer = self.backend.download_bytes(path, info=head)
+                return path
+
+            # Only the objects transferred over the network are worth caching
+            cache = download_cache.get_cache() if self.backend.remote else None
+            cached = cache.lookup(self.s3_bucket, path, self.etag, self.version_id) if cache else None
+            if cached:
+                with storage.replacing(filename) as tmp_path:
+                    shutil.copyfile(cached, tmp_path)
+                logger.info('%s: Unchanged since it was cached (ETag %s), not downloaded', path, self.etag)
+            else:
+                self.backend.download_file(path, filename=filename, info=head)
+                if cache:
+                    cache.store(self.s3_bucket, path, self.etag, self.version_id, filename)
             self.file = os.path.join(prefix, path)
-            logger.info(f'{path}: Downloaded')
             return path
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                logger.error(self.name + ": The object does not exist.")
-            elif e.response['Error']['Code'] == "400":
-                logger.error(f'Unauthorized')
-                exit(1)
-            else:
-                raise
+        except ObjectNotFoundError:
+            logger.error('%s: The object does not exist.', self.name)
+        except AccessDeniedError:
+            logger.error('Unauthorized')
+            exit(1)
+
+    def check_unchanged(self, path: str) -> None:
+        """
+        Refuses to go on if the stored object is not the version this state was downloaded from,
+        i.e. the edited copy would overwrite changes made in the meantime
+
+        :raises TFStateChangeError:
+        """
+        if self.etag is None:
+            logger.warning('%s: The state was not downloaded in this run, it can not be checked for changes', path)
+            return
+        etag = self.backend.head(path).etag
+        if etag != self.etag:
+            raise TFStateChangeError(f'{path} changed in {self.backend} since it was downloaded '
+                                     f'(ETag {self.etag} -> {etag}), refusing to upload a stale copy')
+
+    def backup(self, reason: str, data: bytes = None):
+        """
+        Snapshots the state as downloaded, or the given bytes, into the backup store of the run
+
+        :param reason: Why the snapshot is taken, e.g. "upload"
+        :return: The id of the snapshot, None if backups are disabled or there is nothing to back up
+        """
+        store = backup_store.get_store()
+        if store is None:
+            return None
+        if data is None and self.in_memory:
+            data = self.buffer
+        elif data is None and os.path.exists(self.file):
+            with open(self.file, 'rb') as file:
+                data = file.read()
+        if data is None:
+            logger.warning('%s: The state was not downloaded, there is nothing to back up', self.name)
+            return None
+        with metrics.span("backup", bytes=len(data)):
+            return store.snapshot(f'{self.s3_bucket}/{self.object}/{self.name}', data, reason=reason, etag=self.etag)
 
     def upload(self, source='modified'):
-        """Upload a file to an S3 bucket
+        """Upload a file to the storage of the state. The version it replaces is backed up first
 
-        :param source: The folder from where upload to
+        :param source: The folder from where upload to. A state kept in memory is serialized and uploaded from memory
         :return: True if file was uploaded, else False
         """
         try:
             path = f'{self.object}/{self.name}'
-            self.s3_bucket.upload_file(Filename=f'{source}/{path}', Key=path)
-            logger.info(f'{path}: Uploaded')
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "400":
-                logger.error(f'Unauthorized')
-                return False
-            else:
-                logger.error(e.response['Error'])
-                raise
+            self.check_unchanged(path)
+            self.backup("upload")
+            # The in-memory state is serialized before the span, its serialization is a span of its own
+            data = self.to_bytes() if self.in_memory else None
+            with metrics.span("upload") as span:
+                if self.in_memory:
+                    span.bytes = self.backend.upload_bytes(data, key=path)
+                else:
+                    span.bytes = self.backend.upload_file(f'{source}/{path}', key=path)
+        except AccessDeniedError:
+            logger.error('Unauthorized')
+            return False
         return True
 
     def save(self, dst='modified', rm_tmp=True):
@@ -135,79 +344,166 @@ class TerraformState:
 
         prefix = self.create_folder(dst)
         path = os.path.join(prefix, self.object, self.name)
-        shutil.copyfile(src=self.tmp_file, dst=path)
-        logger.info(f'The state is saved to {path}')
-        if rm_tmp:
-            os.remove(self.tmp_file)
+        with metrics.span("save") as span:
+            if self.in_memory:
+                with open(path, "wb") as state_file:
+                    self.write_to(state_file)
+            else:
+                shutil.copyfile(src=self.tmp_file, dst=path)
+                if rm_tmp:
+                    os.remove(self.tmp_file)
+            span.bytes = os.path.getsize(path)
+        logger.info('The state is saved to %s', path)
         return True
 
+    def rollback(self, snapshot_id: str = "latest", dst='modified', dry_run=False) -> str:
+        """
+        Rebuilds a snapshot of the state from the backup store and uploads it. The restored state is saved
+        to the destination directory as well, e.g. to diff it. The version it replaces is backed up first,
+        so a rollback can be rolled back too
+
+        :param snapshot_id: The id of a snapshot, "latest" for the version the last upload replaced
+        :param dry_run: Only save the restored state
+        :return: Path to the restored state
+        """
+        store = backup_store.get_store()
+        if store is None:
+            raise TFStateChangeError('Backups are disabled, there is nothing to roll back to')
+        data = store.restore(f'{self.s3_bucket}/{self.object}/{self.name}', snapshot_id)
+        path = os.path.join(self.create_folder(dst), self.object, self.name)
+        with open(path, 'wb') as state_file:
+            state_file.write(data)
+        logger.info('The restored state is saved to %s', path)
+        if dry_run:
+            return path
+
+        self.download()
+        key = f'{self.object}/{self.name}'
+        self.check_unchanged(key)
+        self.backup("rollback")
+        with metrics.span("upload") as span:
+            span.bytes = self.backend.upload_bytes(data, key=key)
+        return path
+
     @staticmethod
     def inplace_change(state_file):
-        with open(state_file) as f:
-            s = f.read()
+        """
+        Escapes <, > and & of a file written by json.dump the way Terraform does.
+        Kept for files written outside of TerraformState: write_tmp_file() escapes while serializing
+        """
+        with metrics.span("escape") as span:
+            with open(state_file) as f:
+                s = f.read()
 
-        with open(state_file, 'w') as f:
-            s = s.replace("<", "\\u003c")
-            s = s.replace(">", "\\u003e")
-            s = s.replace("&", "\\u0026")
-            f.write(s)
+            with open(state_file, 'w') as f:
+                s = s.replace("<", "\\u003c")
+                s = s.replace(">", "\\u003e")
+                s = s.replace("&", "\\u0026")
+                f.write(s)
+            span.bytes = len(s)
 
     def getByQuery(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
-        self.dict = self.from_file()
-        result = []
-        for resource in self.dict['resources']:
-            if all(x in resource and resource[x] == query[x] for x in query):
-                logger.info(f'Found the {query} in {self.name}')
-                result.append(resource)
-
+        self._ensure_loaded()
+        with metrics.span("query") as span:
+            result = self.index.get(query)
+            span.resources = len(result)
         if not result:
             raise DataNotFoundError(query)
+        logger.info('Found the %s in %s', query, self.name)
         return result
 
     def addResource(self, new_data: Dict[str, Any]) -> dict:
-        self.tmp_file = self.create_tmp_file()
-        with open(self.tmp_file, "w", encoding='utf-8') as state_file:
-            logger.info("Append new data; {0}".format(new_data))
-            self.dict["resources"].append(new_data)
-            json.dump(self.dict, state_file, indent=2)
-        self.inplace_change(self.tmp_file)
+        with self.transaction() as tx:
+            tx.add(new_data)
         return self.dict
 
     def deleteByQuery(self, query: Dict[str, Any]) -> list:
-        self.dict = self.from_file()
-        found, result = [], []
-        for resource in self.dict["resources"]:
-            if all(x in resource and resource[x] == query[x] for x in query):
-                found.append(resource)
-            else:
-                result.append(resource)
-
-        if len(found) > 0:
-            self.tmp_file = self.create_tmp_file()
-            with open(self.tmp_file, "w", encoding='utf-8') as state_file:
-                logger.info(f'Delete resources: \n {found}')
-                self.dict["resources"] = result
-                json.dump(self.dict, state_file, indent=2)
-            return found
-        else:
+        self._ensure_loaded()
+        found = self.index.get(query)
+        if not found:
+            raise DataNotFoundError(query)
+        # The version as downloaded, the one a rollback can restore. It is not serialized again,
+        # nor read at all if backups are disabled
+        self.backup("deleteByQuery")
+        with self.transaction() as tx:
+            tx.delete(query)
+        return found
+
+    def select(self, expression: str) -> List[Dict[str, Any]]:
+        """
+        The resources matching a selector expression (see selector.py), e.g.
+        "**.aws_lb_listener.* where attributes.port in (9092, 9093)". A resource matches if its address
+        matches the path and, if there are predicates, at least one of its instances matches them all.
+        """
+        self._ensure_loaded()
+        with metrics.span("query") as span:
+            selected = compile_selector(expression).select(self.index)
+            span.resources = len(selected)
+        return [self.dict['resources'][position] for position, _ in selected]
+
+    def dependencyGraph(self) -> DependencyGraph:
+        """
+        The dependency graph of the resources, built on first use and again after the state changed.
+        Building it reads every resource, a lazy state included
+        """
+        self._ensure_loaded()
+        if self._graph is None:
+            self._graph = DependencyGraph(self.dict['resources'])
+        return self._graph
+
+    def resourceHashes(self) -> Dict[str, Any]:
+        """
+        The content hash of every resource and of its instances by address (see state_diff.py), computed on first
+        use and again after the state changed. Hashing reads every resource, a lazy state included
+        """
+        self._ensure_loaded()
+        if self._hashes is None:
+            with metrics.span("hash", resources=len(self.dict['resources'])):
+                self._hashes = state_hashes(self.dict['resources'])
+        return self._hashes
+
+    def diff(self, other: 'TerraformState') -> StateDiff:
+        """
+        The resources added, removed and changed from this state to the other one, compared by hash.
+        Only the changed resources are compared attribute by attribute
+        """
+        hashes_a, hashes_b = self.resourceHashes(), other.resourceHashes()
+        with metrics.span("query") as span:
+            result = diff_states(self.dict['resources'], other.dict['resources'], hashes_a, hashes_b)
+            span.resources = len(result.added) + len(result.removed) + len(result.changed)
+        return result
+
+    def getDependencyClosure(self, query: Dict[str, Any], direction: str = "dependents") -> List[Dict[str, Any]]:
+        """
+        The resources matching the query and all the resources they transitively depend on or that depend on them
+
+        :param direction: "dependencies" (what they need), "dependents" (what needs them) or "both"
+        :raises DataNotFoundError: if no resource matches the query
+        """
+        self._ensure_loaded()
+        positions = self.index.find(query)
+        if not positions:
             raise DataNotFoundError(query)
+        with metrics.span("query") as span:
+            closure = self.dependencyGraph().closure(positions, direction=direction)
+            span.resources = len(closure)
+        logger.info('The %s closure of %s in %s has %s resources', direction, query, self.name, len(closure))
+        return [self.dict['resources'][position] for position in closure]
 
     def getResourceInstances(self, query: Dict[str, Any]) -> list:
-        result = []
-        # self.printDict(self.dict['resources'])
-        logger.debug(f'Query: {query}')
-        logger.debug(dir(self.dict['resources']))
-        logger.debug(type(self.dict['resources']))
-        counter = 0
-        for resource in self.dict['resources']:
-            counter = counter + 1
-            logger.debug(f"test {counter}")
-            if all(x in resource and resource[x] == query[x] for x in query):
-                logger.debug(f"found the {query}!")
-                result.append(resource["instances"])
-        if len(result[0]) < 1:
-            logger.error(f'Did not found such a resource: {query}')
-        return result[0]
+        self._ensure_loaded()
+        logger.debug('Query: %s', query)
+        with metrics.span("query") as span:
+            positions = self.index.find(query)
+            span.resources = len(positions)
+        if not positions:
+            logger.error('Did not found such a resource: %s', query)
+            raise DataNotFoundError(query)
+        logger.debug('found the %s!', query)
+        result = self.dict['resources'][positions[0]]["instances"]
+        if len(result) < 1:
+            logger.error('Did not found such a resource: %s', query)
+        return result
 
     @staticmethod
     def printDict(d: Dict):
@@ -224,9 +520,10 @@ class TerraformState:
 
         if attribute_key in attr_dict.keys():
             attr_dict.pop(attribute_key)
-            logger.debug(f'Instance: {instance.get("index_key")} - Delete attribute by key: {attribute_key}')
+            logger.debug('Instance: %s - Delete attribute by key: %s', instance.get('index_key'), attribute_key)
         else:
-            logger.info(f'No attributes found by attribute_key: {attribute_key} in instance {instance}')
+            logger.info('No attributes found by attribute_key: %s in instance %s', attribute_key,
+                        instance.get('index_key'))
 
         instance.pop("attributes")
         instance["attributes"] = attr_dict
@@ -236,7 +533,7 @@ class TerraformState:
     @staticmethod
     def addInstanceAttr(instance: Dict[str, Any], attribute_key: str, attribute_value):
         instance["attributes"].update({attribute_key: attribute_value})
-        logger.debug(f'Instance: {instance.get("index_key")} - Add new attribute {attribute_key}')
+        logger.debug('Instance: %s - Add new attribute %s', instance.get('index_key'), attribute_key)
         return instance
 
     def updateInstanceAttr(self, instance: Dict[str, Any], attribute_key: str, attribute_value: Dict[str, Any]) -> \
@@ -250,38 +547,16 @@ class TerraformState:
         return instance_with_attr_updated
 
     def updateByQuery(self, query: Dict[str, Any], new_resource=None, new_instances=None) -> bool:
-        result = []
-        found = False
-
-        for resource in self.dict["resources"]:
-            if all(x in resource and resource[x] == query[x] for x in query):
-                found = True
+        try:
+            with self.transaction() as tx:
                 if new_resource:
-                    if set(new_resource.keys()).issubset(resource.keys()):
-                        result.append(new_resource)
-                        logger.info(f'The resource {query} is replaced in {self.name}')
-                        logger.debug(f'The resource {query} is replaced in {self.name} by: {new_resource}')
-                    else:
-                        raise SchemaError(
-                            "original resource keys: " + ",".join(sorted(list(resource.keys()))),
-                            "new_resource keys: "
-                            + ",".join(sorted(list(new_resource.keys()))),
-                        )
-                if new_instances:
-                    resource["instances"] = new_instances
-                    result.append(resource)
-                    logger.info(f'The resource {query} is updated with the instances: {new_instances}')
-            else:
-                result.append(resource)
-        if not found:
-            logger.error(
-                f'There is no resource matching the given filter {query} in the state {self.name},'
-                f' hence it is not updated')
+                    tx.replace(query, new_resource=new_resource)
+                elif new_instances:
+                    tx.set_instances(query, new_instances=new_instances)
+                elif not self.index.find(query):
+                    raise DataNotFoundError(query)
+        except DataNotFoundError:
+            logger.error('There is no resource matching the given filter %s in the state %s, hence it is not updated',
+                         query, self.name)
             exit(1)
-        else:
-            self.tmp_file = self.create_tmp_file()
-            with open(self.tmp_file, "w", encoding='utf-8') as state_file:
-                self.dict["resources"] = result
-                json.dump(self.dict, state_file, indent=2)
-            self.inplace_change(self.tmp_file)
-        return found
+        return True